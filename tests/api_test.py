@@ -79,3 +79,127 @@ def test_create_image_cmd(load_fixture, fixture, expected):
     data = load_fixture(fixture)
     cmd = api.create_image_cmd(data, singleline=False)
     assert cmd == "\n".join(expected)
+
+
+@pytest.fixture
+def direct_data(load_fixture, monkeypatch):
+    monkeypatch.setattr(
+        api, "get_pool_target", lambda uri, pool: ("dir", "/var/lib/libvirt/images")
+    )
+    data = load_fixture("minimum.yml")
+    data["general"]["build-mode"] = "direct"
+    return data
+
+
+def test_direct_build_stages(direct_data):
+    stages = api.get_create_stages(direct_data)
+    assert [name for name, _ in stages] == ["volume", "image", "vm"]
+    image_cmds = dict(stages)["image"]
+    lines = image_cmds[0].split("\n")
+    assert "  --output /var/lib/libvirt/images/kmaster \\" in lines
+    assert image_cmds[1] == "virsh --connect qemu:///system pool-refresh --pool kvm"
+
+
+def test_direct_build_rejects_upload_stage(direct_data):
+    with pytest.raises(ValueError) as exc:
+        api.get_create_stages(direct_data, stage="upload")
+    assert "'stage' must be one of" in str(exc.value)
+
+
+@pytest.fixture
+def replicas_data(load_fixture, monkeypatch):
+    monkeypatch.setattr(
+        api, "get_pool_target", lambda uri, pool: ("dir", "/var/lib/libvirt/images")
+    )
+    data = load_fixture("minimum.yml")
+    data["replicas"] = {
+        "count": 2,
+        "name": "worker-{index}",
+        "network": "bridge=br0,mac=52:54:00:00:00:{index:02x}",
+        "provision": [{"run-command": "ssh-keygen -A"}],
+    }
+    return data
+
+
+def test_expand_replicas(replicas_data):
+    nodes = api.expand_replicas(replicas_data)
+    assert [node["general"]["name"] for node in nodes] == [
+        "kmaster",
+        "worker-1",
+        "worker-2",
+    ]
+    assert nodes[2]["vm"]["network"] == "bridge=br0,mac=52:54:00:00:00:02"
+    assert nodes[2]["replica"]["base"] == "kmaster"
+    # The base is only built and uploaded, it never boots
+    assert api.get_stages(nodes[0]) == ["image", "volume", "upload", "cleanup"]
+    assert api.get_stages(nodes[1]) == api.REPLICA_STAGES
+    assert api.get_node_dependencies(nodes[1]) == {"overlay": [("kmaster", "upload")]}
+
+
+def test_replica_commands(replicas_data):
+    replica = api.get_replicas(replicas_data)[0]
+    stages = dict(api.get_create_stages(replica))
+    overlay = stages["overlay"][0].split("\n")
+    assert "  --backing-vol kmaster \\" in overlay
+    assert "  --backing-vol-format qcow2" in overlay
+    customize = stages["customize"][0].split("\n")
+    assert "  --add /var/lib/libvirt/images/worker-1 \\" in customize
+    assert "  --hostname worker-1 \\" in customize
+    assert "  --truncate /etc/machine-id \\" in customize
+    assert '  --run-command "ssh-keygen -A"' in customize
+    assert "  --network bridge=br0,mac=52:54:00:00:00:01" in stages["vm"][0]
+
+
+def test_replicas_with_fixed_mac_need_network_template(replicas_data):
+    replicas_data["vm"]["network"] = "bridge=br0,mac=52:54:00:00:00:01"
+    del replicas_data["replicas"]["network"]
+    with pytest.raises(ValueError) as exc:
+        api.get_replicas(replicas_data)
+    assert "network template" in str(exc.value)
+
+
+def test_remove_replicas_before_the_base(replicas_data):
+    cmds = api._get_remove_commands(replicas_data)
+    assert cmds[-1] == "virsh --connect qemu:///system vol-delete --pool kvm kmaster"
+    assert "virsh --connect qemu:///system destroy worker-2" in cmds
+
+
+def test_direct_build_requires_local_uri(load_fixture):
+    with pytest.raises(ValueError) as exc:
+        api.get_pool_target("qemu+ssh://root@host/system", "kvm")
+    assert "local URI" in str(exc.value)
+
+
+@pytest.mark.parametrize(
+    "pool_type, error", [("dir", False), ("logical", False), ("rbd", True)]
+)
+def test_get_pool_target(monkeypatch, pool_type, error):
+    xml = f"<pool type='{pool_type}'><target><path>/pools/p1</path></target></pool>"
+    monkeypatch.setattr(api.subprocess, "check_output", lambda cmd: xml.encode())
+    # get_pool_target() is cached, so use a different pool per parameter
+    if error:
+        with pytest.raises(ValueError):
+            api.get_pool_target("qemu:///system", pool_type)
+    else:
+        assert api.get_pool_target("qemu:///system", pool_type) == (
+            pool_type,
+            "/pools/p1",
+        )
+
+
+def test_scratch_dir(load_fixture):
+    data = load_fixture("minimum.yml")
+    data["general"]["scratch-dir"] = "/dev/shm"
+    cmds = api._get_create_commands(data, stage=None)
+    assert "  --output /dev/shm/kmaster.qcow2 \\" in cmds[0].split("\n")
+    assert cmds[2].endswith("--file /dev/shm/kmaster.qcow2")
+    assert cmds[3].endswith(" /dev/shm/kmaster.qcow2")
+
+
+def test_image_source(load_fixture):
+    data = load_fixture("minimum.yml")
+    data["image"]["source"] = "file:///var/cache/templates/index"
+    data["image"]["no-check-signature"] = True
+    lines = api.create_image_cmd(data).split("\n")
+    assert '  --source "file:///var/cache/templates/index" \\' in lines
+    assert "  --no-check-signature" in [line.rstrip(" \\") for line in lines]
@@ -0,0 +1,233 @@
+import hashlib
+import subprocess
+
+import pytest
+
+from virtbuilder import backends
+
+
+def test_get_backend_virsh():
+    assert isinstance(backends.get_backend("virsh"), backends.VirshBackend)
+
+
+def test_get_backend_unknown_raises():
+    with pytest.raises(ValueError) as exc:
+        backends.get_backend("gibberish")
+    assert "backend must be one of" in str(exc.value)
+
+
+def test_get_backend_auto_falls_back_to_virsh(monkeypatch):
+    monkeypatch.setattr(backends, "libvirt", None)
+    assert type(backends.get_backend("auto")) is backends.VirshBackend
+
+
+def test_libvirt_backend_requires_the_bindings(monkeypatch):
+    monkeypatch.setattr(backends, "libvirt", None)
+    with pytest.raises(RuntimeError):
+        backends.get_backend("libvirt")
+
+
+def test_virsh_backend_executes_the_commands(monkeypatch, load_fixture):
+    executed = []
+    monkeypatch.setattr(backends, "execute_cmd", executed.append)
+    monkeypatch.setattr(backends.state, "get_domain_state", lambda data: "running")
+    backend = backends.VirshBackend()
+    backend.run_stage(load_fixture("minimum.yml"), "image", ["cmd1", "cmd2"])
+    backend.remove(load_fixture("minimum.yml"))
+    assert executed == [
+        "cmd1",
+        "cmd2",
+        "virsh --connect qemu:///system destroy kmaster",
+        "virsh --connect qemu:///system undefine --remove-all-storage kmaster",
+    ]
+
+
+@pytest.fixture
+def libvirt_data(load_fixture):
+    """ A definition that targets libvirt's test driver """
+    pytest.importorskip("libvirt")
+    data = load_fixture("minimum.yml")
+    data["general"].update(uri="test:///default", pool="default-pool", name="test")
+    data["image"]["size"] = "1M"
+    return data
+
+
+def test_libvirt_backend_reuses_the_connection(libvirt_data):
+    backend = backends.LibvirtBackend()
+    conn = backend.get_connection("test:///default")
+    assert backend.get_connection("test:///default") is conn
+    backend.close()
+    assert backend.get_connection("test:///default") is not conn
+
+
+def test_libvirt_backend_creates_volumes(libvirt_data):
+    backend = backends.LibvirtBackend()
+    backend.run_stage(libvirt_data, "volume", [])
+    pool = backend.get_connection("test:///default").storagePoolLookupByName(
+        "default-pool"
+    )
+    assert "test" in pool.listVolumes()
+
+
+def test_libvirt_backend_preallocates_metadata(libvirt_data, monkeypatch):
+    created = []
+
+    class Pool(object):
+        def createXML(self, xml, flags):
+            created.append(flags)
+
+    backend = backends.LibvirtBackend()
+    monkeypatch.setattr(backend, "_get_pool", lambda data: Pool())
+    libvirt_data["image"]["qcow2"] = {"preallocation": "metadata"}
+    backend.run_stage(libvirt_data, "volume", [])
+    assert created == [backends.libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA]
+
+
+def test_libvirt_backend_removes_domains(libvirt_data):
+    backend = backends.LibvirtBackend()
+    conn = backend.get_connection("test:///default")
+    assert "test" in [domain.name() for domain in conn.listAllDomains()]
+    backend.remove(libvirt_data)
+    assert "test" not in [domain.name() for domain in conn.listAllDomains()]
+    # Removing an absent domain is a no-op
+    backend.remove(libvirt_data)
+
+
+def test_virsh_backend_removes_orphan_volumes(monkeypatch, load_fixture):
+    executed = []
+    monkeypatch.setattr(backends, "execute_cmd", executed.append)
+    monkeypatch.setattr(backends.state, "get_domain_state", lambda data: None)
+    monkeypatch.setattr(backends.state, "volume_exists", lambda data: True)
+    backends.VirshBackend().remove(load_fixture("minimum.yml"))
+    assert executed == ["virsh --connect qemu:///system vol-delete --pool kvm kmaster"]
+
+
+def test_virsh_backend_removes_stopped_domains(monkeypatch, load_fixture):
+    executed = []
+    monkeypatch.setattr(backends, "execute_cmd", executed.append)
+    monkeypatch.setattr(backends.state, "get_domain_state", lambda data: "shut off")
+    backends.VirshBackend().remove(load_fixture("minimum.yml"))
+    assert executed == [
+        "virsh --connect qemu:///system undefine --remove-all-storage kmaster"
+    ]
+
+
+@pytest.mark.parametrize(
+    "stderr, expected",
+    [
+        ("error: failed to get domain 'kmaster'", None),
+        ("error: failed to connect to the hypervisor", subprocess.CalledProcessError),
+    ],
+)
+def test_get_domain_state_errors(monkeypatch, load_fixture, stderr, expected):
+    def run(cmd, **kwargs):
+        return subprocess.CompletedProcess(cmd, 1, stdout="", stderr=stderr)
+
+    monkeypatch.setattr(subprocess, "run", run)
+    data = load_fixture("minimum.yml")
+    if expected is None:
+        assert backends.state.get_domain_state(data) is None
+    else:
+        # e.g. an unreachable host doesn't count as a removed domain
+        with pytest.raises(expected):
+            backends.VirshBackend().remove(data)
+
+
+@pytest.mark.parametrize(
+    "action, domain_state, expected",
+    [
+        ("start", "shut off", "virsh --connect qemu:///system start kmaster"),
+        ("start", "running", None),
+        ("stop", "running", "virsh --connect qemu:///system shutdown kmaster"),
+        ("stop", None, None),
+        ("reboot", "running", "virsh --connect qemu:///system reboot kmaster"),
+        ("reboot", "shut off", None),
+    ],
+)
+def test_virsh_backend_lifecycle(
+    monkeypatch, load_fixture, action, domain_state, expected
+):
+    executed = []
+    monkeypatch.setattr(backends, "execute_cmd", executed.append)
+    monkeypatch.setattr(backends.state, "get_domain_state", lambda data: domain_state)
+    getattr(backends.VirshBackend(), action)(load_fixture("minimum.yml"))
+    assert executed == ([expected] if expected else [])
+
+
+@pytest.mark.parametrize("verify", [False, True])
+def test_single_stream_uploads_report_progress(tmp_path, load_fixture, verify):
+    data = load_fixture("minimum.yml")
+    data["general"]["scratch-dir"] = str(tmp_path)
+    image = backends.api.get_image_path(data)
+    image.write_bytes(b"0" * 1024)
+    lines = []
+    backend = backends.VirshBackend(verify_upload=verify, output=lines.append)
+    uploaded = []
+    downloaded = []
+    backend.upload_range = lambda data, *range: uploaded.append(range)
+
+    def download_digest(data, offset, length):
+        downloaded.append((offset, length))
+        return hashlib.sha256(b"0" * length).hexdigest()
+
+    backend.download_digest = download_digest
+    assert not backend.runs_commands("upload")
+    backend.run_stage(data, "upload", ["virsh vol-upload"])
+    assert uploaded == [(0, 1024)]
+    assert downloaded == ([(0, 1024)] if verify else [])
+    (line,) = lines
+    assert line.startswith("[kmaster/upload] 100.0% of 0.0 MiB")
+
+
+def test_virsh_backend_uploads_ranges(monkeypatch, load_fixture):
+    backend = backends.VirshBackend(upload_streams=4)
+    assert not backend.runs_commands("upload")
+    assert backend.runs_commands("image")
+    executed = []
+    monkeypatch.setattr(backends, "execute_cmd", executed.append)
+    backend.upload_range(load_fixture("minimum.yml"), 1024, 512)
+    assert executed[0].endswith(" --offset 1024 --length 512")
+
+
+VIRSH_OUTPUT = {
+    "nodeinfo": "CPU model:           x86_64\nCPU(s):              16\n",
+    "freecell": "    0: 3000000 KiB\n    1: 1000000 KiB\n--------------------\n"
+    "Total: 4000000 KiB\n",
+    "pool-info": "Name:           kvm\nState:          running\n"
+    "Available:      53687091200\n",
+    "domstats": "Domain: 'n1'\n  vcpu.current=2\n  vcpu.maximum=4\n\n"
+    "Domain: 'n2'\n  vcpu.current=4\n  vcpu.maximum=4\n",
+}
+
+
+def test_virsh_backend_get_host_info(monkeypatch):
+    commands = []
+
+    def check_output(cmd, **kwargs):
+        commands.append(cmd)
+        return VIRSH_OUTPUT[cmd[2]]
+
+    monkeypatch.setattr(subprocess, "check_output", check_output)
+    info = backends.VirshBackend().get_host_info("qemu+ssh://h1/system", "kvm")
+    assert info == {
+        "cpus": 16,
+        "vcpus": 6,
+        "free_memory": 4000000 * 1024,
+        "free_disk": 50 * 1024 ** 3,
+    }
+    assert commands[-1] == [
+        "virsh",
+        "--connect=qemu+ssh://h1/system",
+        "pool-info",
+        "kvm",
+        "--bytes",
+    ]
+
+
+def test_libvirt_backend_get_host_info(libvirt_data):
+    info = backends.LibvirtBackend().get_host_info("test:///default", "default-pool")
+    assert info["cpus"] > 0
+    # The test driver starts with a running domain
+    assert info["vcpus"] > 0
+    assert info["free_memory"] > 0
+    assert info["free_disk"] > 0
@@ -0,0 +1,29 @@
+import pytest
+
+from virtbuilder import api
+from virtbuilder import scheduler
+
+from .conftest import FLEET_SIZES, PROVISION_SIZES, make_definition
+
+pytest.importorskip("pytest_benchmark")
+
+pytestmark = pytest.mark.bench
+
+
+@pytest.mark.parametrize("provision_size", PROVISION_SIZES)
+@pytest.mark.parametrize("stage", api.CREATE_STAGES)
+def test_create_cmd(run_benchmark, stage, provision_size):
+    data = make_definition(provision_size=provision_size)
+    run_benchmark(api.CREATE_COMMAND_DISPATCHER[stage], data)
+
+
+@pytest.mark.parametrize("provision_size", PROVISION_SIZES)
+def test_get_create_stages(run_benchmark, provision_size):
+    data = make_definition(provision_size=provision_size)
+    run_benchmark(api.get_create_stages, data)
+
+
+@pytest.mark.parametrize("fleet_size", FLEET_SIZES)
+def test_get_create_plan(run_benchmark, definition_files, fleet_size):
+    paths = definition_files(fleet_size)
+    run_benchmark(scheduler.get_create_plan, paths)
@@ -0,0 +1,107 @@
+r"""
+Micro benchmarks of the definition loading, validation and command generation.
+
+The benchmarks are skipped unless ``--runbench`` is given. In order to catch
+regressions, save a baseline and compare against it:
+
+    pytest tests/benchmarks --runbench --benchmark-autosave
+    pytest tests/benchmarks --runbench --benchmark-compare \
+        --benchmark-compare-fail=mean:10%
+
+Besides the timings, each benchmark stores the peak memory that a single call
+allocates (as measured by ``tracemalloc``) in the ``extra_info`` of the results.
+
+"""
+import tracemalloc
+
+import pytest
+import ruamel.yaml
+
+PROVISION_SIZES = [0, 10, 100]
+FLEET_SIZES = [1, 10, 100]
+
+
+def make_definition(name="node", provision_size=10):
+    """ Return a synthetic definition with ``provision_size`` provision steps """
+    provision = []
+    for i in range(provision_size):
+        step = i % 4
+        if step == 0:
+            provision.append({"run-command": f"echo {i} > /tmp/{i}"})
+        elif step == 1:
+            provision.append({"append-line": f"/etc/hosts:10.0.0.{i % 255} host{i}"})
+        elif step == 2:
+            provision.append({"install": [f"package{i}", f"package{i}-extra"]})
+        else:
+            provision.append({"mkdir": f"/opt/dir{i}"})
+    return {
+        "general": {
+            "uri": "qemu:///system",
+            "pool": "kvm",
+            "name": name,
+            "domain": "test.local",
+            "format": "qcow2",
+            "os-name": "ubuntu",
+            "os-version": "18.04",
+        },
+        "image": {
+            "size": "12G",
+            "arch": "x86_64",
+            "no-sync": True,
+            "memsize": 2000,
+            "smp": 2,
+            "config": {
+                "update": True,
+                "timezone": "Europe/Athens",
+                "password-crypto": "sha512",
+                "root-password": "password:1234",
+                "provision": provision,
+            },
+        },
+        "vm": {
+            "ram": 2048,
+            "vcpus": 2,
+            "console": "pty,target_type=serial",
+            "network": "bridge=virbr0,mac=52:54:00:10:00:10",
+        },
+    }
+
+
+def write_definition(directory, data):
+    path = directory / f"{data['general']['name']}.yml"
+    yml = ruamel.yaml.YAML(typ="safe", pure=True)
+    # Block style, like the hand written definitions
+    yml.default_flow_style = False
+    with path.open("w") as fd:
+        yml.dump(data, fd)
+    return path
+
+
+@pytest.fixture
+def definition_files(tmp_path):
+    """ Write a fleet of synthetic definitions and return their paths """
+
+    def _writer(fleet_size, provision_size=10):
+        return [
+            write_definition(tmp_path, make_definition(f"node{i}", provision_size))
+            for i in range(fleet_size)
+        ]
+
+    return _writer
+
+
+@pytest.fixture
+def run_benchmark(benchmark):
+    """ Benchmark ``func`` and record the peak memory of a single call """
+
+    def _runner(func, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_memory_kib"] = peak / 1024
+        return benchmark(func, *args, **kwargs)
+
+    return _runner
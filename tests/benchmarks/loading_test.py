@@ -0,0 +1,41 @@
+import copy
+
+import pytest
+
+from virtbuilder.schemas import FullSchema
+from virtbuilder.utils import load_yaml
+from virtbuilder.validator import DefinitionCache, validate_data
+
+from .conftest import PROVISION_SIZES, make_definition
+
+pytest.importorskip("pytest_benchmark")
+
+pytestmark = pytest.mark.bench
+
+
+@pytest.mark.parametrize("provision_size", PROVISION_SIZES)
+def test_load_yaml(run_benchmark, definition_files, provision_size):
+    (path,) = definition_files(1, provision_size)
+    run_benchmark(load_yaml, path)
+
+
+@pytest.mark.parametrize("provision_size", PROVISION_SIZES)
+def test_full_schema_validate(run_benchmark, provision_size):
+    data = make_definition(provision_size=provision_size)
+    run_benchmark(FullSchema.validate, copy.deepcopy(data))
+
+
+@pytest.mark.parametrize("provision_size", PROVISION_SIZES)
+def test_compiled_validate(run_benchmark, provision_size):
+    data = make_definition(provision_size=provision_size)
+    run_benchmark(validate_data, copy.deepcopy(data))
+
+
+@pytest.mark.parametrize("provision_size", PROVISION_SIZES)
+def test_cached_definition_load(
+    run_benchmark, definition_files, tmp_path, provision_size
+):
+    (path,) = definition_files(1, provision_size)
+    cache = DefinitionCache(tmp_path / "cache")
+    cache.load(path)
+    run_benchmark(cache.load, path)
@@ -0,0 +1,173 @@
+import copy
+import os
+import time
+
+import pytest
+
+from virtbuilder import api
+from virtbuilder import scheduler
+from virtbuilder.cache import LayerCache, get_layer_keys, get_referenced_paths
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return LayerCache(path=tmp_path / "layers")
+
+
+def build_layers(cache, keys):
+    """ Pretend that the layers of ``keys`` have been built """
+    parent = None
+    for key, description in keys:
+        cache.register(key, parent, description)
+        cache.layer_path(key).write_bytes(b"0" * 1024)
+        parent = key
+
+
+@pytest.mark.parametrize(
+    "key, value, expected",
+    [
+        ("ssh-inject", "root:file:/tmp/id_rsa.pub", ["/tmp/id_rsa.pub"]),
+        ("root-password", "file:/tmp/password", ["/tmp/password"]),
+        ("copy-in", "/tmp/netcfg.yaml:/etc/netplan/", ["/tmp/netcfg.yaml"]),
+        ("run", "/tmp/script.sh", ["/tmp/script.sh"]),
+        ("run-command", "rm /etc/machine-id", []),
+        ("install", ["wget"], []),
+    ],
+)
+def test_get_referenced_paths(key, value, expected):
+    assert get_referenced_paths(key, value) == expected
+
+
+def test_layer_keys_are_stable(load_fixture):
+    data = load_fixture("valid.yml")
+    keys = get_layer_keys(data)
+    # base layer + one layer per provision step
+    assert len(keys) == 1 + len(data["image"]["config"]["provision"])
+    assert keys == get_layer_keys(load_fixture("valid.yml"))
+
+
+def test_layer_keys_ignore_the_hostname(load_fixture):
+    data = load_fixture("valid.yml")
+    other = copy.deepcopy(data)
+    other["general"]["name"] = "knode"
+    assert get_layer_keys(data) == get_layer_keys(other)
+
+
+def test_changing_a_step_changes_only_the_subsequent_keys(load_fixture):
+    data = load_fixture("valid.yml")
+    other = copy.deepcopy(data)
+    other["image"]["config"]["provision"][-1]["install"].append("htop")
+    keys, other_keys = get_layer_keys(data), get_layer_keys(other)
+    assert keys[:-1] == other_keys[:-1]
+    assert keys[-1] != other_keys[-1]
+
+
+def test_referenced_files_affect_the_keys(load_fixture, tmp_path):
+    script = tmp_path / "script.sh"
+    script.write_text("echo 1")
+    data = load_fixture("minimum.yml")
+    data["image"]["config"] = {"provision": [{"run": str(script)}]}
+    before = get_layer_keys(data)
+    script.write_text("echo 2")
+    after = get_layer_keys(data)
+    assert before[0] == after[0]
+    assert before[1] != after[1]
+
+
+def test_get_image_cmds_without_cached_layers(load_fixture, cache):
+    data = load_fixture("valid.yml")
+    cmds = cache.get_image_cmds(data, singleline=True)
+    steps = len(data["image"]["config"]["provision"])
+    assert cmds[0].startswith("virt-builder ubuntu-18.04 --verbose --format qcow2")
+    assert "--hostname" not in cmds[0]
+    # one virt-builder + mv, and one qemu-img create + virt-customize + mv per step
+    assert len(cmds) == 2 + 3 * steps + 2
+    assert cmds[-2].startswith("qemu-img convert -O qcow2")
+    assert cmds[-2].endswith("kmaster.qcow2")
+    assert "--hostname kmaster.test.local" in cmds[-1]
+    # The data must not be mutated
+    assert data == load_fixture("valid.yml")
+
+
+def test_get_image_cmds_resumes_from_the_longest_cached_prefix(load_fixture, cache):
+    data = load_fixture("valid.yml")
+    keys = get_layer_keys(data)
+    build_layers(cache, keys[:-1])
+    cmds = cache.get_image_cmds(data, singleline=True)
+    assert len(cmds) == 3 + 2
+    assert cmds[0].startswith("qemu-img create")
+    assert str(cache.layer_path(keys[-2][0])) in cmds[0]
+    assert cmds[1].startswith("virt-customize")
+    assert "--install" in cmds[1]
+
+
+def test_get_image_cmds_with_all_layers_cached(load_fixture, cache):
+    data = load_fixture("valid.yml")
+    build_layers(cache, get_layer_keys(data))
+    cmds = cache.get_image_cmds(data, singleline=True)
+    assert len(cmds) == 2
+    assert cmds[0].startswith("qemu-img convert")
+
+
+def test_get_create_stages_uses_the_cache(load_fixture, cache):
+    data = load_fixture("minimum.yml")
+    stages = api.get_create_stages(data, cache=cache)
+    assert [name for name, _ in stages] == api.CREATE_STAGES
+    assert len(stages[0][1]) == 4
+
+
+def test_generating_the_cmds_leaves_the_cache_untouched(load_fixture, cache):
+    build_layers(cache, [("x", "x")])
+    before = [(meta["key"], meta["last_used"]) for meta in cache.entries()]
+    cmds = cache.get_image_cmds(load_fixture("minimum.yml"), singleline=True)
+    assert [(meta["key"], meta["last_used"]) for meta in cache.entries()] == before
+    # The partial layers are named after the node
+    assert ".kmaster.part " in cmds[0]
+
+
+def test_prepare_registers_the_layers(load_fixture, cache):
+    data = load_fixture("valid.yml")
+    other = load_fixture("minimum.yml")
+    build_layers(cache, get_layer_keys(other)[:1])
+    cache.budget = 0
+    # The layers of the pending builds of this run are never evicted
+    cache.get_image_cmds(other)
+    cache.prepare(data)
+    keys = [key for key, _ in get_layer_keys(data)]
+    assert {meta["key"] for meta in cache.entries()} == set(keys) | {
+        get_layer_keys(other)[0][0]
+    }
+    assert [meta["parent"] for meta in cache.entries() if meta["key"] == keys[1]] == [
+        keys[0]
+    ]
+
+
+def test_prune_evicts_lru_layers_with_their_descendants(cache):
+    build_layers(cache, [("a", "a"), ("b", "b"), ("c", "c")])
+    build_layers(cache, [("x", "x")])
+    # Make "a" (and therefore "b" & "c") the least recently used layers
+    past = time.time() - 1000
+    for key in "abc":
+        os.utime(cache.meta_path(key), (past, past))
+    assert [meta["key"] for meta in cache.entries()][0] == "a"
+    evicted = cache.prune(budget="2K")
+    assert set(evicted) == {"a", "b", "c"}
+    assert [meta["key"] for meta in cache.entries()] == ["x"]
+
+
+def test_prune_keeps_the_requested_layers(cache):
+    build_layers(cache, [("a", "a"), ("b", "b")])
+    assert cache.prune(budget=0, keep={"b"}) == []
+    assert cache.prune(budget=0) == ["a", "b"]
+
+
+def test_the_image_stage_prepares_the_cache(get_fixture, cache):
+    plan = scheduler.get_create_plan(
+        [get_fixture("minimum.yml")],
+        stage="image",
+        cache=cache,
+        run=lambda data, stage, cmds, on_success: None,
+    )
+    assert cache.entries() == []
+    plan.tasks[("kmaster", "image")].action()
+    assert len(cache.entries()) == 1
@@ -0,0 +1,125 @@
+import pathlib
+
+import pytest
+from schema import SchemaError
+
+from virtbuilder import cluster
+from virtbuilder import validator
+from virtbuilder.utils import load_yaml
+
+EXAMPLE = pathlib.Path(__file__).parent.parent / "examples" / "cluster3-ansible"
+
+CLUSTER = """
+defaults:
+  general:
+    uri: 'qemu:///system'
+    pool: 'kvm'
+    format: 'qcow2'
+    os-name: 'ubuntu'
+    os-version: '18.04'
+  image:
+    size: '6G'
+    config:
+      provision:
+        - install: ['wget']
+  vm:
+    ram: 1024
+    vcpus: 2
+nodes:
+  - general: {name: 'node1'}
+  - general: {name: 'node2'}
+    vm: {ram: 2048}
+"""
+
+
+@pytest.fixture
+def write(tmp_path):
+    def _write(text, name="cluster.yml"):
+        path = tmp_path / name
+        path.write_text(text)
+        return path
+
+    return _write
+
+
+def test_merge_shares_the_untouched_structures():
+    base = {"a": {"b": 1, "c": [1]}, "d": {"e": 1}}
+    merged = cluster.merge(base, {"a": {"b": 2}, "f": 3})
+    assert merged == {"a": {"b": 2, "c": [1]}, "d": {"e": 1}, "f": 3}
+    assert merged["d"] is base["d"]
+    assert merged["a"]["c"] is base["a"]["c"]
+    assert base["a"]["b"] == 1
+
+
+def test_lists_are_replaced():
+    assert cluster.merge({"a": [1, 2]}, {"a": [3]}) == {"a": [3]}
+
+
+def test_iter_definitions(write):
+    path = write(CLUSTER)
+    node1, node2 = cluster.iter_definitions(path)
+    assert node1["general"]["name"] == "node1"
+    assert node1["vm"] == {"ram": 1024, "vcpus": 2}
+    assert node2["vm"] == {"ram": 2048, "vcpus": 2}
+    assert node1["image"] is node2["image"]
+
+
+def test_multiple_documents(write, get_fixture):
+    path = write(f"{CLUSTER}---\n{get_fixture('minimum.yml').read_text()}")
+    names = [data["general"]["name"] for data in cluster.iter_definitions(path)]
+    assert names == ["node1", "node2", "kmaster"]
+
+
+def test_iter_definitions_is_lazy(write):
+    path = write(CLUSTER + "  - general: {name: 'node3'}\n    gibberish: 1\n")
+    definitions = cluster.iter_definitions(path)
+    assert next(definitions)["general"]["name"] == "node1"
+    assert next(definitions)["general"]["name"] == "node2"
+    with pytest.raises(SchemaError) as exc:
+        next(definitions)
+    assert exc.value.autos == ["document 0, nodes[2]: Wrong key 'gibberish'"]
+
+
+def test_shared_sections_are_validated_once(write, monkeypatch):
+    calls = []
+    original = validator.MappingValidator.validate
+
+    def validate(self, data, path, errors, memo=None):
+        calls.append(path)
+        return original(self, data, path, errors, memo)
+
+    monkeypatch.setattr(validator.MappingValidator, "validate", validate)
+    list(cluster.iter_definitions(write(CLUSTER)))
+    assert calls.count("image") == 1
+    assert calls.count("vm") == 2
+
+
+def test_check_definitions_reports_all_the_nodes(write):
+    path = write(CLUSTER.replace("ram: 2048", "ram: -1") + "  - {}\n")
+    errors = cluster.check_definitions(path)
+    assert errors[0].startswith("document 0, nodes[1]: Key 'vm.ram' error:")
+    assert "document 0, nodes[2]: Missing key: 'general.name'" in errors
+
+
+def test_invalid_cluster_structure(write):
+    errors = cluster.check_definitions(write("nodes: {}\nextra: 1\n"))
+    assert errors == [
+        "document 0: Wrong key 'extra'",
+        "document 0: Key 'nodes' error:\nshould be a list of mappings",
+    ]
+
+
+def test_plain_definitions_are_cached(get_fixture, tmp_path):
+    cache = validator.DefinitionCache(tmp_path / "cache")
+    path = get_fixture("minimum.yml")
+    assert list(cluster.iter_definitions(path, cache)) == [load_yaml(path)]
+    assert cache.get(path) == load_yaml(path)
+
+
+def test_example_cluster_matches_the_node_files(monkeypatch):
+    monkeypatch.setenv("PWD", "/tmp")
+    definitions = list(
+        cluster.iter_definitions("examples/cluster3-ansible/cluster.yml")
+    )
+    for index, data in enumerate(definitions, 1):
+        assert data == load_yaml(f"examples/cluster3-ansible/node{index}.yml")
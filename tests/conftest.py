@@ -1,6 +1,7 @@
 import os
 import pathlib
 import shutil
+import threading
 
 import pytest
 
@@ -20,6 +21,27 @@ def get_fixture():
     return _getter
 
 
+class LifecycleBackend(object):
+    """ Record the lifecycle actions """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.actions = []
+
+    def __getattr__(self, action):
+        def perform(data, **kwargs):
+            with self.lock:
+                self.actions.append((data["general"]["name"], action, kwargs))
+
+        return perform
+
+
+@pytest.fixture
+def lifecycle_backend():
+    """ A backend that records the lifecycle actions instead of performing them """
+    return LifecycleBackend()
+
+
 @pytest.fixture
 def load_fixture(get_fixture):
     """ Load a fixture """
@@ -38,13 +60,22 @@ def pytest_addoption(parser):
     parser.addoption(
         "--runslow", action="store_true", default=False, help="run slow tests"
     )
+    parser.addoption(
+        "--runbench", action="store_true", default=False, help="run benchmarks"
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: mark test as slow to run")
+    config.addinivalue_line("markers", "bench: mark test as a benchmark")
 
 
 def pytest_collection_modifyitems(config, items):
-    if config.getoption("--runslow"):
-        # --runslow given in cli: do not skip slow tests
-        return
     skip_slow = pytest.mark.skip(reason="need --runslow option to run")
+    skip_bench = pytest.mark.skip(reason="need --runbench option to run")
     for item in items:
-        if "slow" in item.keywords:
+        # --runslow/--runbench given in cli: do not skip slow tests/benchmarks
+        if "slow" in item.keywords and not config.getoption("--runslow"):
             item.add_marker(skip_slow)
+        if "bench" in item.keywords and not config.getoption("--runbench"):
+            item.add_marker(skip_bench)
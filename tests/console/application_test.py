@@ -0,0 +1,85 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import virtbuilder
+
+# The startup budgets of the commands that are executed in tight loops (seconds)
+VERSION_BUDGET = 0.1
+VALIDATE_BUDGET = 0.5
+
+RUN_MAIN = """
+import json, sys
+sys.argv = ["virtbuilder"] + sys.argv[1:]
+from virtbuilder.console.application import main
+try:
+    main()
+except SystemExit:
+    pass
+print(json.dumps(sorted(sys.modules)), file=sys.stderr)
+"""
+
+
+def run_main(*args, env=None):
+    """ Execute ``main()`` in a new interpreter and return its output and modules """
+    proc = subprocess.run(
+        [sys.executable, "-c", RUN_MAIN, *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        env=env,
+        check=True,
+    )
+    modules = json.loads(proc.stderr.splitlines()[-1])
+    return proc.stdout, modules
+
+
+def test_version_fast_path():
+    stdout, modules = run_main("--version")
+    assert stdout == f"Virtbuilder version {virtbuilder.__version__}\n"
+    assert "cleo" not in modules
+    assert "virtbuilder.console.commands" not in modules
+
+
+def test_commands_are_imported_lazily():
+    code = "import sys, virtbuilder.console.commands; print(' '.join(sys.modules))"
+    output = subprocess.check_output(
+        [sys.executable, "-c", code], universal_newlines=True
+    )
+    modules = output.split()
+    for module in ("ruamel.yaml", "schema", "virtbuilder.api", "virtbuilder.backends"):
+        assert module not in modules
+
+
+def test_cached_validate_skips_the_parser(get_fixture, tmp_path):
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path))
+    definition = str(get_fixture("valid.yml"))
+    run_main("validate", definition, env=env)
+    stdout, modules = run_main("validate", definition, env=env)
+    assert "OK!" in stdout
+    assert "ruamel.yaml" not in modules
+
+
+def measure(*args, env=None, repeat=5):
+    """ Return the best wall time of executing ``virtbuilder *args`` """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run_main(*args, env=env)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+@pytest.mark.slow
+def test_version_startup_budget():
+    assert measure("--version") < VERSION_BUDGET
+
+
+@pytest.mark.slow
+def test_validate_startup_budget(get_fixture, tmp_path):
+    env = dict(os.environ, XDG_CACHE_HOME=str(tmp_path))
+    assert measure("validate", str(get_fixture("valid.yml")), env=env) < VALIDATE_BUDGET
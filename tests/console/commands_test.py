@@ -18,3 +18,44 @@ from cleo.testers import CommandTester
 #     assert image.stat().st_size > 20000  # The image should be ~30MB
 #     # cleanup
 #     image.unlink()
+
+
+CLUSTER = pathlib.Path(__file__).parents[2] / "examples" / "cluster3-ansible"
+
+
+def test_remove_handles_cluster_files(tmp_path, monkeypatch):
+    from virtbuilder.console.commands import RemoveCommand
+
+    monkeypatch.chdir(tmp_path)
+    tester = CommandTester(RemoveCommand())
+    tester.execute(f"--preview {CLUSTER / 'cluster.yml'}")
+    output = tester.io.fetch_output()
+    for name in ("node1", "node2", "node3"):
+        assert f"undefine --remove-all-storage test-{name}\n" in output
+
+
+class ClosingBackend(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_create_cleans_up_when_a_stage_fails(tmp_path, monkeypatch, get_fixture):
+    from virtbuilder import backends
+    from virtbuilder import tracing
+    from virtbuilder.console.commands import CreateCommand
+
+    def create_node(*args):
+        raise RuntimeError("boom")
+
+    backend = ClosingBackend()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(backends, "get_backend", lambda *args, **kwargs: backend)
+    monkeypatch.setattr(CreateCommand, "create_node", create_node)
+    tester = CommandTester(CreateCommand())
+    with pytest.raises(RuntimeError):
+        tester.execute(f"--trace trace.json {get_fixture('minimum.yml')}")
+    assert backend.closed
+    assert tracing.get_tracer() is None
+    assert (tmp_path / "trace.json").exists()
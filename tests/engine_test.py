@@ -0,0 +1,161 @@
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pytest
+
+from virtbuilder import engine
+from virtbuilder import scheduler
+from virtbuilder import tracing
+
+
+def get_data(node):
+    return {"general": {"name": node}}
+
+
+def get_plan(eng, cmds):
+    """ Return a plan with a single stage per ``{node: cmd}`` """
+    plan = scheduler.Plan()
+    for node, cmd in cmds.items():
+        action = lambda node=node, cmd=cmd: eng.run_stage(
+            get_data(node), "image", [cmd]
+        )
+        plan.add(scheduler.Task(node, "image", action))
+    return plan
+
+
+def test_output_is_prefixed():
+    lines = []
+    eng = engine.Engine(output=lines.append)
+    plan = get_plan(eng, {"n1": "sh -c 'echo 1; echo 2 >&2'", "n2": "sh -c 'printf 3'"})
+    assert eng.run(plan) == []
+    assert sorted(lines) == ["[n1/image] 1", "[n1/image] 2", "[n2/image] 3"]
+
+
+def test_long_lines_are_split():
+    lines = []
+    eng = engine.Engine(output=lines.append, max_line=10)
+    eng.run(get_plan(eng, {"n1": "sh -c 'printf 0123456789abcde'"}))
+    assert lines == ["[n1/image] 0123456789", "[n1/image] abcde"]
+
+
+def test_failures_include_the_tail_of_the_output():
+    eng = engine.Engine(output=lambda line: None)
+    plan = get_plan(eng, {"n1": "sh -c 'echo boom; exit 3'"})
+    (task,) = eng.run(plan)
+    assert isinstance(task.error, subprocess.CalledProcessError)
+    assert task.error.returncode == 3
+    assert task.error.stderr == "boom"
+
+
+def test_dependents_of_failed_tasks_are_skipped():
+    eng = engine.Engine(output=lambda line: None)
+    plan = scheduler.Plan()
+    plan.add(scheduler.Task("n1", "image", lambda: eng.run_cmd("false", "n1/image")))
+    plan.add(
+        scheduler.Task(
+            "n1", "vm", lambda: eng.run_cmd("true", "n1/vm"), [("n1", "image")]
+        )
+    )
+    assert eng.run(plan) == [plan.tasks[("n1", "image")]]
+    assert plan.skipped == [plan.tasks[("n1", "vm")]]
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def wait_until_dead(pid):
+    for _ in range(50):
+        if not is_alive(pid):
+            break
+        time.sleep(0.1)
+    return not is_alive(pid)
+
+
+def test_fail_fast_kills_the_process_groups(tmp_path):
+    pidfile = tmp_path / "pid"
+    eng = engine.Engine(output=lambda line: None, fail_fast=True)
+    plan = get_plan(
+        eng,
+        {
+            # The background sleep belongs to the process group of the command
+            "n1": f"sh -c 'sleep 30 & echo $! > {pidfile}; wait'",
+            "n2": "sh -c 'sleep 0.5; exit 1'",
+        },
+    )
+    start = time.perf_counter()
+    failed = eng.run(plan)
+    assert time.perf_counter() - start < 10
+    assert {task.node for task in failed} == {"n1", "n2"}
+    assert wait_until_dead(int(pidfile.read_text()))
+
+
+def test_interrupts_kill_the_process_groups(tmp_path):
+    pidfile = tmp_path / "pid"
+    eng = engine.Engine(output=lambda line: None)
+
+    async def interrupt():
+        while not pidfile.exists():
+            await asyncio.sleep(0.05)
+        os.kill(os.getpid(), signal.SIGINT)
+        await asyncio.sleep(30)
+
+    plan = get_plan(eng, {"n1": f"sh -c 'sleep 30 & echo $! > {pidfile}; wait'"})
+    plan.add(scheduler.Task("n2", "image", interrupt))
+    with pytest.raises(KeyboardInterrupt):
+        eng.run(plan)
+    assert wait_until_dead(int(pidfile.read_text()))
+
+
+def test_stages_record_the_resource_usage_of_their_commands():
+    tracer = tracing.enable()
+    try:
+        eng = engine.Engine(output=lambda line: None)
+        burn = f"{sys.executable} -c 'sum(range(3000000))'"
+        eng.run(get_plan(eng, {"n1": burn, "n2": burn, "n3": "true"}))
+    finally:
+        tracing.disable()
+    spans = {span.name: span for span in tracer.spans}
+    for name in ("n1/image", "n2/image"):
+        assert spans[name].cpu > 0
+        assert spans[name].maxrss > 0
+    assert spans["n3/image"].cpu < spans["n1/image"].cpu
+
+
+def test_engine_skips_the_tasks_that_never_start():
+    class EmptyBudget(object):
+        def admit(self, task, running):
+            return False
+
+    eng = engine.Engine(output=lambda line: None, budget=EmptyBudget())
+    plan = get_plan(eng, {"n1": "true"})
+    assert eng.run(plan) == []
+    assert plan.skipped == [plan.tasks[("n1", "image")]]
+
+
+def test_get_create_plan_with_the_engine(get_fixture, monkeypatch):
+    executed = []
+
+    async def run_cmd(cmd, prefix, span=None):
+        executed.append(prefix)
+
+    def run_stage(data, stage, cmds):
+        executed.append(f"{data['general']['name']}/{stage}")
+
+    eng = engine.Engine()
+    monkeypatch.setattr(eng, "run_cmd", run_cmd)
+    # The uploads run in a thread of the backend, with progress
+    monkeypatch.setattr(eng.backend, "run_stage", run_stage)
+    plan = scheduler.get_create_plan([get_fixture("valid.yml")], run=eng.run_stage)
+    assert eng.run(plan) == []
+    assert executed[0] == "kmaster/image"
+    assert "kmaster/upload" in executed
+    assert len(executed) == 5
@@ -0,0 +1,111 @@
+import os
+import shutil
+import subprocess
+import time
+
+import pytest
+import ruamel.yaml
+
+from virtbuilder import cache
+from virtbuilder import export
+from virtbuilder.utils import split_cmd
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The stamps are stored in the state dir of the current working directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def test_quote_cmd_preserves_the_arguments():
+    cmd = """virt-builder --append-line "/etc/hosts:1.2.3.4 a b" --run-command 'echo $HOME'"""
+    assert split_cmd(export.quote_cmd(cmd)) == split_cmd(cmd)
+
+
+def test_get_targets(get_fixture, workdir):
+    targets = export.get_targets([get_fixture("valid.yml")])
+    assert [target.stage for target in targets] == [
+        "image",
+        "volume",
+        "upload",
+        "cleanup",
+        "vm",
+    ]
+    upload = targets[2]
+    assert upload.output == ".virtbuilder/stamps/kmaster/upload.stamp"
+    assert upload.deps == [
+        ".virtbuilder/stamps/kmaster/image.stamp",
+        ".virtbuilder/stamps/kmaster/volume.stamp",
+    ]
+    assert upload.inputs == [".virtbuilder/stamps/kmaster/upload.fingerprint"]
+    assert os.path.exists(upload.inputs[0])
+
+
+def test_exported_layers_are_registered(get_fixture, load_fixture, workdir):
+    layers = cache.LayerCache(workdir / "layers")
+    export.get_targets([get_fixture("valid.yml")], cache=layers)
+    # So that they are listed and evicted like the layers that create builds
+    keys = [key for key, _ in cache.get_layer_keys(load_fixture("valid.yml"))]
+    assert sorted(meta["key"] for meta in layers.entries()) == sorted(keys)
+
+
+def test_unchanged_fingerprints_are_not_rewritten(workdir):
+    path = export.write_fingerprint("node", "image", "abc")
+    os.utime(path, (0, 0))
+    export.write_fingerprint("node", "image", "abc")
+    assert os.stat(path).st_mtime == 0
+    export.write_fingerprint("node", "image", "def")
+    assert os.stat(path).st_mtime > 0
+
+
+def test_ninja_escaping():
+    target = export.Target("node", "image", ["echo '$a'"], [], ["my dir/a:b"])
+    ninja = export.to_ninja([target], limits={"image": 1})
+    assert "stage my$ dir/a$:b\n" in ninja
+    assert "  cmd = echo '$$a'\n" in ninja
+    assert "  pool = image\n" in ninja
+
+
+def get_echo_targets(log):
+    """ Two stages of a node that log their execution """
+    image = export.Target(
+        "node",
+        "image",
+        [f"echo image >> {log}"],
+        [],
+        [export.write_fingerprint("node", "image", "1")],
+    )
+    vm = export.Target(
+        "node",
+        "vm",
+        [f"echo vm >> {log}"],
+        [image.output],
+        [export.write_fingerprint("node", "vm", "1")],
+    )
+    return [image, vm]
+
+
+@pytest.mark.skipif(shutil.which("make") is None, reason="make is not installed")
+def test_make_only_rebuilds_stale_targets(workdir):
+    log = workdir / "log"
+    (workdir / "Makefile").write_text(export.to_makefile(get_echo_targets(log)))
+    subprocess.run(["make", "-s"], check=True)
+    subprocess.run(["make", "-s"], check=True)
+    assert log.read_text().split() == ["image", "vm"]
+    path = export.write_fingerprint("node", "vm", "2")
+    # Make compares modification times, which may have a coarse resolution
+    future = time.time() + 10
+    os.utime(path, (future, future))
+    subprocess.run(["make", "-s"], check=True)
+    assert log.read_text().split() == ["image", "vm", "vm"]
+
+
+def test_newlines_cannot_be_exported(load_fixture, tmp_path, workdir):
+    data = load_fixture("minimum.yml")
+    data["image"]["config"] = {"provision": [{"write": "/etc/motd:a\nb"}]}
+    definition = tmp_path / "definition.yml"
+    ruamel.yaml.YAML(typ="safe").dump(data, definition)
+    with pytest.raises(ValueError) as exc:
+        export.get_targets([definition])
+    assert "newlines" in str(exc.value)
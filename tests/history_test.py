@@ -0,0 +1,90 @@
+import pytest
+
+from virtbuilder import history
+from virtbuilder import scheduler
+
+GB = 1024 ** 3
+
+
+def get_features(template="ubuntu-18.04", size=10 * GB, packages=0):
+    return {
+        "template": template,
+        "size": size,
+        "packages": packages,
+        "provision": 1 if packages else 0,
+        "format": "qcow2",
+        "uri": "qemu:///system",
+    }
+
+
+@pytest.fixture
+def db(tmp_path):
+    return history.History(tmp_path / "history.sqlite3")
+
+
+def test_get_features(load_fixture):
+    data = load_fixture("minimum.yml")
+    data["image"]["config"] = {
+        "provision": [{"install": ["vim", "git"]}, {"run-command": "true"}]
+    }
+    assert history.get_features(data, "image") == {
+        "template": "ubuntu-18.04",
+        "size": 12 * GB,
+        "packages": 2,
+        "provision": 2,
+        "format": "qcow2",
+        "uri": "qemu:///system",
+    }
+    assert history.get_features(data, "vm")["packages"] == 0
+
+
+def test_estimate(db):
+    assert db.estimate("vm", get_features()) is None
+    db.record("n1", "vm", get_features(packages=3), 10)
+    db.record("n2", "vm", get_features(packages=3), 20)
+    db.record("n3", "vm", get_features(packages=3), 90)
+    db.record("n4", "vm", get_features(packages=3), 1000, status=scheduler.FAILED)
+    assert db.estimate("vm", get_features(packages=3)) == 20
+    # The closest match is the same template
+    db.record("n5", "vm", get_features(), 30)
+    assert db.estimate("vm", get_features(packages=5)) == 25
+    assert db.estimate("vm", get_features(template="debian-10")) == 25
+
+
+def test_estimates_of_sized_stages_scale_with_the_size(db):
+    db.record("n1", "upload", get_features(size=10 * GB), 100)
+    assert db.estimate("upload", get_features(size=20 * GB)) == 200
+
+
+def test_predict(db):
+    plan = scheduler.Plan()
+    for node in ("n1", "n2"):
+        deps = []
+        for stage in ("image", "vm"):
+            meta = {"features": get_features()}
+            plan.add(scheduler.Task(node, stage, None, deps, meta=meta))
+            deps = [(node, stage)]
+    plan.add(scheduler.Task("n3", "cleanup", None))
+    assert history.predict(plan, db) is None
+    db.record("n0", "image", get_features(), 60)
+    db.record("n0", "vm", get_features(), 30)
+    prediction = history.predict(plan, db, jobs=4)
+    assert prediction.duration == 90
+    assert prediction.critical_path == [("n1", "image"), ("n1", "vm")]
+    assert prediction.unknown == [("n3", "cleanup")]
+    # A single image stage at a time
+    prediction = history.predict(plan, db, jobs=4, limits={"image": 1})
+    assert prediction.duration == 120
+    assert prediction.format()[0] == "Predicted duration: 0:02:00"
+
+
+def test_the_scheduler_records_the_durations(db):
+    plan = scheduler.Plan()
+    plan.add(
+        scheduler.Task("n1", "vm", lambda: None, meta={"features": get_features()})
+    )
+    plan.add(scheduler.Task("n2", "vm", lambda: None))
+    assert scheduler.Scheduler(history=db).run(plan) == []
+    with db.connect() as connection:
+        rows = connection.execute("SELECT node, stage, status FROM timings")
+        assert rows.fetchall() == [("n1", "vm", "done")]
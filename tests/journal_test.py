@@ -0,0 +1,168 @@
+import json
+import time
+
+import pytest
+
+from virtbuilder import api
+from virtbuilder import engine
+from virtbuilder import scheduler
+from virtbuilder.journal import Journal
+
+
+def flaky(failures):
+    """ Return an action that fails ``failures`` times before it succeeds """
+    calls = []
+
+    def action():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise RuntimeError(f"attempt {len(calls)}")
+
+    return action
+
+
+def get_statuses(journal):
+    lines = journal.path.read_text().splitlines()
+    return [(entry["stage"], entry["status"]) for entry in map(json.loads, lines)]
+
+
+def test_failed_stages_are_retried(tmp_path):
+    journal = Journal(tmp_path / "journal.jsonl")
+    plan = scheduler.Plan()
+    plan.add(scheduler.Task("n1", "upload", flaky(2)))
+    plan.add(scheduler.Task("n1", "vm", lambda: None, [("n1", "upload")]))
+    runner = scheduler.Scheduler(retries={"upload": 2}, backoff=0.01, journal=journal)
+    assert runner.run(plan) == []
+    assert plan.tasks[("n1", "upload")].attempts == 2
+    assert get_statuses(journal) == [
+        ("upload", "started"),
+        ("upload", "retrying"),
+        ("upload", "started"),
+        ("upload", "retrying"),
+        ("upload", "started"),
+        ("upload", "done"),
+        ("vm", "started"),
+        ("vm", "done"),
+    ]
+
+
+def test_retries_are_limited(tmp_path):
+    plan = scheduler.Plan()
+    plan.add(scheduler.Task("n1", "upload", flaky(3)))
+    plan.add(scheduler.Task("n1", "image", flaky(1)))
+    runner = scheduler.Scheduler(retries={"upload": 2}, backoff=0)
+    failed = runner.run(plan)
+    assert [(task.stage, str(task.error)) for task in failed] == [
+        ("upload", "attempt 3"),
+        ("image", "attempt 1"),
+    ]
+
+
+def test_engine_retries_failed_stages():
+    eng = engine.Engine(output=lambda line: None, retries={"upload": 1}, backoff=0.01)
+    plan = scheduler.Plan()
+    action = flaky(1)
+
+    async def run():
+        action()
+
+    plan.add(scheduler.Task("n1", "upload", run))
+    assert eng.run(plan) == []
+    assert plan.tasks[("n1", "upload")].attempts == 1
+
+
+def count_calls(monkeypatch, module, name):
+    """ Count the calls of ``module.name`` """
+    calls = []
+    function = getattr(module, name)
+
+    def wrapper(*args, **kwargs):
+        calls.append(1)
+        return function(*args, **kwargs)
+
+    monkeypatch.setattr(module, name, wrapper)
+    return calls
+
+
+def test_due_retries_wait_for_a_free_job(monkeypatch):
+    waits = count_calls(monkeypatch, scheduler, "wait")
+    plan = scheduler.Plan()
+    plan.add(scheduler.Task("n1", "upload", flaky(1)))
+    # Starts while the retry of n1 is being delayed
+    plan.add(scheduler.Task("n2", "upload", lambda: time.sleep(0.3)))
+    runner = scheduler.Scheduler(jobs=1, retries={"upload": 1}, backoff=0.01)
+    assert runner.run(plan) == []
+    # The loop sleeps until the running upload finishes, instead of spinning
+    assert len(waits) < 10
+
+
+def test_engine_due_retries_wait_for_a_free_job(monkeypatch):
+    waits = count_calls(monkeypatch, engine.asyncio, "wait")
+    eng = engine.Engine(
+        output=lambda line: None, jobs=1, retries={"upload": 1}, backoff=0.01
+    )
+    action = flaky(1)
+
+    async def run():
+        action()
+
+    plan = scheduler.Plan()
+    plan.add(scheduler.Task("n1", "upload", run))
+    plan.add(scheduler.Task("n2", "upload", lambda: engine.asyncio.sleep(0.3)))
+    assert eng.run(plan) == []
+    assert len(waits) < 10
+
+
+def test_the_last_entry_of_each_task_wins(tmp_path):
+    journal = Journal(tmp_path / "journal.jsonl")
+    task = scheduler.Task("n1", "image", None, meta={"fingerprint": "abc"})
+    journal.record(task, scheduler.STARTED)
+    journal.record(task, scheduler.DONE)
+    journal.record(scheduler.Task("n1", "upload", None), scheduler.FAILED)
+    # A run that got killed while writing
+    with journal.path.open("a") as fd:
+        fd.write('{"node": "n1", "sta')
+    assert journal.get_completed() == {("n1", "image"): "abc"}
+    journal.reset()
+    assert journal.load() == {}
+
+
+@pytest.mark.parametrize("changed", [False, True])
+def test_resume(tmp_path, load_fixture, changed):
+    data = load_fixture("minimum.yml")
+    path = tmp_path / "kmaster.yml"
+    path.write_text(json.dumps(data))
+    plan = scheduler.get_create_plan([path])
+    journal = Journal(tmp_path / "journal.jsonl")
+    for stage in ("image", "volume"):
+        task = plan.tasks[("kmaster", stage)]
+        assert task.meta["artefact"] == api.get_artefact(data, stage)
+        journal.record(task, scheduler.DONE)
+    if changed:
+        data["image"]["size"] = "20G"
+        path.write_text(json.dumps(data))
+    plan = scheduler.get_create_plan([path], completed=journal.get_completed())
+    if changed:
+        # The size is an input of both stages
+        assert list(plan.tasks) == [("kmaster", stage) for stage in api.CREATE_STAGES]
+    else:
+        assert list(plan.tasks) == [
+            ("kmaster", "upload"),
+            ("kmaster", "cleanup"),
+            ("kmaster", "vm"),
+        ]
+        assert plan.tasks[("kmaster", "upload")].deps == []
+
+
+def test_resume_waits_for_the_vms_again(tmp_path, load_fixture):
+    data = load_fixture("minimum.yml")
+    data["vm"]["wait"] = {"method": "agent"}
+    path = tmp_path / "kmaster.yml"
+    path.write_text(json.dumps(data))
+    journal = Journal(tmp_path / "journal.jsonl")
+    for task in scheduler.get_create_plan([path]).tasks.values():
+        journal.record(task, scheduler.DONE)
+    plan = scheduler.get_create_plan([path], completed=journal.get_completed())
+    # The inventory needs the addresses of all the VMs
+    assert list(plan.tasks) == [("kmaster", "wait")]
+    assert plan.tasks[("kmaster", "wait")].deps == []
@@ -0,0 +1,109 @@
+import hashlib
+
+import pytest
+
+from virtbuilder import mirror
+
+INDEX = """\
+-----BEGIN PGP SIGNED MESSAGE-----
+Hash: SHA512
+
+[ubuntu-18.04]
+name=Ubuntu 18.04
+arch=x86_64
+file=ubuntu-18.04.xz
+checksum[sha512]={checksum}
+notes=Ubuntu 18.04
+ with a continuation line
+
+[ubuntu-18.04]
+arch=aarch64
+file=ubuntu-18.04-aarch64.xz
+-----BEGIN PGP SIGNATURE-----
+
+abcdef
+-----END PGP SIGNATURE-----
+"""
+
+
+@pytest.fixture
+def upstream(tmp_path):
+    repo = tmp_path / "upstream"
+    repo.mkdir()
+    contents = b"template" * 1000
+    (repo / "ubuntu-18.04.xz").write_bytes(contents)
+    checksum = hashlib.sha512(contents).hexdigest()
+    (repo / "index.asc").write_text(INDEX.format(checksum=checksum))
+    return repo
+
+
+def test_parse_index(upstream):
+    entries = mirror.parse_index((upstream / "index.asc").read_text())
+    assert [(e["os-version"], e["arch"]) for e in entries] == [
+        ("ubuntu-18.04", "x86_64"),
+        ("ubuntu-18.04", "aarch64"),
+    ]
+    assert entries[0]["notes"] == "Ubuntu 18.04\n with a continuation line"
+    assert mirror.parse_index(mirror.format_index(entries)) == entries
+
+
+def test_get_templates(load_fixture):
+    data = load_fixture("minimum.yml")
+    data["image"]["arch"] = "amd64"
+    other = load_fixture("minimum.yml")
+    other["image"]["arch"] = "x86_64"
+    assert mirror.get_templates([data, other]) == [("ubuntu-18.04", "x86_64")]
+
+
+def test_warm(upstream, tmp_path):
+    template_mirror = mirror.TemplateMirror(
+        tmp_path / "mirror", index_url=(upstream / "index.asc").as_uri()
+    )
+    templates = [("ubuntu-18.04", "x86_64")]
+    assert template_mirror.warm(templates) == [(templates[0], True)]
+    assert template_mirror.warm(templates) == [(templates[0], False)]
+    # The signed index is kept as is, so that virt-builder can verify it
+    index = (upstream / "index.asc").read_text()
+    assert template_mirror.index_path.read_text() == index
+    path = tmp_path / "mirror" / "ubuntu-18.04.xz"
+    assert path.read_bytes() == (upstream / "ubuntu-18.04.xz").read_bytes()
+    assert template_mirror.uri.startswith("file:///")
+    assert template_mirror.uri.endswith("/index.asc")
+
+
+def test_warm_downloads_the_template_signatures(upstream, tmp_path):
+    index = (upstream / "index.asc").read_text()
+    index = index.replace("file=ubuntu-18.04.xz\n", "file=ubuntu-18.04.xz\nsig=x.sig\n")
+    (upstream / "index.asc").write_text(index)
+    (upstream / "x.sig").write_text("signature")
+    template_mirror = mirror.TemplateMirror(
+        tmp_path / "mirror", index_url=(upstream / "index.asc").as_uri()
+    )
+    template_mirror.warm([("ubuntu-18.04", "x86_64")])
+    assert (tmp_path / "mirror" / "x.sig").read_text() == "signature"
+
+
+def test_files_outside_the_mirror_are_rejected(tmp_path):
+    template_mirror = mirror.TemplateMirror(tmp_path / "mirror")
+    with pytest.raises(ValueError):
+        template_mirror.template_path({"file": "../../etc/passwd"})
+
+
+def test_warm_rejects_bad_checksums(upstream, tmp_path):
+    (upstream / "ubuntu-18.04.xz").write_bytes(b"tampered")
+    template_mirror = mirror.TemplateMirror(
+        tmp_path / "mirror", index_url=(upstream / "index.asc").as_uri()
+    )
+    with pytest.raises(ValueError) as exc:
+        template_mirror.warm([("ubuntu-18.04", "x86_64")])
+    assert "Checksum mismatch" in str(exc.value)
+    assert list((tmp_path / "mirror").iterdir()) == []
+
+
+def test_warm_rejects_unknown_templates(upstream, tmp_path):
+    template_mirror = mirror.TemplateMirror(
+        tmp_path / "mirror", index_url=(upstream / "index.asc").as_uri()
+    )
+    with pytest.raises(ValueError) as exc:
+        template_mirror.warm([("debian-10", "x86_64")])
+    assert "no template debian-10" in str(exc.value)
@@ -0,0 +1,198 @@
+import json
+
+import pytest
+
+from virtbuilder import placement
+from virtbuilder import scheduler
+
+GB = 1024 ** 3
+
+
+class PoolBackend(object):
+    """ Hosts with 8 CPUs, the given free memory and 100G of free space """
+
+    def __init__(self, vcpus=None, **free_memory):
+        self.free_memory = {
+            f"qemu+ssh://{host}/system": m for host, m in free_memory.items()
+        }
+        self.free_memory["qemu:///system"] = self.free_memory.pop(
+            "qemu+ssh://local/system", 0
+        )
+        # host -> the vCPUs of its running domains
+        self.vcpus = vcpus or {}
+
+    def get_host_info(self, uri, pool):
+        if uri not in self.free_memory:
+            raise ConnectionError(uri)
+        return {
+            "cpus": 8,
+            "vcpus": self.vcpus.get(uri.split("/")[2], 0),
+            "free_memory": self.free_memory[uri],
+            "free_disk": 100 * GB,
+        }
+
+
+def get_hosts(*hosts, **weights):
+    uris = {"local": "qemu:///system"}
+    return [
+        {
+            "uri": uris.get(host, f"qemu+ssh://{host}/system"),
+            "weight": weights.get(host, 1),
+        }
+        for host in hosts
+    ]
+
+
+@pytest.fixture
+def get_data(load_fixture):
+    def _get_data(name, **general):
+        data = load_fixture("minimum.yml")
+        data["general"].update(name=name, **general)
+        return data
+
+    return _get_data
+
+
+def get_placer(tmp_path, hosts, backend):
+    return placement.Placer(
+        hosts=hosts, backend=backend, path=tmp_path / "placement.json"
+    )
+
+
+def test_get_demand(get_data):
+    data = get_data("n1")
+    assert placement.get_demand(data) == {
+        "cpus": 4,
+        "memory": 2000 * 1024 ** 2,
+        "disk": 12 * GB,
+    }
+    data["replicas"] = {"count": 3}
+    assert placement.get_demand(data)["cpus"] == 12
+
+
+def test_is_local_uri():
+    assert placement.is_local_uri("qemu:///system")
+    assert placement.is_local_uri("test:///default")
+    assert not placement.is_local_uri("qemu+ssh://h1/system")
+
+
+def test_place_on_the_host_with_the_most_free_memory(tmp_path, get_data):
+    backend = PoolBackend(h1=16 * GB, h2=32 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    assert placer.place(get_data("n1"))["general"]["uri"] == "qemu+ssh://h2/system"
+
+
+def test_the_weight_favours_a_host(tmp_path, get_data):
+    backend = PoolBackend(h1=16 * GB, h2=32 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1", "h2", h1=3), backend)
+    assert placer.place(get_data("n1"))["general"]["uri"] == "qemu+ssh://h1/system"
+
+
+def test_the_placed_definitions_are_spread(tmp_path, get_data):
+    backend = PoolBackend(h1=16 * GB, h2=16 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    uris = [placer.place(get_data(name))["general"]["uri"] for name in ("n1", "n2")]
+    assert uris == ["qemu+ssh://h1/system", "qemu+ssh://h2/system"]
+
+
+def test_the_running_domains_load_a_host(tmp_path, get_data):
+    backend = PoolBackend(h1=16 * GB, h2=17 * GB, vcpus={"h2": 16})
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    assert placer.place(get_data("n1"))["general"]["uri"] == "qemu+ssh://h1/system"
+
+
+def test_hosts_without_free_cpus_are_skipped(tmp_path, get_data):
+    backend = PoolBackend(h1=16 * GB, h2=64 * GB, vcpus={"h2": 30})
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    assert placer.place(get_data("n1"))["general"]["uri"] == "qemu+ssh://h1/system"
+
+
+def test_no_host_fits(tmp_path, get_data):
+    # h2 is unreachable
+    backend = PoolBackend(h1=3 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    placer.place(get_data("n1"))
+    with pytest.raises(ValueError) as exc:
+        placer.place(get_data("n2"))
+    assert str(exc.value) == (
+        "n2: no host of the pool has enough free memory, CPUs and free space in the "
+        "pool 'kvm'"
+    )
+
+
+def test_direct_builds_are_placed_on_local_hosts(tmp_path, get_data):
+    backend = PoolBackend(local=4 * GB, h1=32 * GB)
+    placer = get_placer(tmp_path, get_hosts("local", "h1"), backend)
+    data = get_data("n1", **{"build-mode": "direct"})
+    assert placer.place(data)["general"]["uri"] == "qemu:///system"
+
+
+def test_replicas_are_placed_on_local_hosts(tmp_path, get_data):
+    backend = PoolBackend(local=8 * GB, h1=32 * GB)
+    placer = get_placer(tmp_path, get_hosts("local", "h1"), backend)
+    data = get_data("n1")
+    data["replicas"] = {"count": 1}
+    assert placer.place(data)["general"]["uri"] == "qemu:///system"
+
+
+def test_placements_are_kept(tmp_path, get_data):
+    backend = PoolBackend(h1=16 * GB, h2=32 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    placer.place(get_data("n1"))
+    # n1 stays on its host, even if another one has more free memory now
+    backend = PoolBackend(h1=64 * GB, h2=32 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    assert placer.place(get_data("n1"))["general"]["uri"] == "qemu+ssh://h2/system"
+    placer = placement.Placer(path=tmp_path / "placement.json")
+    assert placer.locate(get_data("n1"))["general"]["uri"] == "qemu+ssh://h2/system"
+    # Without a pool, the definitions that haven't been placed keep their uri
+    assert placer.place(get_data("n2"))["general"]["uri"] == "qemu:///system"
+    placer.release(get_data("n1"))
+    assert placer.locate(get_data("n1"))["general"]["uri"] == "qemu:///system"
+    assert json.loads((tmp_path / "placement.json").read_text()) == {}
+
+
+def test_get_create_plan_places_the_definitions(tmp_path, get_data):
+    paths = []
+    for name in ("n1", "n2"):
+        path = tmp_path / f"{name}.yml"
+        path.write_text(json.dumps(get_data(name)))
+        paths.append(path)
+    backend = PoolBackend(h1=16 * GB, h2=16 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1", "h2"), backend)
+    plan = scheduler.get_create_plan(paths, stage="vm", placer=placer)
+    uris = [task.meta["features"]["uri"] for task in plan.tasks.values()]
+    assert uris == ["qemu+ssh://h1/system", "qemu+ssh://h2/system"]
+    assert sorted(placer.load()) == ["n1", "n2"]
+
+
+def test_definitions_that_fit_nowhere_fail(tmp_path, get_data):
+    paths = []
+    for name in ("n1", "n2"):
+        path = tmp_path / f"{name}.yml"
+        path.write_text(json.dumps(get_data(name)))
+        paths.append(path)
+    backend = PoolBackend(h1=3 * GB)
+    placer = get_placer(tmp_path, get_hosts("h1"), backend)
+    plan = scheduler.get_create_plan(
+        paths,
+        stage="vm",
+        placer=placer,
+        run=lambda data, stage, cmds, on_success: None,
+    )
+    assert list(plan.tasks) == [("n1", "vm"), ("n2", "place")]
+    assert scheduler.Scheduler().run(plan) == [plan.tasks[("n2", "place")]]
+
+
+def test_load_host_pool(tmp_path):
+    path = tmp_path / "hosts.yml"
+    path.write_text(
+        "hosts:\n"
+        "  - uri: qemu+ssh://h1/system\n"
+        "    weight: 2\n"
+        "  - uri: qemu:///system\n"
+    )
+    assert placement.load_host_pool(path) == [
+        {"uri": "qemu+ssh://h1/system", "weight": 2},
+        {"uri": "qemu:///system", "weight": 1},
+    ]
@@ -0,0 +1,171 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from virtbuilder import api
+from virtbuilder import engine
+from virtbuilder import readiness
+from virtbuilder import scheduler
+from virtbuilder import state
+
+DOMIFADDR = """\
+ Name       MAC address          Protocol     Address
+-------------------------------------------------------------------------------
+ lo         00:00:00:00:00:00    ipv4         127.0.0.1/8
+ vnet0      52:54:00:8a:2d:11    ipv4         192.168.122.45/24
+ -          -                    ipv6         fe80::5054:ff:fe8a:2d11/64
+"""
+
+
+def get_data(name, **wait):
+    return {"general": {"name": name}, "vm": {"wait": wait}}
+
+
+def test_parse_addresses():
+    assert readiness.parse_addresses(DOMIFADDR) == ["192.168.122.45"]
+    assert readiness.parse_addresses("") == []
+
+
+def test_wait_stage(load_fixture):
+    data = load_fixture("minimum.yml")
+    fingerprints = state.get_fingerprints(data)
+    data["vm"]["wait"] = {"method": "agent", "timeout": 60}
+    assert api.get_stages(data) == api.CREATE_STAGES + ["wait"]
+    # The wait settings only affect the wait stage
+    assert state.get_fingerprints(data)["vm"] == fingerprints["vm"]
+    assert "--wait" not in api.create_vm_cmd(data)
+    ((_, (cmd,)),) = api.get_create_stages(data, stage="wait")
+    assert cmd == (
+        "timeout 60 sh -c 'until virsh --connect qemu:///system qemu-agent-command"
+        ' kmaster \'"\'"\'{"execute": "guest-ping"}\'"\'"\' >/dev/null 2>&1;'
+        " do sleep 2; done'"
+    )
+
+
+def test_poller_waits_for_all_the_vms_at_once():
+    probes = []
+    lock = threading.Lock()
+
+    def probe(data):
+        name = data["general"]["name"]
+        with lock:
+            probes.append(name)
+            attempts = probes.count(name)
+        return "10.0.0.1" if name == "n1" and attempts == 3 else None
+
+    poller = readiness.ReadinessPoller(probe=probe, interval=0.01)
+    n1 = poller.wait(get_data("n1", timeout=10))
+    n2 = poller.wait(get_data("n2", timeout=0.1, method="lease"))
+    assert n1.result(timeout=5) == "10.0.0.1"
+    with pytest.raises(TimeoutError) as exc:
+        n2.result(timeout=5)
+    assert str(exc.value) == "n2 was not ready (lease) after 0.1 seconds"
+    assert poller.hosts == {"n1": {"ansible_host": "10.0.0.1"}}
+    # Both VMs were polled by the same thread
+    assert probes.count("n2") > 1
+
+
+def test_poller_probes_the_vms_concurrently():
+    lock = threading.Lock()
+    probing = []
+    peak = []
+
+    def probe(data):
+        with lock:
+            probing.append(data)
+            peak.append(len(probing))
+        time.sleep(0.05)
+        with lock:
+            probing.remove(data)
+        # The VMs are only ready once they have all been probed at the same time
+        return "10.0.0.1" if max(peak) == 3 else None
+
+    poller = readiness.ReadinessPoller(probe=probe, interval=0.01)
+    waits = [poller.wait(get_data(name)) for name in ("n1", "n2", "n3")]
+    assert [wait.result(timeout=5) for wait in waits] == ["10.0.0.1"] * 3
+
+
+def test_probe_errors_fail_the_wait():
+    def probe(data):
+        raise FileNotFoundError("virsh")
+
+    poller = readiness.ReadinessPoller(probe=probe, interval=0.01)
+    with pytest.raises(FileNotFoundError):
+        poller.wait(get_data("n1")).result(timeout=5)
+
+
+def test_has_ssh_banner():
+    server = socket.socket()
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    def accept():
+        connection, _ = server.accept()
+        connection.sendall(b"SSH-2.0-OpenSSH_8.2\r\n")
+        connection.close()
+
+    thread = threading.Thread(target=accept)
+    thread.start()
+    assert readiness.has_ssh_banner("127.0.0.1", port)
+    thread.join()
+    server.close()
+    assert not readiness.has_ssh_banner("127.0.0.1", port)
+
+
+def test_format_inventory():
+    hosts = {
+        "n2": {"ansible_host": "10.0.0.2", "ansible_port": 2222},
+        "n1": {"ansible_host": "10.0.0.1"},
+    }
+    assert readiness.format_inventory(hosts) == (
+        "[virtbuilder]\n"
+        "n1 ansible_host=10.0.0.1\n"
+        "n2 ansible_host=10.0.0.2 ansible_port=2222\n"
+    )
+    data = get_data("n1", port=2222)
+    assert readiness.get_host_vars(data, "10.0.0.1")["ansible_port"] == 2222
+
+
+class WaitBackend(object):
+    """ The VMs are ready once ``event`` is set """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.poller = readiness.ReadinessPoller(
+            probe=lambda data: "10.0.0.1" if self.event.is_set() else None,
+            interval=0.01,
+        )
+
+    def runs_commands(self, stage):
+        return stage != "wait"
+
+    def wait(self, data):
+        return self.poller.wait(data)
+
+
+def test_waiting_vms_do_not_take_up_jobs():
+    backend = WaitBackend()
+    lines = []
+    eng = engine.Engine(backend=backend, jobs=1, output=lines.append)
+    plan = scheduler.Plan()
+    for node in ("n1", "n2"):
+        data = get_data(node, timeout=10)
+        plan.add(
+            scheduler.Task(
+                node, "wait", lambda data=data: eng.run_stage(data, "wait", [])
+            )
+        )
+
+    async def build():
+        backend.event.set()
+
+    # Blocks forever if the waiting VMs take up the only job
+    plan.add(scheduler.Task("n3", "image", build))
+    assert eng.run(plan) == []
+    assert sorted(lines) == [
+        "[n1/wait] ready at 10.0.0.1",
+        "[n2/wait] ready at 10.0.0.1",
+    ]
@@ -0,0 +1,60 @@
+import pytest
+
+from virtbuilder import resources
+from virtbuilder.scheduler import Task
+
+GB = 1024 ** 3
+
+
+def image_task(node, memory=GB, cpus=1, disk=GB, path="/scratch"):
+    demand = resources.Demand(memory=memory, cpus=cpus, disk=disk, path=path)
+    return Task(node, "image", None, demand=demand)
+
+
+@pytest.fixture
+def budget():
+    return resources.HostBudget(
+        reserve_memory="1G",
+        cpus=4,
+        free_memory=lambda: 4 * GB,
+        free_disk=lambda path: (path, 3 * GB),
+    )
+
+
+def test_get_stage_demand(load_fixture):
+    data = load_fixture("minimum.yml")
+    data["image"]["memsize"] = 2048
+    demand = resources.get_stage_demand(data, "image")
+    assert (demand.memory, demand.cpus, demand.disk) == (2 * GB, 1, 12 * GB)
+    assert resources.get_stage_demand(data, "upload") is None
+
+
+def test_the_first_task_is_always_admitted(budget):
+    assert budget.admit(image_task("n1", memory=100 * GB), [])
+
+
+def test_tasks_without_demand_are_always_admitted(budget):
+    running = [image_task("n1", memory=3 * GB)]
+    assert budget.admit(Task("n2", "upload", None), running)
+
+
+@pytest.mark.parametrize(
+    "task, admitted",
+    [
+        (image_task("n2"), True),
+        # 4G free - 1G reserved - 1G running
+        (image_task("n2", memory=3 * GB), False),
+        (image_task("n2", cpus=4), False),
+        (image_task("n2", disk=3 * GB), False),
+        # A different filesystem
+        (image_task("n2", disk=3 * GB, path="/other"), True),
+    ],
+)
+def test_admission(budget, task, admitted):
+    assert budget.admit(task, [image_task("n1")]) is admitted
+
+
+def test_get_free_disk_of_missing_directory(tmp_path):
+    device, free = resources.get_free_disk(str(tmp_path / "missing" / "dir"))
+    assert device == resources.get_free_disk(str(tmp_path))[0]
+    assert free > 0
@@ -0,0 +1,191 @@
+import json
+import threading
+import time
+
+import pytest
+
+from virtbuilder import api
+from virtbuilder import scheduler
+
+
+class Recorder(object):
+    """ Record the order and the concurrency of the executed tasks """
+
+    def __init__(self, duration=0.01, fail=()):
+        self.duration = duration
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.order = []
+        self.running = {}
+        self.max_running = {}
+
+    def action(self, node, stage):
+        def _action():
+            with self.lock:
+                self.running[stage] = self.running.get(stage, 0) + 1
+                self.max_running[stage] = max(
+                    self.max_running.get(stage, 0), self.running[stage]
+                )
+            time.sleep(self.duration)
+            with self.lock:
+                self.running[stage] -= 1
+                self.order.append((node, stage))
+            if (node, stage) in self.fail:
+                raise RuntimeError(f"{node}/{stage}")
+
+        return _action
+
+
+def get_plan(recorder, nodes):
+    plan = scheduler.Plan()
+    for node in nodes:
+        for stage in api.CREATE_STAGES:
+            deps = [(node, dep) for dep in api.STAGE_DEPENDENCIES[stage]]
+            plan.add(scheduler.Task(node, stage, recorder.action(node, stage), deps))
+    return plan
+
+
+def test_plan_rejects_unknown_dependencies():
+    plan = scheduler.Plan()
+    with pytest.raises(ValueError) as exc:
+        plan.add(scheduler.Task("n1", "upload", None, [("n1", "image")]))
+    assert "Unknown dependencies" in str(exc.value)
+
+
+def test_plan_rejects_duplicate_tasks():
+    plan = scheduler.Plan()
+    plan.add(scheduler.Task("n1", "image", None))
+    with pytest.raises(ValueError):
+        plan.add(scheduler.Task("n1", "image", None))
+
+
+def test_dependencies_are_respected():
+    recorder = Recorder()
+    plan = get_plan(recorder, ["n1", "n2", "n3"])
+    failed = scheduler.Scheduler(jobs=4).run(plan)
+    assert failed == []
+    assert len(recorder.order) == 15
+    for node, stage in recorder.order:
+        position = recorder.order.index((node, stage))
+        for dep in api.STAGE_DEPENDENCIES[stage]:
+            assert recorder.order.index((node, dep)) < position
+
+
+def test_stage_limits_are_respected():
+    recorder = Recorder(duration=0.02)
+    plan = get_plan(recorder, ["n1", "n2", "n3", "n4"])
+    runner = scheduler.Scheduler(jobs=8, limits={"image": 1, "upload": 2})
+    assert runner.run(plan) == []
+    assert recorder.max_running["image"] == 1
+    assert recorder.max_running["upload"] <= 2
+    assert recorder.max_running["volume"] > 1
+
+
+def test_failure_skips_dependents_only():
+    recorder = Recorder(fail=[("n1", "upload")])
+    plan = get_plan(recorder, ["n1", "n2"])
+    failed = scheduler.Scheduler(jobs=2).run(plan)
+    assert [task.key for task in failed] == [("n1", "upload")]
+    assert {task.key for task in plan.skipped} == {("n1", "cleanup"), ("n1", "vm")}
+    assert all(
+        plan.tasks[("n2", stage)].status == scheduler.DONE
+        for stage in api.CREATE_STAGES
+    )
+
+
+@pytest.mark.parametrize("stage", [None] + api.CREATE_STAGES)
+def test_get_create_plan(get_fixture, stage):
+    plan = scheduler.get_create_plan([get_fixture("minimum.yml")], stage=stage)
+    stages = [stage] if stage else api.CREATE_STAGES
+    assert list(plan.tasks) == [("kmaster", s) for s in stages]
+    for task in plan.tasks.values():
+        assert all(dep in plan.tasks for dep in task.deps)
+
+
+def test_get_create_plan_with_replicas(tmp_path, load_fixture, monkeypatch):
+    monkeypatch.setattr(
+        api, "get_pool_target", lambda uri, pool: ("dir", "/var/lib/libvirt/images")
+    )
+    data = load_fixture("minimum.yml")
+    data["replicas"] = {"count": 2}
+    path = tmp_path / "replicas.yml"
+    path.write_text(json.dumps(data))
+    plan = scheduler.get_create_plan([path])
+    assert ("kmaster", "vm") not in plan.tasks
+    overlay = plan.tasks[("kmaster-2", "overlay")]
+    assert overlay.deps == [("kmaster", "upload")]
+    assert plan.tasks[("kmaster-2", "vm")].deps == [("kmaster-2", "customize")]
+
+
+def test_get_lifecycle_plan_with_replicas(tmp_path, load_fixture, lifecycle_backend):
+    data = load_fixture("minimum.yml")
+    data["replicas"] = {"count": 2}
+    path = tmp_path / "replicas.yml"
+    path.write_text(json.dumps(data))
+    backend = lifecycle_backend
+    removed = []
+    plan = scheduler.get_lifecycle_plan(
+        [path], "remove", backend=backend, on_success=removed.append
+    )
+    assert plan.tasks[("kmaster", "remove")].deps == [
+        ("kmaster-1", "remove"),
+        ("kmaster-2", "remove"),
+    ]
+    assert scheduler.Scheduler(jobs=4).run(plan) == []
+    assert backend.actions[-1] == ("kmaster", "remove", {"replicas": False})
+    assert len(removed) == 3
+    # The base has no VM to start
+    plan = scheduler.get_lifecycle_plan([path], "start", backend=backend)
+    assert list(plan.tasks) == [("kmaster-1", "start"), ("kmaster-2", "start")]
+
+
+def test_get_lifecycle_plan_rejects_unknown_actions(get_fixture):
+    with pytest.raises(ValueError):
+        scheduler.get_lifecycle_plan([get_fixture("minimum.yml")], "gibberish")
+
+
+class FullBudget(object):
+    """ Admit a single task with a demand at a time """
+
+    def admit(self, task, running):
+        return task.demand is None or not any(other.demand for other in running)
+
+
+def test_budget_queues_the_tasks_that_do_not_fit():
+    recorder = Recorder()
+    plan = scheduler.Plan()
+    for node in ("n1", "n2", "n3"):
+        plan.add(
+            scheduler.Task(node, "image", recorder.action(node, "image"), demand=1)
+        )
+    scheduler.Scheduler(jobs=3, budget=FullBudget()).run(plan)
+    assert recorder.max_running["image"] == 1
+    assert all(task.status == scheduler.DONE for task in plan.tasks.values())
+
+
+@pytest.mark.parametrize("jobs, limits", [(0, None), (4, {"image": 0})])
+def test_non_positive_limits_are_rejected(jobs, limits):
+    with pytest.raises(ValueError):
+        scheduler.Scheduler(jobs=jobs, limits=limits)
+
+
+class EmptyBudget(object):
+    """ Admit no task at all """
+
+    def admit(self, task, running):
+        return False
+
+
+def test_tasks_that_never_start_are_skipped():
+    recorder = Recorder()
+    plan = get_plan(recorder, ["n1"])
+    assert scheduler.Scheduler(budget=EmptyBudget()).run(plan) == []
+    assert recorder.order == []
+    assert plan.skipped == list(plan.tasks.values())
+
+
+def test_ready_tasks_are_sorted_by_priority():
+    plan = scheduler.Plan()
+    plan.add(scheduler.Task("n1", "image", None))
+    plan.add(scheduler.Task("n2", "cleanup", None, priority=-1))
+    assert [task.node for task in plan.ready()] == ["n2", "n1"]
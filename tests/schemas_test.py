@@ -52,11 +52,13 @@ class TestGeneralSchema(BaseSchemaTestCase):
         "os-name": "ubuntu",
         "os-version": "18.04",
         "verbose": True,
+        "build-mode": "upload",
+        "scratch-dir": "/dev/shm",
     }
 
     mandatory_keys = ["uri", "pool", "name", "format", "os-name", "os-version"]
 
-    optional_keys = ["domain", "os-variant", "verbose"]
+    optional_keys = ["domain", "os-variant", "verbose", "build-mode", "scratch-dir"]
 
     @pytest.mark.parametrize("key", mandatory_keys)
     def test_missing_mandatory_key_raises(self, key):
@@ -83,6 +85,13 @@ class TestGeneralSchema(BaseSchemaTestCase):
         assert f"Key 'format' error:" in str(exc.value)
         assert GIBBERISH in str(exc.value)
 
+    def test_unknown_build_mode_raises(self):
+        data = self.valid.copy()
+        data["build-mode"] = GIBBERISH
+        with pytest.raises(SchemaError) as exc:
+            self.schema.validate(data)
+        assert f"Key 'build-mode' error:" in str(exc.value)
+
     @pytest.mark.parametrize("key", mandatory_keys)
     def test_empty_string_raises(self, key):
         data = self.valid.copy()
@@ -301,6 +310,150 @@ class TestImageSchema(BaseSchemaTestCase):
         self._test_missing_optional_key_passes(key)
 
 
+class TestDiskPerformanceSchema(BaseSchemaTestCase):
+    schema = schemas.DiskPerformanceSchema
+    valid = {
+        "profile": "throughput",
+        "bus": "scsi",
+        "cache": "none",
+        "io": "io_uring",
+        "discard": "unmap",
+        "detect-zeroes": "unmap",
+        "iothreads": 2,
+        "queues": 4,
+    }
+    mandatory_keys = []
+    optional_keys = list(valid)
+
+    @pytest.mark.parametrize("key", optional_keys)
+    def test_missing_optional_key_passes(self, key):
+        self._test_missing_optional_key_passes(key)
+
+    @pytest.mark.parametrize(
+        "key, value", [("profile", "fast"), ("io", "aio"), ("queues", 0)]
+    )
+    def test_invalid_value_raises(self, key, value):
+        with pytest.raises(SchemaError):
+            self.schema.validate(dict(self.valid, **{key: value}))
+
+
+class TestPerformanceSchema(BaseSchemaTestCase):
+    schema = schemas.PerformanceSchema
+    valid = {
+        "cpu-model": "host-passthrough",
+        "pinning": "auto",
+        "numa-node": 0,
+        "hugepages": True,
+        "net-queues": "auto",
+    }
+    mandatory_keys = []
+    optional_keys = list(valid)
+
+    @pytest.mark.parametrize("key", optional_keys)
+    def test_missing_optional_key_passes(self, key):
+        self._test_missing_optional_key_passes(key)
+
+    @pytest.mark.parametrize("pinning", ["0-3,8", "5"])
+    def test_cpuset_pinning_passes(self, pinning):
+        self.schema.validate({"pinning": pinning})
+
+    @pytest.mark.parametrize(
+        "key, value",
+        [("pinning", "0-3,"), ("hugepages", "4K"), ("net-queues", 0)],
+    )
+    def test_invalid_value_raises(self, key, value):
+        with pytest.raises(SchemaError):
+            self.schema.validate(dict(self.valid, **{key: value}))
+
+
+class TestWaitSchema(BaseSchemaTestCase):
+    schema = schemas.WaitSchema
+    valid = {"method": "ssh", "timeout": 300, "port": 22}
+    mandatory_keys = []
+    optional_keys = list(valid)
+
+    @pytest.mark.parametrize("key", optional_keys)
+    def test_missing_optional_key_passes(self, key):
+        self._test_missing_optional_key_passes(key)
+
+    @pytest.mark.parametrize(
+        "key, value", [("method", "ping"), ("timeout", 0), ("port", 70000)]
+    )
+    def test_invalid_value_raises(self, key, value):
+        with pytest.raises(SchemaError):
+            self.schema.validate(dict(self.valid, **{key: value}))
+
+
+class TestHostPoolSchema(object):
+    schema = schemas.HostPoolSchema
+
+    def test_default_weight(self):
+        data = self.schema.validate({"hosts": [{"uri": "qemu+ssh://h1/system"}]})
+        assert data["hosts"] == [{"uri": "qemu+ssh://h1/system", "weight": 1}]
+
+    @pytest.mark.parametrize(
+        "hosts",
+        [[], [{"uri": GIBBERISH}], [{"uri": "qemu:///system", "weight": 0}]],
+    )
+    def test_invalid_hosts_raise(self, hosts):
+        with pytest.raises(SchemaError):
+            self.schema.validate({"hosts": hosts})
+
+
+class TestQcow2Schema(BaseSchemaTestCase):
+    schema = schemas.Qcow2Schema
+    valid = {"preallocation": "metadata", "cluster-size": "2M", "lazy-refcounts": True}
+    mandatory_keys = []
+    optional_keys = list(valid)
+
+    @pytest.mark.parametrize("key", optional_keys)
+    def test_missing_optional_key_passes(self, key):
+        self._test_missing_optional_key_passes(key)
+
+    @pytest.mark.parametrize("size", ["3K", "4M", "64k"])
+    def test_invalid_cluster_size_raises(self, size):
+        with pytest.raises(SchemaError):
+            self.schema.validate({"cluster-size": size})
+
+
+class TestReplicasSchema(BaseSchemaTestCase):
+    schema = schemas.ReplicasSchema
+    valid = {
+        "count": 3,
+        "name": "worker-{index:02d}",
+        "network": "bridge=br0,mac=52:54:00:00:00:{index:02x}",
+        "provision": [{"run-command": "ssh-keygen -A"}],
+    }
+    mandatory_keys = ["count"]
+    optional_keys = ["name", "network", "provision"]
+
+    @pytest.mark.parametrize("key", mandatory_keys)
+    def test_missing_mandatory_key_raises(self, key):
+        self._test_missing_mandatory_key_raises(key)
+
+    @pytest.mark.parametrize("key", optional_keys)
+    def test_missing_optional_key_passes(self, key):
+        self._test_missing_optional_key_passes(key)
+
+    @pytest.mark.parametrize(
+        "key, value",
+        [
+            ("count", 0),
+            ("name", "worker"),
+            ("name", "{idx}-{index}"),
+            ("name", "worker-{index:s}"),
+            ("name", "worker-{index!z}"),
+            ("network", "bridge=br0,mac=52:54:00:00:00:{idx:02x}"),
+            ("network", "bridge=br0,mac=52:54:00:00:00:{index:q}"),
+            ("network", "bridge=br0,mac=52:54:00:00:00:{0}"),
+        ],
+    )
+    def test_invalid_value_raises(self, key, value):
+        data = dict(self.valid, **{key: value})
+        with pytest.raises(SchemaError):
+            self.schema.validate(data)
+
+
 class TestFullSchema(BaseSchemaTestCase):
     schema = schemas.FullSchema
     valid = {
@@ -315,9 +468,10 @@ class TestFullSchema(BaseSchemaTestCase):
         },
         "image": {"size": "10GB"},
         "vm": {"ram": 2000, "vcpus": 4},
+        "replicas": {"count": 2},
     }
     mandatory_keys = ["general", "image", "vm"]
-    optional_keys = []
+    optional_keys = ["replicas"]
 
     @pytest.mark.parametrize("key", mandatory_keys)
     def test_missing_mandatory_key_raises(self, key):
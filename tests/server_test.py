@@ -0,0 +1,169 @@
+import http.client
+import json
+import socket
+import threading
+
+import pytest
+
+from virtbuilder import server
+from virtbuilder.state import StateStore
+from virtbuilder.tuning import CpuAllocator
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__("localhost")
+        self.path = str(path)
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+def request(path, method, url, body=None):
+    connection = UnixConnection(path)
+    connection.request(method, url, body=json.dumps(body) if body else None)
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read())
+    connection.close()
+    return result
+
+
+@pytest.fixture
+def unix_server(tmp_path):
+    queue = server.JobQueue()
+    socket_path = tmp_path / "serve.sock"
+    http_server = server.make_server(queue, socket_path=socket_path)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+    yield socket_path, queue
+    http_server.shutdown()
+    http_server.server_close()
+    assert not socket_path.exists()
+
+
+def test_jobs_are_queued_by_priority():
+    queue = server.JobQueue()
+    first = queue.submit("create", ["vm1.yml"])
+    urgent = queue.submit("remove", ["vm2.yml"], priority=-1)
+    cancelled = queue.submit("create", ["vm3.yml"], priority=-1)
+    assert queue.cancel(cancelled.id)
+    assert queue.get() is urgent
+    assert queue.get() is first
+    assert queue.get(timeout=0.01) is None
+    assert not queue.cancel(first.id)
+
+
+@pytest.mark.parametrize(
+    "command, definitions, options",
+    [
+        ("gibberish", ["vm1.yml"], None),
+        ("create", [], None),
+        ("create", "vm1.yml", None),
+        ("create", ["vm1.yml"], 5),
+        ("create", ["vm1.yml"], {"gibberish": True}),
+    ],
+)
+def test_invalid_jobs_are_rejected(command, definitions, options):
+    with pytest.raises(ValueError):
+        server.JobQueue().submit(command, definitions, options=options)
+
+
+def test_job_log_offsets_are_stable(monkeypatch):
+    monkeypatch.setattr(server, "MAX_LOG_LINES", 2)
+    job = server.Job(1, "create", ["vm1.yml"])
+    for line in "abc":
+        job.write(line)
+    assert job.get_log() == (["b", "c"], 3)
+    assert job.get_log(2) == (["c"], 3)
+    assert job.get_log(3) == ([], 3)
+
+
+def test_http_api(unix_server):
+    path, queue = unix_server
+    status, job = request(
+        path,
+        "POST",
+        "/jobs",
+        {"command": "create", "definitions": ["vm1.yml"], "options": {"force": True}},
+    )
+    assert (status, job["id"], job["status"]) == (201, 1, server.QUEUED)
+    status, body = request(path, "POST", "/jobs", {"command": "gibberish"})
+    assert status == 400
+    for job in (
+        {"command": "create", "definitions": "vm1.yml"},
+        {"command": "create", "definitions": ["vm1.yml"], "options": 5},
+    ):
+        assert request(path, "POST", "/jobs", job)[0] == 400
+    queue.jobs[1].write("[vm1/image] building")
+    assert request(path, "GET", "/jobs/1/log?offset=0") == (
+        200,
+        {"lines": ["[vm1/image] building"], "offset": 1},
+    )
+    assert request(path, "GET", "/jobs/1/log?offset=x")[0] == 400
+    assert request(path, "GET", "/")[1]["jobs"] == {server.QUEUED: 1}
+    assert [job["id"] for job in request(path, "GET", "/jobs")[1]] == [1]
+    status, job = request(path, "DELETE", "/jobs/1")
+    assert (status, job["status"]) == (200, server.CANCELLED)
+    assert request(path, "DELETE", "/jobs/1")[0] == 409
+    assert request(path, "GET", "/jobs/2")[0] == 404
+
+
+def test_the_socket_is_private(unix_server):
+    path, _ = unix_server
+    assert path.stat().st_mode & 0o777 == 0o600
+
+
+def test_tcp_servers_only_listen_on_loopback():
+    assert server.is_loopback("localhost")
+    assert server.is_loopback("127.0.0.1")
+    assert server.is_loopback("::1")
+    assert not server.is_loopback("0.0.0.0")
+    assert not server.is_loopback("example.com")
+    with pytest.raises(ValueError):
+        server.make_server(server.JobQueue(), host="0.0.0.0", port=0)
+
+
+def get_runner(tmp_path, backend):
+    return server.JobRunner(
+        backend,
+        definition_cache=server.MemoryDefinitionCache(tmp_path / "definitions"),
+        store=StateStore(tmp_path / "state"),
+        allocator=CpuAllocator(tmp_path / "cpus.json"),
+    )
+
+
+def test_job_runner(tmp_path, get_fixture, lifecycle_backend):
+    backend = lifecycle_backend
+    runner = get_runner(tmp_path, backend)
+    queue = server.JobQueue()
+    job = runner.run(queue.submit("start", [str(get_fixture("minimum.yml"))]))
+    assert job.status == server.DONE
+    assert dict(job.tasks) == {"kmaster/start": "done"}
+    assert backend.actions == [("kmaster", "start", {})]
+    job = runner.run(queue.submit("start", [str(tmp_path / "missing.yml")]))
+    assert job.status == server.FAILED
+    assert job.error.startswith("FileNotFoundError")
+
+
+def test_definitions_are_kept_in_memory(tmp_path, get_fixture):
+    cache = server.MemoryDefinitionCache(tmp_path)
+    path = get_fixture("minimum.yml")
+    data = cache.load(path)
+    assert cache.load(path) is data
+    # A new instance reads the entry from the disk
+    assert cache.load(path) is not server.MemoryDefinitionCache(tmp_path).load(path)
+
+
+def test_serve(unix_server, tmp_path, get_fixture, lifecycle_backend):
+    path, queue = unix_server
+    runner = get_runner(tmp_path, lifecycle_backend)
+    http_server = server.make_server(queue, socket_path=tmp_path / "other.sock")
+    thread = threading.Thread(target=server.serve, args=(http_server, queue, runner))
+    thread.start()
+    definitions = [str(get_fixture("minimum.yml"))]
+    request(path, "POST", "/jobs", {"command": "start", "definitions": definitions})
+    queue.close()
+    thread.join(10)
+    assert not thread.is_alive()
+    assert queue.jobs[1].status == server.DONE
@@ -0,0 +1,99 @@
+import copy
+
+import pytest
+
+from virtbuilder import api
+from virtbuilder import scheduler
+from virtbuilder import state
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # The image is created in the current working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(state, "volume_exists", lambda data: True)
+    monkeypatch.setattr(state, "domain_exists", lambda data: True)
+    return state.StateStore(path=tmp_path / "state")
+
+
+def record_all(store, data):
+    for stage, fingerprint in state.get_fingerprints(data).items():
+        store.record(data, stage, fingerprint)
+
+
+def test_fingerprints_are_stable(load_fixture):
+    data = load_fixture("valid.yml")
+    assert state.get_fingerprints(data) == state.get_fingerprints(copy.deepcopy(data))
+
+
+def test_everything_is_outdated_initially(load_fixture, store):
+    data = load_fixture("valid.yml")
+    assert store.get_outdated_stages(data) == api.CREATE_STAGES
+
+
+def test_nothing_is_outdated_after_a_successful_run(load_fixture, store):
+    data = load_fixture("valid.yml")
+    record_all(store, data)
+    assert store.get_outdated_stages(data) == []
+
+
+def test_vm_changes_only_affect_the_vm(load_fixture, store):
+    data = load_fixture("valid.yml")
+    record_all(store, data)
+    data["vm"]["ram"] = 4096
+    assert store.get_outdated_stages(data) == ["vm"]
+
+
+def test_provision_changes_affect_the_downstream_stages(load_fixture, store):
+    data = load_fixture("valid.yml")
+    record_all(store, data)
+    data["image"]["config"]["provision"].append({"touch": "/etc/foo"})
+    assert store.get_outdated_stages(data) == ["image", "upload", "cleanup", "vm"]
+
+
+def test_referenced_file_changes_affect_the_image(load_fixture, store, tmp_path):
+    script = tmp_path / "script.sh"
+    script.write_text("echo 1")
+    data = load_fixture("minimum.yml")
+    data["image"]["config"] = {"provision": [{"run": str(script)}]}
+    record_all(store, data)
+    script.write_text("echo 2")
+    assert store.get_outdated_stages(data)[0] == "image"
+
+
+def test_missing_image_is_rebuilt_when_the_upload_is_outdated(load_fixture, store):
+    data = load_fixture("valid.yml")
+    record_all(store, data)
+    data["image"]["size"] = "20G"
+    assert store.get_outdated_stages(data) == api.CREATE_STAGES
+
+
+def test_missing_domain_outdates_the_vm(load_fixture, store, monkeypatch):
+    data = load_fixture("valid.yml")
+    record_all(store, data)
+    monkeypatch.setattr(state, "domain_exists", lambda data: False)
+    assert store.get_outdated_stages(data) == ["vm"]
+
+
+def test_leftover_image_outdates_the_cleanup(load_fixture, store, tmp_path):
+    data = load_fixture("valid.yml")
+    record_all(store, data)
+    (tmp_path / "kmaster.qcow2").write_text("")
+    assert store.get_outdated_stages(data) == ["cleanup"]
+
+
+def test_clear(load_fixture, store):
+    data = load_fixture("valid.yml")
+    record_all(store, data)
+    store.clear(data)
+    assert store.load(data) == {}
+
+
+def test_get_create_plan_skips_up_to_date_stages(get_fixture, load_fixture, store):
+    record_all(store, load_fixture("valid.yml"))
+    plan = scheduler.get_create_plan([get_fixture("valid.yml")], store=store)
+    assert list(plan.tasks) == []
+    store.record(load_fixture("valid.yml"), "vm", "outdated")
+    plan = scheduler.get_create_plan([get_fixture("valid.yml")], store=store)
+    assert list(plan.tasks) == [("kmaster", "vm")]
+    assert plan.tasks[("kmaster", "vm")].deps == []
@@ -0,0 +1,73 @@
+import json
+import subprocess
+import sys
+import time
+
+import pytest
+
+from virtbuilder import tracing
+from virtbuilder.utils import execute_cmd
+
+
+@pytest.fixture
+def tracer():
+    tracer = tracing.enable()
+    yield tracer
+    tracing.disable()
+
+
+def test_span_is_a_noop_without_a_tracer():
+    assert tracing.get_tracer() is None
+    with tracing.span("noop"):
+        execute_cmd("true")
+
+
+def test_spans_record_wall_time(tracer):
+    with tracing.span("n1/image", node="n1", stage="image"):
+        time.sleep(0.01)
+    (span,) = tracer.spans
+    assert span.name == "n1/image"
+    assert span.duration >= 0.01
+
+
+def test_spans_record_child_resource_usage(tracer):
+    burn = f"{sys.executable} -c 'sum(range(3000000))'"
+    with tracing.span("outer"):
+        with tracing.span("inner"):
+            execute_cmd(burn)
+    inner, outer = tracer.spans
+    assert inner.cpu > 0
+    assert inner.maxrss > 0
+    # The usage is attributed to all the open spans
+    assert outer.cpu == inner.cpu
+
+
+def test_execute_cmd_raises_on_failure(tracer):
+    with pytest.raises(subprocess.CalledProcessError) as exc:
+        execute_cmd("false")
+    assert exc.value.returncode == 1
+
+
+def test_chrome_trace_export(tracer, tmp_path):
+    with tracing.span("n1/image", node="n1", stage="image"):
+        pass
+    with tracing.span("n1/upload", node="n1", stage="upload"):
+        pass
+    path = tmp_path / "trace.json"
+    tracer.export(path)
+    events = json.loads(path.read_text())["traceEvents"]
+    spans = [event for event in events if event["ph"] == "X"]
+    assert [event["name"] for event in spans] == ["n1/image", "n1/upload"]
+    assert spans[0]["args"]["stage"] == "image"
+    assert all(event["dur"] >= 0 for event in spans)
+    assert any(event["ph"] == "M" for event in events)
+
+
+def test_summary(tracer):
+    for stage in ("image", "upload", "image"):
+        with tracing.span(f"n1/{stage}", node="n1", stage=stage):
+            pass
+    header, *rows = tracer.get_summary()
+    assert header[0] == "span"
+    assert len(rows) == 3 + 2
+    assert [row[0] for row in rows[-2:]] == ["total image", "total upload"]
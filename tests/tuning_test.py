@@ -0,0 +1,191 @@
+import json
+
+import pytest
+
+from virtbuilder import api
+from virtbuilder import scheduler
+from virtbuilder import tuning
+from virtbuilder.cache import LayerCache
+
+
+@pytest.mark.parametrize(
+    "performance, expected",
+    [
+        ({}, ["--disk vol=kvm/vm1,bus=virtio,cache=none,io=native"]),
+        (
+            {"profile": "latency"},
+            [
+                "--disk vol=kvm/vm1,bus=virtio,cache=none,io=native,driver.iothread=1",
+                "--iothreads 1",
+            ],
+        ),
+        (
+            {"profile": "throughput", "queues": 8},
+            [
+                "--disk vol=kvm/vm1,bus=scsi,cache=none,io=io_uring,discard=unmap,"
+                "detect_zeroes=unmap",
+                "--iothreads 1",
+                "--controller type=scsi,model=virtio-scsi,driver.iothread=1,"
+                "driver.queues=8",
+            ],
+        ),
+        (
+            {"profile": "latency", "iothreads": 0, "io": "threads"},
+            ["--disk vol=kvm/vm1,bus=virtio,cache=none,io=threads"],
+        ),
+    ],
+)
+def test_get_disk_parts(performance, expected):
+    vm = {"ram": 1024, "vcpus": 2, "disk-performance": performance}
+    assert tuning.get_disk_parts(vm, "kvm/vm1") == expected
+
+
+def test_get_qcow2_options():
+    image = {"qcow2": {"cluster-size": "2M", "lazy-refcounts": True}}
+    assert tuning.get_qcow2_options(image) == "cluster_size=2M,lazy_refcounts=on"
+    assert tuning.get_qcow2_options({}) == ""
+
+
+def test_qcow2_settings(load_fixture):
+    data = load_fixture("minimum.yml")
+    data["image"]["qcow2"] = {"preallocation": "metadata", "cluster-size": "1M"}
+    data["vm"]["disk-performance"] = {"profile": "throughput"}
+    stages = dict(api.get_create_stages(data))
+    assert stages["image"][1:] == [
+        "qemu-img convert -f qcow2 -O qcow2 -o preallocation=metadata,cluster_size=1M"
+        " kmaster.qcow2 kmaster.qcow2.tuned",
+        "mv kmaster.qcow2.tuned kmaster.qcow2",
+    ]
+    assert "--qcow2" not in stages["image"][0]
+    assert stages["volume"][0].endswith("--prealloc-metadata")
+    assert "--disk-performance" not in stages["vm"][0]
+
+
+def test_qcow2_settings_with_direct_builds(load_fixture, monkeypatch):
+    monkeypatch.setattr(
+        api, "get_pool_target", lambda uri, pool: ("logical", "/dev/vg0")
+    )
+    data = load_fixture("minimum.yml")
+    data["general"]["build-mode"] = "direct"
+    data["image"]["qcow2"] = {"cluster-size": "1M"}
+    cmds = dict(api.get_create_stages(data))["image"]
+    # The logical volume can't be replaced, so the image is converted into it
+    assert "  --output kmaster.qcow2 \\" in cmds[0].split("\n")
+    assert cmds[1:3] == [
+        "qemu-img convert -f qcow2 -O qcow2 -o cluster_size=1M"
+        " kmaster.qcow2 /dev/vg0/kmaster",
+        "/bin/rm kmaster.qcow2",
+    ]
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_qcow2_settings_require_qcow2_format(load_fixture, tmp_path, cache):
+    data = load_fixture("minimum.yml")
+    data["general"]["format"] = "raw"
+    data["image"]["qcow2"] = {"lazy-refcounts": True}
+    layer_cache = LayerCache(path=tmp_path) if cache else None
+    with pytest.raises(ValueError):
+        api.get_create_stages(data, stage="image", cache=layer_cache)
+
+
+@pytest.mark.parametrize(
+    "cpuset, cpus",
+    [("3", [3]), ("0-3,8", [0, 1, 2, 3, 8]), ("4-5,7-9", [4, 5, 7, 8, 9])],
+)
+def test_cpuset(cpuset, cpus):
+    assert tuning.parse_cpuset(cpuset) == cpus
+    assert tuning.format_cpuset(cpus) == cpuset
+
+
+def test_get_performance_parts():
+    vm = {
+        "vcpus": 2,
+        "performance": {
+            "cpu-model": "host-passthrough",
+            "pinning": "4-7",
+            "numa-node": 1,
+            "hugepages": "1G",
+        },
+    }
+    assert tuning.get_performance_parts(vm) == [
+        "--cpu host-passthrough",
+        "--cputune vcpupin0.vcpu=0,vcpupin0.cpuset=4,vcpupin1.vcpu=1,vcpupin1.cpuset=5",
+        "--numatune 1,mode=strict",
+        "--memorybacking hugepages.page0.size=1,hugepages.page0.unit=G",
+    ]
+
+
+def test_unallocated_pinning_raises():
+    with pytest.raises(ValueError):
+        tuning.get_performance_parts({"vcpus": 2, "performance": {"pinning": "auto"}})
+
+
+@pytest.mark.parametrize(
+    "vm, expected",
+    [
+        ({"vcpus": 2}, []),
+        ({"vcpus": 2, "network": "bridge=br0"}, ["--network bridge=br0"]),
+        (
+            {
+                "vcpus": 2,
+                "network": "bridge=br0",
+                "performance": {"net-queues": "auto"},
+            },
+            ["--network bridge=br0,driver.queues=2"],
+        ),
+        (
+            {"vcpus": 2, "performance": {"net-queues": 4}},
+            ["--network network=default,model=virtio,driver.queues=4"],
+        ),
+    ],
+)
+def test_get_network_parts(vm, expected):
+    assert tuning.get_network_parts(vm) == expected
+
+
+def pinned(load_fixture, name, vcpus, **performance):
+    data = load_fixture("minimum.yml")
+    data["general"]["name"] = name
+    data["vm"]["vcpus"] = vcpus
+    data["vm"]["performance"] = dict(pinning="auto", **performance)
+    return data
+
+
+def test_cpu_allocator(tmp_path, load_fixture):
+    topology = {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]}
+    allocator = tuning.CpuAllocator(tmp_path / "cpus.json", lambda uri: topology)
+    vm1 = allocator.allocate(pinned(load_fixture, "vm1", 2))
+    vm2 = allocator.allocate(pinned(load_fixture, "vm2", 2, **{"numa-node": 1}))
+    vm3 = allocator.allocate(pinned(load_fixture, "vm3", 2))
+    assert [vm["vm"]["performance"]["pinning"] for vm in (vm1, vm2, vm3)] == [
+        "0-1",
+        "4-5",
+        "2-3",
+    ]
+    for vm in (vm1, vm2, vm3):
+        allocator.claim(vm)
+    # The allocations are stable across runs
+    allocator = tuning.CpuAllocator(tmp_path / "cpus.json", lambda uri: topology)
+    vm1 = allocator.allocate(pinned(load_fixture, "vm1", 2))
+    assert vm1["vm"]["performance"]["pinning"] == "0-1"
+    with pytest.raises(ValueError):
+        allocator.allocate(pinned(load_fixture, "vm4", 3))
+    allocator.release(vm3)
+    vm4 = allocator.allocate(pinned(load_fixture, "vm4", 3))
+    # No NUMA node has 3 free CPUs
+    assert vm4["vm"]["performance"]["pinning"] == "2-3,6"
+    assert "--cputune" in api.create_vm_cmd(vm4)
+
+
+def test_cpus_are_only_kept_when_the_vm_is_created(tmp_path, load_fixture):
+    path = tmp_path / "kmaster.yml"
+    path.write_text(json.dumps(pinned(load_fixture, "kmaster", 4)))
+    topology = {0: [0, 1, 2, 3]}
+    allocator = tuning.CpuAllocator(tmp_path / "cpus.json", lambda uri: topology)
+    plan = scheduler.get_create_plan(
+        [path], allocator=allocator, run=lambda data, stage, cmds, on_success: None
+    )
+    # Building the plan (e.g. for a preview or an export) doesn't take up any CPUs
+    assert allocator.load() == {}
+    plan.tasks[("kmaster", "vm")].action()
+    assert allocator.load() == {"qemu:///system": {"kmaster": [0, 1, 2, 3]}}
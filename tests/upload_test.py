@@ -0,0 +1,101 @@
+import hashlib
+
+import pytest
+
+from virtbuilder import upload
+
+
+@pytest.mark.parametrize(
+    "size, streams, expected",
+    [
+        (0, 4, []),
+        (100, 4, [(0, 100)]),
+        (256, 2, [(0, 64), (64, 64), (128, 64), (192, 64)]),
+        (250, 8, [(0, 63), (63, 63), (126, 63), (189, 61)]),
+    ],
+)
+def test_get_ranges(size, streams, expected):
+    assert upload.get_ranges(size, streams, min_size=60) == expected
+
+
+def test_progress():
+    lines = []
+    now = [0]
+    progress = upload.Progress(
+        4 * 1024 ** 2, "n1/upload", output=lines.append, clock=lambda: now[0]
+    )
+    now[0] = 2
+    progress.update(1024 ** 2)
+    assert lines == ["[n1/upload]  25.0% of 4.0 MiB, 0.5 MiB/s, ETA 0:00:06"]
+
+
+class FakeVolume(object):
+    """ Store the uploaded ranges in memory """
+
+    def __init__(self, path, corrupt=False):
+        self.path = path
+        self.contents = bytearray()
+        self.corrupt = corrupt
+
+    def upload_range(self, offset, length):
+        with open(self.path, "rb") as fd:
+            fd.seek(offset)
+            chunk = fd.read(length)
+        if self.corrupt and offset:
+            chunk = bytes(len(chunk))
+        end = offset + length
+        if len(self.contents) < end:
+            self.contents.extend(bytes(end - len(self.contents)))
+        self.contents[offset:end] = chunk
+
+    def download_digest(self, offset, length):
+        return hashlib.sha256(self.contents[offset : offset + length]).hexdigest()
+
+
+def test_upload_file_without_verification(tmp_path):
+    path = tmp_path / "image.qcow2"
+    path.write_bytes(bytes(range(256)))
+
+    def download_digest(offset, length):
+        raise AssertionError("the volume shouldn't be downloaded")
+
+    volume = FakeVolume(path)
+    upload.upload_file(
+        path,
+        256,
+        upload_range=volume.upload_range,
+        download_digest=download_digest,
+        streams=1,
+        verify=False,
+    )
+    assert bytes(volume.contents) == path.read_bytes()
+
+
+@pytest.mark.parametrize("corrupt", [False, True])
+def test_upload_file(tmp_path, monkeypatch, corrupt):
+    monkeypatch.setattr(upload, "MIN_RANGE_SIZE", 1000)
+    path = tmp_path / "image.qcow2"
+    path.write_bytes(bytes(range(256)) * 40)
+    volume = FakeVolume(path, corrupt=corrupt)
+    lines = []
+    progress = upload.Progress(10240, "n1/upload", output=lines.append)
+
+    def run():
+        upload.upload_file(
+            path,
+            10240,
+            upload_range=volume.upload_range,
+            download_digest=volume.download_digest,
+            streams=3,
+            progress=progress,
+        )
+
+    if corrupt:
+        with pytest.raises(ValueError) as exc:
+            run()
+        assert "Checksum mismatch" in str(exc.value)
+    else:
+        run()
+        assert bytes(volume.contents) == path.read_bytes()
+        assert len(lines) == 10
+        assert "100.0%" in lines[-1]
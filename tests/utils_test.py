@@ -0,0 +1,8 @@
+from virtbuilder.utils import load_yaml
+
+
+def test_load_yaml_accepts_what_the_pure_parser_accepts(tmp_path):
+    # libyaml rejects the ":" of the URI inside a flow mapping
+    path = tmp_path / "flow.yml"
+    path.write_text("general: {uri: qemu:///system, pool: kvm}\n")
+    assert load_yaml(path) == {"general": {"uri": "qemu:///system", "pool": "kvm"}}
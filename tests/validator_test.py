@@ -0,0 +1,118 @@
+import copy
+import os
+
+import pytest
+from schema import SchemaError
+
+from virtbuilder import validator
+from virtbuilder.schemas import FullSchema, ProvisionSchema
+
+
+@pytest.mark.parametrize("fixture", ["minimum.yml", "valid.yml"])
+def test_compiled_validator_matches_schema(load_fixture, fixture):
+    data = load_fixture(fixture)
+    # "run" is not used by the fixtures, so the results must be identical
+    expected = FullSchema.validate(copy.deepcopy(data))
+    assert validator.validate_data(copy.deepcopy(data)) == expected
+
+
+def test_defaults_are_applied(load_fixture):
+    data = validator.validate_data(load_fixture("minimum.yml"))
+    assert data["image"]["smp"] == 4
+
+
+def test_all_errors_are_reported(load_fixture):
+    data = load_fixture("valid.yml")
+    data["general"]["uri"] = "gibberish"
+    del data["general"]["pool"]
+    data["vm"]["ram"] = -1
+    data["vm"]["gibberish"] = "gibberish"
+    data["image"]["config"]["provision"].append({"gibberish": "gibberish"})
+    data["image"]["config"]["provision"].append({"touch": ""})
+    with pytest.raises(SchemaError) as exc:
+        validator.validate_data(data)
+    errors = exc.value.autos
+    assert len(errors) == 6
+    assert "Key 'general.uri' error:\n'gibberish' does not match" in errors[0]
+    assert "Missing key: 'general.pool'" in errors
+    assert "Wrong key 'vm.gibberish'" in errors
+    assert any(error.startswith("Key 'vm.ram' error:") for error in errors)
+    assert "Wrong key 'gibberish' in image.config.provision[6]" in errors
+    assert any(
+        error.startswith("Key 'image.config.provision[7].touch' error:")
+        for error in errors
+    )
+
+
+def test_replicas_need_a_local_uri(load_fixture):
+    data = load_fixture("minimum.yml")
+    data["replicas"] = {"count": 2}
+    validator.validate_data(data)
+    data["general"]["uri"] = "qemu+ssh://h1/system"
+    with pytest.raises(SchemaError) as exc:
+        validator.validate_data(data)
+    (error,) = exc.value.autos
+    assert error.startswith("Key 'replicas' error:\nreplicas are customized")
+
+
+def test_provision_items_are_dispatched_by_key():
+    compiled = validator.compile_schema(ProvisionSchema)
+    assert isinstance(compiled, validator.ProvisionValidator)
+    assert len(compiled.dispatch) == 23
+    errors = []
+    data = [{"install": ["wget"]}, {"touch": "/a", "mkdir": "/b"}]
+    compiled.validate(data, "provision", errors)
+    assert errors == [
+        "Key 'provision[1]' error:\n{'touch': '/a', 'mkdir': '/b'} should be a single key mapping"
+    ]
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_check_files(get_fixture, tmp_path, jobs):
+    invalid = tmp_path / "invalid.yml"
+    invalid.write_text("general: {}\nimage: {size: 1G}\nvm: {ram: 1, vcpus: 1}\n")
+    paths = [get_fixture("minimum.yml"), get_fixture("valid.yml"), invalid]
+    results = validator.check_files(paths, jobs=jobs)
+    assert list(results) == [str(path) for path in paths]
+    assert results[str(paths[0])] == []
+    assert results[str(paths[1])] == []
+    assert "Missing key: 'general.uri'" in results[str(invalid)]
+
+
+@pytest.fixture
+def definition(get_fixture, tmp_path):
+    path = tmp_path / "definition.yml"
+    path.write_text(get_fixture("minimum.yml").read_text())
+    return path
+
+
+def test_definition_cache_skips_parsing(definition, tmp_path, monkeypatch):
+    cache = validator.DefinitionCache(tmp_path / "cache")
+    data = cache.load(definition)
+    monkeypatch.setattr(validator, "load_yaml", pytest.fail)
+    assert cache.load(definition) == data
+    # Touching the file doesn't invalidate the entry, since the contents are the same
+    os.utime(definition, ns=(0, 0))
+    assert cache.load(definition) == data
+
+
+def test_definition_cache_reparses_changed_files(definition, tmp_path):
+    cache = validator.DefinitionCache(tmp_path / "cache")
+    cache.load(definition)
+    definition.write_text(definition.read_text().replace("kmaster", "knode"))
+    assert cache.load(definition)["general"]["name"] == "knode"
+
+
+def test_definition_cache_ignores_other_versions(definition, tmp_path, monkeypatch):
+    cache = validator.DefinitionCache(tmp_path / "cache")
+    cache.load(definition)
+    monkeypatch.setattr(validator, "__version__", "0.0.0")
+    assert cache._read_entry(definition.resolve()) is None
+
+
+def test_definition_cache_does_not_store_invalid_files(definition, tmp_path):
+    cache = validator.DefinitionCache(tmp_path / "cache")
+    definition.write_text("general: {}\n")
+    with pytest.raises(SchemaError):
+        cache.load(definition)
+    assert not cache.entry_path(definition.resolve()).exists()
@@ -1,64 +1,168 @@
+import functools
 import os.path
 import pathlib
+import shlex
+import subprocess
+import urllib.parse
 
 from pprint import pprint as pp
 
-from .schemas import FullSchema
+from . import tuning
+from .readiness import AGENT_PING, POLL_INTERVAL, get_wait_settings
 from .utils import load_yaml, execute_cmd
 
 SINGLE_SEPARATOR = " "
 MULTI_SEPARATOR = " \\\n  "
 
+# The image options that are boolean flags and not key-value pairs
+IMAGE_FLAGS = {"no-sync", "no-check-signature"}
 
-def validate(definition_file):
-    """ Raise a SchemaError if the provided data are not not valid """
-    data = load_yaml(definition_file)
-    FullSchema.validate(data)
 
+def validate(definition_file, definition_cache=None):
+    """
+    Raise a SchemaError if the provided data are not not valid.
 
-def create_image_cmd(data, singleline=False) -> str:
+    Return the data, so that the definition doesn't need to be parsed again.
+    ``definition_cache`` is an optional ``validator.DefinitionCache``.
+
+    """
+    # The validator pulls in ``schema``, which is slow to import
+    from .validator import load_definition
+
+    return load_definition(definition_file, cache=definition_cache)
+
+
+def is_direct(data):
+    """ Return True if the image should be built directly into the pool volume """
+    return data["general"].get("build-mode", "upload") == "direct"
+
+
+def has_replicas(data):
+    """ Return True if ``data`` only defines the base image of its replicas """
+    return "replicas" in data
+
+
+def is_replica(data):
+    """ Return True if ``data`` is a replica returned by ``get_replicas`` """
+    return "replica" in data
+
+
+def get_replicas(data):
+    """
+    Return the definitions of the replicas of ``data``.
+
+    A replica is a copy of the definition with its own name and (optionally) network.
+    Its ``replica`` key holds the name of the base volume and the provision steps that
+    are applied to the overlay of the replica.
+
+    """
+    replicas = data["replicas"]
     general = data["general"]
-    image = data["image"]
-    config = data["image"].pop("config", {})
-    provision = config.pop("provision", [])
+    vm = data["vm"]
+    if "mac=" in vm.get("network", "") and "network" not in replicas:
+        msg = f"{general['name']}: replicas with a fixed MAC need a network template"
+        raise ValueError(msg)
+    template = replicas.get("name", REPLICA_NAME)
+    result = []
+    for index in range(1, replicas["count"] + 1):
+        fields = {"name": general["name"], "index": index}
+        replica = {key: value for key, value in data.items() if key != "replicas"}
+        replica["general"] = dict(general, name=template.format(**fields))
+        if "network" in replicas:
+            replica["vm"] = dict(vm, network=replicas["network"].format(**fields))
+        replica["replica"] = {
+            "base": general["name"],
+            "index": index,
+            "provision": replicas.get("provision", []),
+        }
+        result.append(replica)
+    return result
 
-    output = general["name"] + "." + general["format"]
-    # Append domain to hostname if it is available
-    hostname = general["name"]
-    domain = general.get("domain", "")
-    if domain:
-        hostname += "." + domain
 
-    parts = [
-        f"virt-builder",
-        f"{general['os-name']}-{general['os-version']}",
-        f"--verbose" if general.get("verbose") else "",
-        f"--format {general['format']}",
-        f"--output {output}",
-        f"--hostname {hostname}",
-    ]
+def expand_replicas(data):
+    """ Return the definitions of all the nodes of ``data``, base image first """
+    if has_replicas(data):
+        return [data] + get_replicas(data)
+    return [data]
+
+
+@functools.lru_cache(maxsize=None)
+def get_pool_target(uri, pool):
+    """
+    Return the ``(type, path)`` of a storage pool.
+
+    This is only possible for the pools of a local hypervisor, since the path must be
+    accessible by ``virt-builder``.
+
+    """
+    if urllib.parse.urlsplit(uri).hostname:
+        raise ValueError(f"Direct builds require a local URI, not: {uri}")
+    import xml.etree.ElementTree as ET
+
+    xml = subprocess.check_output(["virsh", "--connect", uri, "pool-dumpxml", pool])
+    root = ET.fromstring(xml)
+    pool_type = root.get("type")
+    if pool_type not in LOCAL_POOL_TYPES:
+        msg = f"Direct builds require one of {LOCAL_POOL_TYPES} pools, not: {pool_type}"
+        raise ValueError(msg)
+    return pool_type, root.findtext("target/path")
+
+
+def get_image_path(data):
+    """
+    Return the path of the image that ``virt-builder`` creates.
+
+    When building directly into the pool, this is the path of the volume. Otherwise it
+    is a file inside the ``scratch-dir`` (or the current working directory).
+
+    """
+    general = data["general"]
+    if is_direct(data):
+        _, target = get_pool_target(general["uri"], general["pool"])
+        return pathlib.Path(target, general["name"])
+    return get_scratch_path(data)
+
+
+def get_scratch_path(data):
+    """ Return the path of the local image inside ``scratch-dir`` (or the cwd) """
+    general = data["general"]
+    filename = f"{general['name']}.{general['format']}"
+    if general.get("scratch-dir"):
+        return pathlib.Path(os.path.expandvars(general["scratch-dir"]), filename)
+    return pathlib.Path(filename)
+
+
+def get_build_path(data):
+    """
+    Return the path that ``virt-builder`` writes the image to.
+
+    This is the image itself, unless the image is built directly into the pool with
+    ``qcow2`` settings. Since the volume may be a block device (e.g. a logical
+    volume), the image is then built locally and converted into the volume.
+
+    """
+    if is_direct(data) and tuning.get_qcow2_options(data["image"]):
+        return get_scratch_path(data)
+    return get_image_path(data)
 
-    # build time options
-    for key, value in image.items():
-        # no-sync is a boolean flag and not a key-value pair
-        if key == "no-sync":
-            if value is True:
-                parts.append(f"--{key}")
-        else:
-            if isinstance(value, str):
-                value = os.path.expandvars(value)
-            parts.append(f'--{key} "{value}"')
 
-    for key, value in config.items():
-        # update & selinux-relabel are boolean flags and not key-value pairs
-        if key in {"update", "selinux-relabel"}:
+def get_option_parts(options, flags=()):
+    """ Return the command line options of a mapping. ``flags`` are boolean options """
+    parts = []
+    for key, value in options.items():
+        if key in flags:
             if value is True:
                 parts.append(f"--{key}")
         else:
             if isinstance(value, str):
                 value = os.path.expandvars(value)
             parts.append(f'--{key} "{value}"')
+    return parts
 
+
+def get_provision_parts(provision):
+    """ Return the command line options of the ``provision`` items """
+    parts = []
     for item in provision:
         for key, value in item.items():
             # install & uninstall are comma separated lists
@@ -68,6 +172,56 @@ def create_image_cmd(data, singleline=False) -> str:
                 if isinstance(value, str):
                     value = os.path.expandvars(value)
                 parts.append(f'--{key} "{value}"')
+    return parts
+
+
+def get_hostname(data):
+    """ Return the hostname of the VM, including the domain if it is available """
+    general = data["general"]
+    hostname = general["name"]
+    domain = general.get("domain", "")
+    if domain:
+        hostname += "." + domain
+    return hostname
+
+
+def get_artefact(data, stage):
+    """ Return what a create stage produces, i.e. a local file, a volume or a domain """
+    general = data["general"]
+    if stage == "image":
+        return str(get_image_path(data))
+    if stage in {"volume", "upload", "overlay", "customize"}:
+        return f"{general['uri']} {general['pool']}/{general['name']}"
+    if stage == "vm":
+        return f"{general['uri']} {general['name']}"
+    return None
+
+
+def create_image_cmd(data, singleline=False) -> str:
+    general = data["general"]
+    image = dict(data["image"])
+    config = dict(image.pop("config", {}))
+    provision = config.pop("provision", [])
+    # Applied after the build, see ``create_qcow2_cmds``
+    image.pop("qcow2", None)
+
+    output = get_build_path(data).as_posix()
+    hostname = get_hostname(data)
+
+    parts = [
+        f"virt-builder",
+        f"{general['os-name']}-{general['os-version']}",
+        f"--verbose" if general.get("verbose") else "",
+        f"--format {general['format']}",
+        f"--output {output}",
+        f"--hostname {hostname}",
+    ]
+
+    # build time options
+    parts.extend(get_option_parts(image, flags=IMAGE_FLAGS))
+    # update & selinux-relabel are boolean flags and not key-value pairs
+    parts.extend(get_option_parts(config, flags={"update", "selinux-relabel"}))
+    parts.extend(get_provision_parts(provision))
 
     sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
     cmd = sep.join((p for p in parts if p))
@@ -76,7 +230,6 @@ def create_image_cmd(data, singleline=False) -> str:
 
 def create_volume_cmd(data, singleline=False):
     general = data["general"]
-    image = pathlib.Path(f"{general['name']}.{general['format']}").resolve()
     image_size = data["image"]["size"]
     create_volume_parts = [
         f"virsh",
@@ -87,14 +240,17 @@ def create_volume_cmd(data, singleline=False):
         f"--format {general['format']}",
         f"--capacity {image_size}",
     ]
+    if data["image"].get("qcow2", {}).get("preallocation") == "metadata":
+        create_volume_parts.append("--prealloc-metadata")
     sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
     cmd = sep.join(create_volume_parts)
     return cmd
 
 
-def create_upload_cmd(data, singleline=False):
+def create_upload_cmd(data, singleline=False, offset=None, length=None):
+    """ Upload the image, or only ``length`` bytes of it starting at ``offset`` """
     general = data["general"]
-    image = pathlib.Path(f"{general['name']}.{general['format']}").resolve()
+    image = get_image_path(data).resolve()
     upload_image_parts = [
         f"virsh",
         f"--connect {general['uri']}",
@@ -103,14 +259,60 @@ def create_upload_cmd(data, singleline=False):
         f"--vol {general['name']}",
         f"--file {image.as_posix()}",
     ]
+    if offset is not None:
+        upload_image_parts.extend([f"--offset {offset}", f"--length {length}"])
     sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
     cmd = sep.join(upload_image_parts)
     return cmd
 
 
+def create_download_cmd(data, offset, length, output="/dev/stdout"):
+    """ Download ``length`` bytes of the volume starting at ``offset`` """
+    general = data["general"]
+    parts = [
+        f"virsh",
+        f"--connect {general['uri']}",
+        f"vol-download",
+        f"--pool {general['pool']}",
+        f"--vol {general['name']}",
+        f"--file {output}",
+        f"--offset {offset}",
+        f"--length {length}",
+    ]
+    return SINGLE_SEPARATOR.join(parts)
+
+
+def get_qcow2_options(data):
+    """ Return the ``qemu-img`` options of the ``qcow2`` settings of the image """
+    options = tuning.get_qcow2_options(data["image"])
+    if options and data["general"]["format"] != "qcow2":
+        raise ValueError("The 'qcow2' image settings require the qcow2 format")
+    return options
+
+
+def create_qcow2_cmds(data):
+    """
+    Return the commands that apply the ``qcow2`` settings to the image.
+
+    virt-builder can't set e.g. the cluster size, so the image is converted into a new
+    qcow2 file that replaces it, or into the volume when building directly into the
+    pool (see ``get_build_path``).
+
+    """
+    options = get_qcow2_options(data)
+    if not options:
+        return []
+    convert = f"qemu-img convert -f qcow2 -O qcow2 -o {options}"
+    output = get_image_path(data).as_posix()
+    if is_direct(data):
+        build = get_build_path(data).as_posix()
+        return [f"{convert} {build} {output}", f"/bin/rm {build}"]
+    return [f"{convert} {output} {output}.tuned", f"mv {output}.tuned {output}"]
+
+
 def create_cleanup_cmd(data, singleline=False):
     general = data["general"]
-    parts = [f"/bin/rm", f"{data['general']['name']}.{data['general']['format']}"]
+    parts = [f"/bin/rm", get_image_path(data).as_posix()]
     sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
     cmd = sep.join(parts)
     return cmd
@@ -127,47 +329,229 @@ def create_vm_cmd(data, singleline=False):
         f"--noautoconsole",
         f"--name {general['name']}",
         f"--os-variant {os_variant}",
-        f"--disk vol={general['pool']}/{general['name']},bus=virtio,cache=none,io=native",
     ]
-    for key, value in data["vm"].items():
-        parts.append(f"--{key} {value}")
+    parts.extend(tuning.get_disk_parts(vm, f"{general['pool']}/{general['name']}"))
+    for key, value in vm.items():
+        if key == "network":
+            parts.extend(tuning.get_network_parts(vm))
+        elif key not in VM_TUNING_KEYS:
+            parts.append(f"--{key} {value}")
+    if "network" not in vm:
+        parts.extend(tuning.get_network_parts(vm))
+    parts.extend(tuning.get_performance_parts(vm))
+    sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
+    cmd = sep.join(parts)
+    return cmd
+
+
+def create_overlay_cmd(data, singleline=False):
+    """ Create the volume of a replica as a qcow2 overlay of the base volume """
+    general = data["general"]
+    parts = [
+        f"virsh",
+        f"--connect {general['uri']}",
+        f"vol-create-as",
+        f"--pool {general['pool']}",
+        f"--name {general['name']}",
+        f"--format qcow2",
+        f"--capacity {data['image']['size']}",
+        f"--backing-vol {data['replica']['base']}",
+        f"--backing-vol-format {general['format']}",
+    ]
+    sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
+    cmd = sep.join(parts)
+    return cmd
+
+
+def create_customize_cmd(data, singleline=False):
+    """
+    Make the overlay of a replica unique.
+
+    The hostname is set and the machine-id is truncated, so that systemd generates a new
+    one on first boot. The provision steps of the replicas are applied too.
+
+    """
+    general = data["general"]
+    _, target = get_pool_target(general["uri"], general["pool"])
+    parts = [
+        f"virt-customize",
+        f"--verbose" if general.get("verbose") else "",
+        f"--add {pathlib.Path(target, general['name']).as_posix()}",
+        f"--format qcow2",
+        f"--hostname {get_hostname(data)}",
+        f"--truncate /etc/machine-id",
+    ]
+    parts.extend(get_provision_parts(data["replica"]["provision"]))
+    sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
+    cmd = sep.join((p for p in parts if p))
+    return cmd
+
+
+def create_refresh_cmd(data, singleline=False):
+    general = data["general"]
+    parts = [
+        f"virsh",
+        f"--connect {general['uri']}",
+        f"pool-refresh",
+        f"--pool {general['pool']}",
+    ]
     sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
     cmd = sep.join(parts)
     return cmd
 
 
-def _get_create_commands(data, stage):
-    if stage:
-        func = CREATE_COMMAND_DISPATCHER[stage]
-        cmds = [func(data)]
+def get_stages(data):
+    """ Return the create stages of ``data`` in execution order """
+    if is_replica(data):
+        stages = REPLICA_STAGES
     else:
-        cmds = [
-            create_image_cmd(data),
-            create_volume_cmd(data),
-            create_upload_cmd(data),
-            create_cleanup_cmd(data, singleline=True),
-            create_vm_cmd(data),
-        ]
+        stages = DIRECT_STAGES if is_direct(data) else CREATE_STAGES
+    if has_replicas(data):
+        # The base volume is only used as the backing file of the replicas. Booting it
+        # would corrupt their overlays.
+        stages = [stage for stage in stages if stage != "vm"]
+    elif "wait" in data["vm"]:
+        stages = stages + ["wait"]
+    return stages
+
+
+def get_stage_dependencies(data):
+    """ Return the dependencies of the create stages of ``data`` """
+    if is_replica(data):
+        return REPLICA_STAGE_DEPENDENCIES
+    return DIRECT_STAGE_DEPENDENCIES if is_direct(data) else STAGE_DEPENDENCIES
+
+
+def get_node_dependencies(data):
+    """
+    Return the stages of other nodes that the stages of ``data`` depend on.
+
+    The result maps stages to ``(node, stage)`` keys, e.g. the overlay of a replica
+    can only be created after the base volume is complete.
+
+    """
+    if not is_replica(data):
+        return {}
+    base_stage = "image" if is_direct(data) else "upload"
+    return {"overlay": [(data["replica"]["base"], base_stage)]}
+
+
+def get_create_stages(data, stage=None, cache=None):
+    """
+    Return a list of ``(stage, cmds)`` tuples.
+
+    Normally each stage consists of a single command, but when a layer ``cache`` is
+    being used, the image stage consists of all the commands needed to build the
+    missing layers. When building directly into the pool, the image stage also
+    refreshes the pool, so that libvirt picks up the new allocation of the volume.
+
+    """
+    available = get_stages(data)
+    if stage and stage not in available:
+        raise ValueError(f"'stage' must be one of {available}, not: {stage}")
+    stages = [stage] if stage else available
+    result = []
+    for name in stages:
+        if name == "image":
+            if cache:
+                cmds = cache.get_image_cmds(data)
+            else:
+                cmds = [create_image_cmd(data)] + create_qcow2_cmds(data)
+            if is_direct(data):
+                cmds.append(create_refresh_cmd(data, singleline=True))
+        elif name == "cleanup":
+            cmds = [create_cleanup_cmd(data, singleline=True)]
+        elif name == "wait":
+            cmds = [create_wait_cmd(data)]
+        elif name in REPLICA_COMMAND_DISPATCHER:
+            cmds = [REPLICA_COMMAND_DISPATCHER[name](data)]
+        else:
+            cmds = [CREATE_COMMAND_DISPATCHER[name](data)]
+        result.append((name, cmds))
+    return result
+
+
+def _get_create_commands(data, stage, cache=None):
+    cmds = []
+    for _, stage_cmds in get_create_stages(data, stage=stage, cache=cache):
+        cmds.extend(stage_cmds)
     return cmds
 
 
-def get_create_commands(definition_file, stage=None):
+def get_create_commands(definition_file, stage=None, cache=None):
     data = load_yaml(definition_file)
-    cmds = _get_create_commands(data, stage=stage)
+    cmds = _get_create_commands(data, stage=stage, cache=cache)
     return cmds
 
 
 def get_remove_commands(definition_file):
     data = load_yaml(definition_file)
-    name = data["general"]["name"]
-    uri = data["general"]["uri"]
+    return _get_remove_commands(data)
+
+
+def _get_remove_commands(data):
+    if has_replicas(data):
+        # The overlays must be removed before their backing volume
+        cmds = []
+        for replica in get_replicas(data):
+            cmds.extend(_get_remove_commands(replica))
+        cmds.append(create_vol_delete_cmd(data))
+        return cmds
     cmds = [
-        f"virsh --connect {uri} destroy {name}",
-        f"virsh --connect {uri} undefine --remove-all-storage {name}",
+        create_lifecycle_cmd(data, "destroy"),
+        create_lifecycle_cmd(data, "undefine"),
     ]
     return cmds
 
 
+def create_wait_cmd(data):
+    """
+    Return a command that waits until the VM is ready.
+
+    The backends poll all the VMs at once (see ``readiness.ReadinessPoller``), so this
+    command is only used by the previews and the exported build files. It checks the
+    DHCP lease or the guest agent, but not the SSH banner.
+
+    """
+    general = data["general"]
+    settings = get_wait_settings(data)
+    virsh = f"virsh --connect {general['uri']}"
+    if settings["method"] == "agent":
+        check = f"{virsh} qemu-agent-command {general['name']} '{AGENT_PING}'"
+        check += " >/dev/null 2>&1"
+    else:
+        check = f"{virsh} domifaddr {general['name']} --source lease | grep -q ipv4"
+    loop = f"until {check}; do sleep {POLL_INTERVAL}; done"
+    return f"timeout {settings['timeout']} sh -c {shlex.quote(loop)}"
+
+
+def create_lifecycle_cmd(data, action):
+    """ Return the ``virsh`` command that performs a lifecycle ``action`` on the VM """
+    general = data["general"]
+    if action not in LIFECYCLE_COMMANDS:
+        msg = f"'action' must be one of {list(LIFECYCLE_COMMANDS)}, not: {action}"
+        raise ValueError(msg)
+    parts = [
+        f"virsh",
+        f"--connect {general['uri']}",
+        LIFECYCLE_COMMANDS[action],
+        general["name"],
+    ]
+    return SINGLE_SEPARATOR.join(parts)
+
+
+def create_vol_delete_cmd(data):
+    general = data["general"]
+    parts = [
+        f"virsh",
+        f"--connect {general['uri']}",
+        f"vol-delete",
+        f"--pool {general['pool']}",
+        general["name"],
+    ]
+    return SINGLE_SEPARATOR.join(parts)
+
+
 CREATE_COMMAND_DISPATCHER = {
     "image": create_image_cmd,
     "volume": create_volume_cmd,
@@ -178,3 +562,59 @@ CREATE_COMMAND_DISPATCHER = {
 
 
 CREATE_STAGES = list(CREATE_COMMAND_DISPATCHER.keys())
+
+# The stages that need to finish before a stage can start
+STAGE_DEPENDENCIES = {
+    "image": [],
+    "volume": [],
+    "upload": ["image", "volume"],
+    "cleanup": ["upload"],
+    "vm": ["upload"],
+    # Only with a ``vm.wait`` section
+    "wait": ["vm"],
+}
+
+# When building directly into the pool, the volume must exist before the image is built
+# and there is nothing to upload or clean up.
+DIRECT_STAGES = ["volume", "image", "vm"]
+
+DIRECT_STAGE_DEPENDENCIES = {
+    "volume": [],
+    "image": ["volume"],
+    "vm": ["image"],
+    "wait": ["vm"],
+}
+
+# The replicas share the base image of their definition, so they only need an overlay
+# of the base volume that gets customized before the VM is created.
+REPLICA_COMMAND_DISPATCHER = {
+    "overlay": create_overlay_cmd,
+    "customize": create_customize_cmd,
+    "vm": create_vm_cmd,
+}
+
+REPLICA_STAGES = list(REPLICA_COMMAND_DISPATCHER.keys())
+
+REPLICA_STAGE_DEPENDENCIES = {
+    "overlay": [],
+    "customize": ["overlay"],
+    "vm": ["customize"],
+    "wait": ["vm"],
+}
+
+REPLICA_NAME = "{name}-{index}"
+
+# The ``vm`` settings that are not virt-install options
+VM_TUNING_KEYS = {"disk-performance", "performance", "wait"}
+
+# The virsh subcommands of the lifecycle actions
+LIFECYCLE_COMMANDS = {
+    "start": "start",
+    "stop": "shutdown",
+    "reboot": "reboot",
+    "destroy": "destroy",
+    "undefine": "undefine --remove-all-storage",
+}
+
+# The pool types whose volumes are files or block devices of the local host
+LOCAL_POOL_TYPES = ("dir", "fs", "netfs", "logical")
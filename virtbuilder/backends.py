@@ -0,0 +1,390 @@
+import functools
+import hashlib
+import os
+import subprocess
+import threading
+import xml.etree.ElementTree as ET
+
+from . import api
+from . import readiness
+from . import state
+from . import upload
+from .utils import execute_cmd, parse_size, split_cmd, write_line
+
+try:
+    import libvirt
+except ImportError:  # pragma: no cover
+    libvirt = None
+
+# The lifecycle actions that can be performed on (multiple) existing VMs
+LIFECYCLE_ACTIONS = ("remove", "start", "stop", "reboot")
+# The states of the domains that are not running, as reported by ``virsh domstate``
+INACTIVE_STATES = {"shut off", "crashed"}
+
+
+def remove_image_file(data):
+    """ Remove the local image of a node, e.g. one left behind by a failed create """
+    if api.is_direct(data):
+        # The image is the volume itself
+        return
+    path = api.get_image_path(data)
+    if path.exists():
+        path.unlink()
+
+
+class VirshBackend(object):
+    """ Execute every stage by spawning the commands returned by ``api`` """
+
+    name = "virsh"
+
+    def __init__(self, upload_streams=1, verify_upload=False, output=write_line):
+        # The images are uploaded in ranges, ``upload_streams`` of them concurrently
+        self.upload_streams = upload_streams
+        self.verify_upload = verify_upload
+        self.output = output
+        # Polls the VMs of all the wait stages
+        self.poller = readiness.ReadinessPoller()
+
+    def runs_commands(self, stage):
+        """ Return True if ``stage`` is executed by spawning its commands """
+        # The uploads report their progress, which needs them to run in ranges
+        return stage not in ("wait", "upload")
+
+    def run_stage(self, data, stage, cmds):
+        if stage == "wait":
+            self.wait(data).result()
+        elif stage == "upload":
+            self.upload_ranges(data)
+        else:
+            for cmd in cmds:
+                execute_cmd(cmd)
+
+    def wait(self, data):
+        """ Return a ``Future`` with the address of the VM, once it is ready """
+        return self.poller.wait(data)
+
+    def upload_range(self, data, offset, length):
+        cmd = api.create_upload_cmd(data, singleline=True, offset=offset, length=length)
+        execute_cmd(cmd)
+
+    def download_digest(self, data, offset, length):
+        """ Return the sha256 of a range of the volume """
+        cmd = split_cmd(api.create_download_cmd(data, offset, length))
+        digest = hashlib.sha256()
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+            for chunk in iter(lambda: process.stdout.read(upload.CHUNK_SIZE), b""):
+                digest.update(chunk)
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return digest.hexdigest()
+
+    def upload_ranges(self, data):
+        """ Upload the image in ``upload_streams`` concurrent ranges with progress """
+        path = api.get_image_path(data)
+        size = os.path.getsize(path)
+        upload.upload_file(
+            path,
+            size,
+            upload_range=functools.partial(self.upload_range, data),
+            download_digest=functools.partial(self.download_digest, data),
+            streams=self.upload_streams,
+            progress=upload.Progress(
+                size, f"{data['general']['name']}/upload", output=self.output
+            ),
+            verify=self.verify_upload,
+        )
+
+    def remove(self, data, replicas=True):
+        """
+        Remove the VM and its volumes. Missing domains and volumes are ignored.
+
+        The definitions with ``replicas`` remove their replicas (unless ``replicas`` is
+        False) and then the base volume.
+
+        """
+        if api.has_replicas(data):
+            if replicas:
+                for replica in api.get_replicas(data):
+                    self.remove(replica)
+            self.delete_volume(data)
+        else:
+            # An unreachable ``uri`` raises, rather than counting as a missing domain
+            domain_state = state.get_domain_state(data)
+            if domain_state is None:
+                # A create that failed before the vm stage leaves an orphan volume
+                self.delete_volume(data)
+            else:
+                if domain_state not in INACTIVE_STATES:
+                    execute_cmd(api.create_lifecycle_cmd(data, "destroy"))
+                execute_cmd(api.create_lifecycle_cmd(data, "undefine"))
+        remove_image_file(data)
+
+    def delete_volume(self, data):
+        """ Delete the volume of the node, if it exists """
+        if state.volume_exists(data):
+            execute_cmd(api.create_vol_delete_cmd(data))
+
+    def _run_lifecycle_cmd(self, data, action, states):
+        # Acting on a domain that is missing or in the wrong state is a no-op
+        if state.get_domain_state(data) in states:
+            execute_cmd(api.create_lifecycle_cmd(data, action))
+
+    def start(self, data):
+        self._run_lifecycle_cmd(data, "start", INACTIVE_STATES)
+
+    def stop(self, data):
+        self._run_lifecycle_cmd(data, "stop", {"running", "paused"})
+
+    def reboot(self, data):
+        self._run_lifecycle_cmd(data, "reboot", {"running"})
+
+    def get_host_info(self, uri, pool):
+        """
+        Return the CPUs of a host, the vCPUs of its running domains, its free memory
+        and the free space of its ``pool``.
+
+        """
+
+        def virsh(*args, separator=":"):
+            output = subprocess.check_output(
+                ["virsh", f"--connect={uri}", *args], universal_newlines=True
+            )
+            fields = (line.partition(separator) for line in output.splitlines())
+            return [(key.strip(), value.split()) for key, _, value in fields]
+
+        def get(*args):
+            return dict(virsh(*args))
+
+        memory = " ".join(get("freecell", "--all")["Total"])
+        stats = virsh("domstats", "--state-running", "--vcpu", separator="=")
+        return {
+            "cpus": int(get("nodeinfo")["CPU(s)"][0]),
+            "vcpus": sum(
+                int(value[0]) for key, value in stats if key == "vcpu.current"
+            ),
+            "free_memory": parse_size(memory),
+            "free_disk": int(get("pool-info", pool, "--bytes")["Available"][0]),
+        }
+
+    def close(self):
+        pass
+
+
+class LibvirtBackend(VirshBackend):
+    """
+    Execute the libvirt related stages through the libvirt python bindings.
+
+    A single connection per URI is kept open for the whole run and it is shared by all
+    the threads. The stages that don't talk to libvirt (e.g. ``image``) are still
+    executed by spawning their commands.
+
+    """
+
+    name = "libvirt"
+
+    def __init__(self, upload_streams=1, verify_upload=False, output=write_line):
+        if libvirt is None:
+            raise RuntimeError("The libvirt python bindings are not installed")
+        super().__init__(
+            upload_streams=upload_streams, verify_upload=verify_upload, output=output
+        )
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._handlers = {
+            "volume": self.create_volume,
+            "upload": self.upload_ranges,
+            "vm": self.create_vm,
+            "wait": lambda data: self.wait(data).result(),
+        }
+
+    def get_connection(self, uri):
+        with self._lock:
+            conn = self._connections.get(uri)
+            if conn is None or not conn.isAlive():
+                conn = self._connections[uri] = libvirt.open(uri)
+            return conn
+
+    def close(self):
+        with self._lock:
+            for conn in self._connections.values():
+                conn.close()
+            self._connections.clear()
+
+    def _get_pool(self, data):
+        general = data["general"]
+        return self.get_connection(general["uri"]).storagePoolLookupByName(
+            general["pool"]
+        )
+
+    def _lookup_domain(self, data):
+        general = data["general"]
+        conn = self.get_connection(general["uri"])
+        try:
+            return conn.lookupByName(general["name"])
+        except libvirt.libvirtError as exc:
+            if exc.get_error_code() == libvirt.VIR_ERR_NO_DOMAIN:
+                return None
+            raise
+
+    def get_host_info(self, uri, pool):
+        conn = self.get_connection(uri)
+        # [model, memory (MiB), cpus, mhz, nodes, sockets, cores, threads]
+        info = conn.getInfo()
+        try:
+            free_memory = conn.getFreeMemory()
+        except libvirt.libvirtError:
+            # Not supported by all the drivers
+            free_memory = info[1] * 1024 ** 2
+        # [state, max memory, memory, vcpus, cpu time]
+        vcpus = sum(
+            domain.info()[3]
+            for domain in conn.listAllDomains(libvirt.VIR_CONNECT_LIST_DOMAINS_ACTIVE)
+        )
+        # [state, capacity, allocation, available]
+        available = conn.storagePoolLookupByName(pool).info()[3]
+        return {
+            "cpus": info[2],
+            "vcpus": vcpus,
+            "free_memory": free_memory,
+            "free_disk": available,
+        }
+
+    def runs_commands(self, stage):
+        return stage not in self._handlers
+
+    def run_stage(self, data, stage, cmds):
+        handler = self._handlers.get(stage)
+        if handler is None:
+            super().run_stage(data, stage, cmds)
+        else:
+            handler(data)
+
+    def create_volume(self, data):
+        general = data["general"]
+        xml = (
+            f"<volume>"
+            f"<name>{general['name']}</name>"
+            f"<capacity unit='bytes'>{parse_size(data['image']['size'])}</capacity>"
+            f"<target><format type='{general['format']}'/></target>"
+            f"</volume>"
+        )
+        flags = 0
+        if data["image"].get("qcow2", {}).get("preallocation") == "metadata":
+            # Like ``virsh vol-create-as --prealloc-metadata``
+            flags = libvirt.VIR_STORAGE_VOL_CREATE_PREALLOC_METADATA
+        self._get_pool(data).createXML(xml, flags)
+
+    def upload_range(self, data, offset, length):
+        general = data["general"]
+        conn = self.get_connection(general["uri"])
+        volume = self._get_pool(data).storageVolLookupByName(general["name"])
+        stream = conn.newStream(0)
+        volume.upload(stream, offset, length, 0)
+        with open(api.get_image_path(data), "rb") as fd:
+            fd.seek(offset)
+            remaining = [length]
+
+            def read(stream, nbytes, fd):
+                chunk = fd.read(min(nbytes, remaining[0]))
+                remaining[0] -= len(chunk)
+                return chunk
+
+            stream.sendAll(read, fd)
+        stream.finish()
+
+    def download_digest(self, data, offset, length):
+        general = data["general"]
+        conn = self.get_connection(general["uri"])
+        volume = self._get_pool(data).storageVolLookupByName(general["name"])
+        digest = hashlib.sha256()
+        stream = conn.newStream(0)
+        volume.download(stream, offset, length, 0)
+        stream.recvAll(lambda stream, chunk, digest: digest.update(chunk), digest)
+        stream.finish()
+        return digest.hexdigest()
+
+    def create_vm(self, data):
+        # virt-install knows how to turn the definition into domain XML
+        cmd = api.create_vm_cmd(data, singleline=True) + " --print-xml"
+        xml = subprocess.check_output(split_cmd(cmd), universal_newlines=True)
+        conn = self.get_connection(data["general"]["uri"])
+        conn.defineXML(xml).create()
+
+    def delete_volume(self, data):
+        pool = self._get_pool(data)
+        try:
+            pool.storageVolLookupByName(data["general"]["name"]).delete(0)
+        except libvirt.libvirtError as exc:
+            if exc.get_error_code() != libvirt.VIR_ERR_NO_STORAGE_VOL:
+                raise
+
+    def start(self, data):
+        domain = self._lookup_domain(data)
+        if domain is not None and not domain.isActive():
+            domain.create()
+
+    def stop(self, data):
+        domain = self._lookup_domain(data)
+        if domain is not None and domain.isActive():
+            domain.shutdown()
+
+    def reboot(self, data):
+        domain = self._lookup_domain(data)
+        if domain is not None and domain.isActive():
+            domain.reboot(0)
+
+    def remove(self, data, replicas=True):
+        """ Destroy and undefine the domain and delete its volumes """
+        if api.has_replicas(data):
+            # The overlays must be removed before their backing volume
+            if replicas:
+                for replica in api.get_replicas(data):
+                    self.remove(replica)
+            self.delete_volume(data)
+            remove_image_file(data)
+            return
+        domain = self._lookup_domain(data)
+        if domain is None:
+            # A create that failed before the vm stage leaves an orphan volume
+            self.delete_volume(data)
+            remove_image_file(data)
+            return
+        conn = self.get_connection(data["general"]["uri"])
+        if domain.isActive():
+            domain.destroy()
+        volumes = []
+        root = ET.fromstring(domain.XMLDesc(0))
+        for source in root.iterfind("devices/disk/source"):
+            try:
+                if source.get("pool") and source.get("volume"):
+                    pool = conn.storagePoolLookupByName(source.get("pool"))
+                    volumes.append(pool.storageVolLookupByName(source.get("volume")))
+                elif source.get("file") or source.get("dev"):
+                    path = source.get("file") or source.get("dev")
+                    volumes.append(conn.storageVolLookupByPath(path))
+            except libvirt.libvirtError:
+                # Like "virsh undefine --remove-all-storage", only managed volumes
+                # are deleted
+                continue
+        domain.undefine()
+        for volume in volumes:
+            volume.delete(0)
+        remove_image_file(data)
+
+
+BACKENDS = {"virsh": VirshBackend, "libvirt": LibvirtBackend}
+
+
+def get_backend(name="auto", **options):
+    """
+    Return a backend instance. The ``options`` are passed to the backend class.
+
+    ``auto`` returns the libvirt backend if the bindings are installed and falls back to
+    the virsh backend otherwise.
+
+    """
+    if name == "auto":
+        name = "virsh" if libvirt is None else "libvirt"
+    if name not in BACKENDS:
+        raise ValueError(f"backend must be one of {['auto', *BACKENDS]}, not: {name}")
+    return BACKENDS[name](**options)
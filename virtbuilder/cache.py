@@ -0,0 +1,286 @@
+import copy
+import hashlib
+import json
+import os.path
+import pathlib
+import threading
+
+from .api import IMAGE_FLAGS, MULTI_SEPARATOR, SINGLE_SEPARATOR
+from .api import get_hostname, get_image_path, get_option_parts
+from .api import get_provision_parts, get_qcow2_options
+from .utils import get_cache_dir, get_digest, parse_size
+
+DEFAULT_BUDGET = "20G"
+
+
+def hash_path(path):
+    """ Return a digest of the contents of ``path`` (which may be a directory) """
+    path = pathlib.Path(path)
+    digest = hashlib.sha256()
+    if path.is_dir():
+        for child in sorted(p for p in path.rglob("*") if p.is_file()):
+            digest.update(child.relative_to(path).as_posix().encode())
+            digest.update(hash_path(child).encode())
+    elif path.is_file():
+        with path.open("rb") as fd:
+            for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+                digest.update(chunk)
+    else:
+        digest.update(b"<missing>")
+    return digest.hexdigest()
+
+
+def get_referenced_paths(key, value):
+    """ Return the local files that are referenced by an option """
+    if not isinstance(value, str):
+        return []
+    value = os.path.expandvars(value)
+    if ":file:" in value:
+        # e.g. --ssh-inject USER:file:FILE or --password USER:file:FILE
+        return [value.split(":file:", 1)[1]]
+    if value.startswith("file:"):
+        # e.g. --root-password file:FILE
+        return [value[len("file:") :]]
+    if key in {"copy-in", "upload"}:
+        # e.g. --copy-in LOCALPATH:REMOTEDIR
+        return [value.rsplit(":", 1)[0]]
+    if key in {"run", "firstboot"}:
+        return [value]
+    return []
+
+
+def hash_references(options):
+    """ Return the digests of the files referenced by a mapping of options """
+    return {
+        path: hash_path(path)
+        for key, value in options.items()
+        for path in get_referenced_paths(key, value)
+    }
+
+
+def get_layer_keys(data):
+    """
+    Return a list of ``(key, description)`` tuples, one for the base image and one for
+    each prefix of the ``provision`` list.
+
+    Each key is a hash of the definition options that affect the contents of the layer
+    (plus the contents of the local files these options reference) and of the key of
+    its parent layer.
+
+    """
+    general = data["general"]
+    image = data["image"]
+    config = dict(image.get("config", {}))
+    provision = config.pop("provision", [])
+    base = {
+        "os-name": general["os-name"],
+        "os-version": general["os-version"],
+        "arch": image.get("arch"),
+        "size": image["size"],
+        "format": general["format"],
+        "config": {
+            key: os.path.expandvars(value) if isinstance(value, str) else value
+            for key, value in config.items()
+        },
+        "files": hash_references(config),
+    }
+    key = get_digest(base)
+    keys = [(key, f"{general['os-name']}-{general['os-version']}")]
+    for item in provision:
+        description = get_provision_parts([item])[0]
+        key = get_digest(key, get_provision_parts([item]), hash_references(item))
+        keys.append((key, description))
+    return keys
+
+
+class LayerCache(object):
+    """
+    A content addressed cache of qcow2 layers.
+
+    The base layer is created by ``virt-builder`` and each subsequent layer is a qcow2
+    overlay (backed by its parent) with a single provision step applied to it via
+    ``virt-customize``. Next to each ``<key>.qcow2`` layer there is a ``<key>.json``
+    file with the layer metadata. Its modification time is used as the "last used"
+    timestamp of the layer for the LRU eviction.
+
+    Generating the commands doesn't touch the cache. The layers are registered and
+    the cache is pruned by ``prepare``, right before the image stage runs.
+
+    """
+
+    def __init__(self, path=None, budget=DEFAULT_BUDGET):
+        self.path = pathlib.Path(path) if path else get_cache_dir("layers")
+        self.budget = parse_size(budget)
+        self._lock = threading.Lock()
+        # The layers that the generated commands of this run build upon
+        self._reserved = set()
+
+    def layer_path(self, key):
+        return self.path / f"{key}.qcow2"
+
+    def meta_path(self, key):
+        return self.path / f"{key}.json"
+
+    def has(self, key):
+        return self.layer_path(key).exists()
+
+    def register(self, key, parent, description):
+        """ Store the metadata of a layer and mark it as used """
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta = {"key": key, "parent": parent, "description": description}
+        self.meta_path(key).write_text(json.dumps(meta))
+
+    def entries(self):
+        """ Return the metadata of the cached layers, least recently used first """
+        entries = []
+        for meta_path in self.path.glob("*.json"):
+            meta = json.loads(meta_path.read_text())
+            layer = self.layer_path(meta["key"])
+            meta["last_used"] = meta_path.stat().st_mtime
+            meta["size"] = layer.stat().st_size if layer.exists() else 0
+            meta["complete"] = layer.exists()
+            entries.append(meta)
+        return sorted(entries, key=lambda meta: meta["last_used"])
+
+    def remove(self, key):
+        for path in (self.layer_path(key), self.meta_path(key)):
+            if path.exists():
+                path.unlink()
+
+    @staticmethod
+    def _descendants(key, entries):
+        """ Return ``key`` and the keys of all the layers that are backed by it """
+        found = [key]
+        while True:
+            children = [
+                meta["key"]
+                for meta in entries
+                if meta["parent"] in found and meta["key"] not in found
+            ]
+            if not children:
+                return found
+            found.extend(children)
+
+    def prune(self, budget=None, keep=()):
+        """
+        Evict the least recently used layers until the cache fits in ``budget``.
+
+        Since each layer is backed by its parent, evicting a layer evicts its
+        descendants too. The layers in ``keep`` are never evicted. Return the list of
+        the evicted keys.
+
+        """
+        budget = self.budget if budget is None else parse_size(budget)
+        entries = {meta["key"]: meta for meta in self.entries()}
+        total = sum(meta["size"] for meta in entries.values())
+        evicted = []
+        for key in list(entries):
+            if total <= budget:
+                break
+            if key not in entries or key in keep:
+                continue
+            doomed = self._descendants(key, entries.values())
+            if keep and set(doomed).intersection(keep):
+                continue
+            for doomed_key in doomed:
+                total -= entries.pop(doomed_key)["size"]
+                self.remove(doomed_key)
+                evicted.append(doomed_key)
+        return evicted
+
+    def prepare(self, data):
+        """
+        Mark the layers of ``data`` as used and make room for the missing ones.
+
+        The layers that the commands of this run build upon are never evicted.
+
+        """
+        keys = get_layer_keys(data)
+        with self._lock:
+            self.prune(keep=self._reserved.union(key for key, _ in keys))
+            for index, (key, description) in enumerate(keys):
+                parent = keys[index - 1][0] if index else None
+                self.register(key, parent, description)
+
+    def get_image_cmds(self, data, singleline=False):
+        """
+        Return the commands that create the image of ``data`` using the cache.
+
+        The build resumes from the longest cached prefix of the provision list and only
+        the missing layers are created. The image itself is a copy of the last layer,
+        to which the node specific options (i.e. the hostname) get applied.
+
+        """
+        data = copy.deepcopy(data)
+        keys = get_layer_keys(data)
+        general = data["general"]
+        image = data["image"]
+        config = image.pop("config", {})
+        provision = config.pop("provision", [])
+        qcow2_options = get_qcow2_options(data)
+        image.pop("qcow2", None)
+        with self._lock:
+            self._reserved.update(key for key, _ in keys)
+
+        cached = -1
+        for index in reversed(range(len(keys))):
+            if self.has(keys[index][0]):
+                cached = index
+                break
+
+        sep = SINGLE_SEPARATOR if singleline else MULTI_SEPARATOR
+        verbose = "--verbose" if general.get("verbose") else ""
+        cmds = []
+        for index, (key, _) in enumerate(keys):
+            parent = keys[index - 1][0] if index else None
+            if index <= cached:
+                continue
+            layer = self.layer_path(key)
+            # Concurrent builds of the same layer don't share their partial file
+            partial = self.path / f"{key}.{general['name']}.part"
+            if index == 0:
+                parts = [
+                    f"virt-builder",
+                    f"{general['os-name']}-{general['os-version']}",
+                    verbose,
+                    f"--format qcow2",
+                    f"--output {partial}",
+                ]
+                parts.extend(get_option_parts(image, flags=IMAGE_FLAGS))
+                parts.extend(
+                    get_option_parts(config, flags={"update", "selinux-relabel"})
+                )
+            else:
+                cmds.append(
+                    sep.join(
+                        [
+                            f"qemu-img create",
+                            f"-f qcow2",
+                            f"-F qcow2",
+                            f"-b {self.layer_path(parent)}",
+                            f"{partial}",
+                        ]
+                    )
+                )
+                parts = [f"virt-customize", verbose, f"--format qcow2", f"-a {partial}"]
+                parts.extend(get_provision_parts(provision[index - 1 : index]))
+            cmds.append(sep.join(p for p in parts if p))
+            cmds.append(f"mv {partial} {layer}")
+
+        output = get_image_path(data).as_posix()
+        last = self.layer_path(keys[-1][0])
+        convert = f"qemu-img convert -O {general['format']}"
+        if qcow2_options:
+            convert += f" -o {qcow2_options}"
+        cmds.append(f"{convert} {last} {output}")
+        parts = [
+            f"virt-customize",
+            verbose,
+            f"--format {general['format']}",
+            f"-a {output}",
+            f"--hostname {get_hostname(data)}",
+            # The provision steps may have created unlabeled files
+            f"--selinux-relabel" if config.get("selinux-relabel") else "",
+        ]
+        cmds.append(sep.join(p for p in parts if p))
+        return cmds
@@ -0,0 +1,141 @@
+import itertools
+
+from schema import SchemaError
+
+from .utils import load_yaml_all
+from .validator import ValidationMemo, validate_data
+
+CLUSTER_KEYS = {"defaults", "nodes"}
+
+
+def is_cluster(document):
+    """ Return True if ``document`` describes a cluster instead of a single VM """
+    return isinstance(document, dict) and "nodes" in document
+
+
+def merge(base, override):
+    """
+    Return ``override`` merged on top of ``base``.
+
+    Mappings are merged recursively, everything else (including lists) is replaced. The
+    sub-structures of ``base`` that are not overridden are not copied, so the merged
+    definitions share them.
+
+    """
+    if not (isinstance(base, dict) and isinstance(override, dict)):
+        return override
+    merged = dict(base)
+    for key, value in override.items():
+        merged[key] = merge(base[key], value) if key in base else value
+    return merged
+
+
+def walk(obj):
+    """ Yield ``obj`` and all the mappings and lists that it contains """
+    yield obj
+    if isinstance(obj, dict):
+        for value in obj.values():
+            if isinstance(value, (dict, list)):
+                yield from walk(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            if isinstance(value, (dict, list)):
+                yield from walk(value)
+
+
+def check_cluster(document):
+    """ Raise a SchemaError if the structure of a cluster document is not valid """
+    errors = [f"Wrong key '{key}'" for key in document if key not in CLUSTER_KEYS]
+    if not isinstance(document.get("defaults", {}), dict):
+        errors.append("Key 'defaults' error:\nshould be a mapping")
+    nodes = document["nodes"]
+    if not isinstance(nodes, list) or not all(isinstance(n, dict) for n in nodes):
+        errors.append("Key 'nodes' error:\nshould be a list of mappings")
+    if errors:
+        raise SchemaError(errors)
+
+
+def expand(document):
+    """ Lazily yield the definitions of the nodes of a (checked) cluster document """
+    defaults = document.get("defaults", {})
+    for override in document["nodes"]:
+        yield merge(defaults, override)
+
+
+def _add_label(label, exc):
+    """ Return a SchemaError with the errors of ``exc`` prefixed by ``label`` """
+    errors = [error for error in exc.autos if error]
+    if label is not None:
+        errors = [f"{label}: {error}" for error in errors]
+    return SchemaError(errors)
+
+
+def iter_documents(path):
+    """
+    Yield ``(label, data, memo)`` for each VM definition of a (multi-document) file.
+
+    ``label`` identifies the definition in the error messages and it is None for files
+    with a single plain definition. ``memo`` is the ``ValidationMemo`` that is shared
+    by all the nodes of a cluster document, or None for plain definitions.
+
+    """
+    documents = (doc for doc in load_yaml_all(path) if doc is not None)
+    # Peek, in order to find out whether this is a file with a single definition
+    first = list(itertools.islice(documents, 2))
+    if len(first) == 1 and not is_cluster(first[0]):
+        yield None, first[0], None
+        return
+    for index, document in enumerate(itertools.chain(first, documents)):
+        label = f"document {index}"
+        if not is_cluster(document):
+            yield label, document, None
+            continue
+        try:
+            check_cluster(document)
+        except SchemaError as exc:
+            raise _add_label(label, exc) from None
+        memo = ValidationMemo(walk(document.get("defaults", {})))
+        for position, data in enumerate(expand(document)):
+            yield f"{label}, nodes[{position}]", data, memo
+
+
+def iter_definitions(path, definition_cache=None):
+    """
+    Lazily yield the validated definitions of a file.
+
+    The file may contain multiple documents, each of which is either a single VM
+    definition or a cluster, i.e. a mapping with the ``defaults`` of the cluster and a
+    list of per-node overrides under ``nodes``. A SchemaError is raised for the first
+    invalid definition.
+
+    Files with a single plain definition are stored in ``definition_cache``, if one is
+    provided.
+
+    """
+    if definition_cache is not None:
+        data = definition_cache.get(path)
+        if data is not None:
+            yield data
+            return
+    for label, data, memo in iter_documents(path):
+        try:
+            validate_data(data, memo)
+        except SchemaError as exc:
+            raise _add_label(label, exc) from None
+        if label is None and definition_cache is not None:
+            definition_cache.put(path, data)
+        yield data
+
+
+def check_definitions(path):
+    """ Return the validation errors of all the definitions of a file """
+    errors = []
+    try:
+        for label, data, memo in iter_documents(path):
+            try:
+                validate_data(data, memo)
+            except SchemaError as exc:
+                errors.extend(_add_label(label, exc).autos)
+    except SchemaError as exc:
+        errors.extend(exc.autos)
+    return errors
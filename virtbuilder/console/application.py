@@ -1,15 +1,35 @@
-from cleo import Application
+import sys
 
-from .commands import CreateCommand
-from .commands import MultiCommand
-from .commands import RemoveCommand
-from .commands import ValidateCommand
+from .. import __version__
+
+NAME = "virtbuilder"
+VERSION_FLAGS = {"--version", "-V"}
 
 
 def main():
-    application = Application(complete=False)
+    # Answer ``--version`` without importing cleo and the commands, since it is what
+    # scripts call most often in order to check that virtbuilder is installed.
+    if len(sys.argv) == 2 and sys.argv[1] in VERSION_FLAGS:
+        # Same output as cleo, which displays the title-cased name
+        print(f"{NAME.title()} version {__version__}")
+        return 0
+
+    from cleo import Application
+
+    from .commands import CacheCommand
+    from .commands import CreateCommand
+    from .commands import ExportCommand
+    from .commands import MultiCommand
+    from .commands import RemoveCommand
+    from .commands import ServeCommand
+    from .commands import ValidateCommand
+
+    application = Application(NAME, __version__, complete=False)
+    application.add(CacheCommand())
     application.add(CreateCommand())
+    application.add(ExportCommand())
     application.add(MultiCommand())
     application.add(RemoveCommand())
+    application.add(ServeCommand())
     application.add(ValidateCommand())
     application.run()
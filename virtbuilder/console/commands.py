@@ -1,21 +1,53 @@
 import os.path
+import time
 
 from cleo import Command as BaseCommand
 
-from .. import api
-from ..utils import execute_cmd
+from .. import tracing
+
+# The rest of the package is imported by the commands that need it, so that e.g.
+# ``virtbuilder --help`` doesn't have to import ``ruamel.yaml``, ``schema`` etc.
 
 
 def validate_stage(stage):
-    """ Raise a ValueError if ``stage`` is not one of ``api.CREATE_STAGES`` """
-    if stage and stage not in api.CREATE_STAGES:
-        msg = f"'stage' must be one of {api.CREATE_STAGES}, not: {stage}"
+    """ Raise a ValueError if ``stage`` is not a create stage """
+    from .. import api
+
+    stages = api.CREATE_STAGES + [
+        name for name in api.REPLICA_STAGES if name not in api.CREATE_STAGES
+    ]
+    stages.append("wait")
+    if stage and stage not in stages:
+        msg = f"'stage' must be one of {stages}, not: {stage}"
         raise ValueError(msg)
 
 
 class Command(BaseCommand):
     """ Base Command class for our application """
 
+    def start_tracing(self, params):
+        if params.get("trace"):
+            tracing.enable()
+
+    def stop_tracing(self, params):
+        """ Export the trace and print a summary of the traced spans """
+        tracer = tracing.get_tracer()
+        # Commands called by ``multi`` don't own the tracer
+        if tracer is None or not params.get("trace"):
+            return
+        tracing.disable()
+        tracer.export(params["trace"])
+        summary = tracer.get_summary()
+        self.render_table(summary[0], summary[1:])
+        self.line(f"Trace written to: {params['trace']}")
+
+    def load_definitions(self, definition_file):
+        """ Return the validated definitions of a (cluster) definition file """
+        from ..cluster import iter_definitions
+        from ..validator import DefinitionCache
+
+        return list(iter_definitions(definition_file, DefinitionCache()))
+
     def get_parameters(self):
         """ Return command parameters """
         params = {
@@ -34,22 +66,109 @@ class CreateCommand(Command):
         {--stage= : The stage you want to run. Needs to be one of [image,upload,vm]}
         {--no-interactive : The commands will not be displayed before execution}
         {--preview : Preview the commands without executing them}
+        {--cache : Build the image on top of the cached layers}
+        {--force : Execute all the stages, even the ones that are up to date}
+        {--backend=auto : How to talk to libvirt. One of [auto, virsh, libvirt]}
+        {--upload-streams=1 : Upload each image in this many concurrent ranges}
+        {--verify-upload : Download the uploaded volumes again to verify them}
+        {--trace= : Write a Chrome trace of the executed stages to this file}
     """
 
     def handle(self):
+        from .. import api
+        from ..backends import get_backend
+        from ..cache import LayerCache
+        from ..history import History
+        from ..placement import Placer
+        from ..state import StateStore
+        from ..tuning import CpuAllocator
+
         params = self.get_parameters()
         validate_stage(params["stage"])
-        api.validate(params["definition"])
-        cmds = api.get_create_commands(
-            definition_file=params["definition"], stage=params["stage"]
+        backend = get_backend(
+            params["backend"],
+            upload_streams=int(params["upload-streams"]),
+            verify_upload=params["verify-upload"],
         )
-        for cmd in cmds:
-            self.line("\n")
-            self.line(cmd)
-            self.line("\n")
+        placer = Placer()
+        definitions = self.load_definitions(params["definition"])
+        store = StateStore()
+        cache = LayerCache() if params["cache"] else None
+        allocator = CpuAllocator()
+        history = History()
+        self.start_tracing(params)
+        try:
+            for data in definitions:
+                # A definition that ``multi --host-pool`` has placed stays on its host
+                data = placer.locate(data)
+                # The base image is created first, followed by its replicas (if any)
+                for node in api.expand_replicas(data):
+                    stage = params["stage"]
+                    if stage and stage not in api.get_stages(node):
+                        continue
+                    node = allocator.allocate(node)
+                    self.create_node(
+                        node, params, store, backend, cache, history, allocator
+                    )
+        finally:
+            backend.close()
+            self.stop_tracing(params)
+
+    def create_node(self, data, params, store, backend, cache, history, allocator):
+        from .. import api
+        from .. import scheduler
+        from .. import state
+        from ..history import get_features
+
+        fingerprints = state.get_fingerprints(data)
+        stages = api.get_create_stages(data, stage=params["stage"], cache=cache)
+        # An explicitly requested stage is always executed
+        if not (params["stage"] or params["force"]):
+            outdated = store.get_outdated_stages(data, fingerprints)
+            for name, _ in stages:
+                if name not in outdated:
+                    self.line(f"<comment>Skipping {name}: up to date</>")
+            stages = [(name, cmds) for name, cmds in stages if name in outdated]
+        self.print_prediction(data, stages, history)
+        for name, cmds in stages:
+            for cmd in cmds:
+                self.line("\n")
+                self.line(cmd)
+                self.line("\n")
             if not params["preview"]:
                 self.ask("Press Enter to Continue")
-                execute_cmd(cmd)
+                started = time.monotonic()
+                if name == "image" and cache is not None:
+                    cache.prepare(data)
+                elif name == "vm":
+                    allocator.claim(data)
+                scheduler.run_stage(backend, data, name, cmds)
+                store.record(data, name, fingerprints[name])
+                duration = time.monotonic() - started
+                history.record(
+                    data["general"]["name"], name, get_features(data, name), duration
+                )
+                if name == "wait":
+                    host = backend.poller.hosts[data["general"]["name"]]
+                    self.line(f"<c1>Ready at: {host['ansible_host']}</>")
+
+    def print_prediction(self, data, stages, history):
+        """ Print how long the ``stages`` of ``data`` are expected to take """
+        from .. import scheduler
+        from ..history import get_features, predict
+
+        plan = scheduler.Plan()
+        node = data["general"]["name"]
+        deps = []
+        # The stages are executed one after the other
+        for name, _ in stages:
+            meta = {"features": get_features(data, name)}
+            plan.add(scheduler.Task(node, name, None, deps, meta=meta))
+            deps = [(node, name)]
+        prediction = predict(plan, history)
+        if prediction is not None:
+            for line in prediction.format():
+                self.line(f"<comment>{line}</>")
 
 
 class RemoveCommand(Command):
@@ -60,19 +179,42 @@ class RemoveCommand(Command):
         {definition : The yaml file with the image configuration}
         {--stage= : The stage you want to run. Needs to be one of [image,upload,vm]}
         {--preview : Preview the commands without executing them}
+        {--backend=auto : How to talk to libvirt. One of [auto, virsh, libvirt]}
     """
 
     def handle(self):
+        from .. import api
+        from .. import export
+        from ..backends import get_backend
+        from ..placement import Placer
+        from ..state import StateStore
+        from ..tuning import CpuAllocator
+
         params = self.get_parameters()
-        api.validate(params["definition"])
-        cmds = api.get_remove_commands(definition_file=params["definition"])
-        for cmd in cmds:
-            self.line("\n")
-            self.line(cmd)
-            self.line("\n")
-            if not params["preview"]:
-                self.ask("Press Enter to Continue")
-                execute_cmd(cmd)
+        placer = Placer()
+        for data in self.load_definitions(params["definition"]):
+            data = placer.locate(data)
+            cmds = api._get_remove_commands(data)
+            for cmd in cmds:
+                self.line("\n")
+                self.line(cmd)
+                self.line("\n")
+            if params["preview"]:
+                continue
+            self.ask("Press Enter to Continue")
+            backend = get_backend(params["backend"])
+            try:
+                backend.remove(data)
+            finally:
+                backend.close()
+            for node in api.expand_replicas(data):
+                StateStore().clear(node)
+                export.clear_stamps(node)
+                CpuAllocator().release(node)
+            placer.release(data)
+
+
+MULTI_COMMANDS = ("create", "remove", "start", "stop", "reboot")
 
 
 class MultiCommand(Command):
@@ -80,29 +222,387 @@ class MultiCommand(Command):
     Execute <c1>command</> on multiple <c1>definitions</>.
 
     multi
-        {command : The action we want to perform. Needs to be one of {"create", "remove}.}
+        {command : The action to perform: create, remove, start, stop or reboot}
         {definitions* : The definition files for the VMs}
+        {--parallel : Run the stages/actions of all the definitions concurrently}
+        {--fail-fast : With --parallel, stop all the stages as soon as one fails}
+        {--jobs=4 : The maximum number of concurrently running stages}
+        {--image-jobs=1 : The maximum number of concurrently running image stages}
+        {--upload-jobs=2 : The maximum number of concurrently running upload stages}
+        {--reserve-memory=1G : With --parallel, the memory to keep free for the host}
+        {--no-admission : With --parallel, don't wait for free host resources}
+        {--cache : Build the images on top of the cached layers}
+        {--force : Execute all the stages, even the ones that are up to date}
+        {--resume : Skip the stages that the last create run has completed}
+        {--inventory= : Write an Ansible inventory of the VMs with a wait stage}
+        {--host-pool= : Place the new definitions on the hosts of this YAML file}
+        {--retries=2 : With --parallel or --resume, retry failed upload/volume stages}
+        {--retry-backoff=5 : The seconds before the first retry, doubled every time}
+        {--backend=auto : How to talk to libvirt. One of [auto, virsh, libvirt]}
+        {--upload-streams=1 : Upload each image in this many concurrent ranges}
+        {--verify-upload : Download the uploaded volumes again to verify them}
+        {--trace= : Write a Chrome trace of the executed stages to this file}
     """
 
     def handle(self):
         params = self.get_parameters()
         command = params["command"]
-        if command not in {"create", "remove"}:
-            msg = "command needs to be in {'create', 'remove'}, not: {command}"
+        if command not in MULTI_COMMANDS:
+            msg = f"command needs to be one of {MULTI_COMMANDS}, not: {command}"
             raise ValueError(msg)
+        self.start_tracing(params)
+        try:
+            return self.handle_command(params)
+        finally:
+            self.stop_tracing(params)
+
+    def handle_command(self, params):
+        """ Dispatch the command to the parallel, lifecycle or sequential runner """
+        command = params["command"]
+        # The journal, the inventory and the placement need the create plans
+        plan_options = ("parallel", "resume", "inventory", "host-pool")
+        if command == "create" and any(params[option] for option in plan_options):
+            return self.handle_parallel(params)
+        if params["parallel"] or command not in {"create", "remove"}:
+            return self.handle_lifecycle(params)
         for definition in params["definitions"]:
+            if command == "create":
+                for option in ("cache", "force", "verify-upload"):
+                    if params[option]:
+                        definition += f" --{option}"
+                definition += f" --upload-streams {params['upload-streams']}"
+            definition += f" --backend {params['backend']}"
             self.call(command, definition)
 
+    def handle_parallel(self, params):
+        """
+        Run the create stages of all the definitions as a DAG.
+
+        Without --parallel (e.g. with --resume) the stages are executed one at a time.
+        The outcome of every stage is recorded in the journal of the run.
+
+        """
+        from .. import scheduler
+        from ..backends import get_backend
+        from ..cache import LayerCache
+        from ..engine import Engine
+        from ..history import History, predict
+        from ..journal import Journal
+        from ..placement import Placer, load_host_pool
+        from ..readiness import write_inventory
+        from ..resources import HostBudget
+        from ..state import StateStore
+        from ..validator import DefinitionCache
+
+        budget = None
+        if not params["no-admission"]:
+            budget = HostBudget(reserve_memory=params["reserve-memory"])
+        backend = get_backend(
+            params["backend"],
+            upload_streams=int(params["upload-streams"]),
+            verify_upload=params["verify-upload"],
+        )
+        try:
+            hosts = None
+            if params["host-pool"]:
+                hosts = load_host_pool(params["host-pool"])
+            placer = Placer(hosts=hosts, backend=backend)
+            journal = Journal()
+            completed = None
+            if params["resume"]:
+                completed = journal.get_completed()
+                self.line(
+                    f"<comment>Resuming after {len(completed)} completed stages</>"
+                )
+            else:
+                journal.reset()
+            retries = int(params["retries"])
+            history = History()
+            engine = Engine(
+                backend=backend,
+                jobs=int(params["jobs"]) if params["parallel"] else 1,
+                limits={
+                    "image": int(params["image-jobs"]),
+                    "upload": int(params["upload-jobs"]),
+                },
+                fail_fast=params["fail-fast"],
+                budget=budget,
+                retries={stage: retries for stage in scheduler.RETRY_STAGES},
+                backoff=float(params["retry-backoff"]),
+                journal=journal,
+                history=history,
+            )
+            plan = scheduler.get_create_plan(
+                params["definitions"],
+                cache=LayerCache() if params["cache"] else None,
+                store=None if params["force"] else StateStore(),
+                backend=backend,
+                definition_cache=DefinitionCache(),
+                run=engine.run_stage,
+                completed=completed,
+                placer=placer,
+            )
+            prediction = predict(plan, history, jobs=engine.jobs, limits=engine.limits)
+            if prediction is not None:
+                for line in prediction.format():
+                    self.line(f"<comment>{line}</>")
+            failed = engine.run(plan)
+        finally:
+            backend.close()
+        if params["inventory"]:
+            write_inventory(params["inventory"], backend.poller.hosts)
+            self.line(f"Inventory written to: {params['inventory']}")
+        return self.report(plan, failed)
+
+    def handle_lifecycle(self, params):
+        """ Perform a lifecycle action on all the nodes, see --parallel """
+        from .. import export
+        from .. import scheduler
+        from ..backends import get_backend
+        from ..placement import Placer
+        from ..state import StateStore
+        from ..tuning import CpuAllocator
+        from ..validator import DefinitionCache
+
+        command = params["command"]
+        placer = Placer()
+        store = StateStore()
+        allocator = CpuAllocator()
+
+        def forget(data):
+            store.clear(data)
+            export.clear_stamps(data)
+            allocator.release(data)
+            placer.release(data)
+
+        on_success = forget if command == "remove" else None
+
+        # A single connection per URI is shared by all the threads
+        backend = get_backend(params["backend"])
+        try:
+            plan = scheduler.get_lifecycle_plan(
+                params["definitions"],
+                command,
+                backend=backend,
+                definition_cache=DefinitionCache(),
+                on_success=on_success,
+                placer=placer,
+            )
+            jobs = int(params["jobs"]) if params["parallel"] else 1
+            failed = scheduler.Scheduler(jobs=jobs).run(plan)
+        finally:
+            backend.close()
+        return self.report(plan, failed)
+
+    def report(self, plan, failed):
+        for task in failed:
+            self.line(f"<error>{task.node}/{task.stage} failed: {task.error}</>")
+        for task in plan.skipped:
+            self.line(f"<comment>{task.node}/{task.stage} skipped</>")
+        if failed or plan.skipped:
+            return 1
+        self.line("<c1>OK!</>")
+
+
+class ServeCommand(Command):
+    """
+    Execute create/remove/start/stop/reboot jobs that are submitted over HTTP.
+
+    serve
+        {--socket= : The Unix socket to listen on. Defaults to .virtbuilder/serve.sock}
+        {--port= : Listen on this TCP port of --host instead of a Unix socket}
+        {--host=127.0.0.1 : The loopback address to listen on, with --port}
+        {--jobs=4 : The maximum number of concurrently running stages}
+        {--image-jobs=1 : The maximum number of concurrently running image stages}
+        {--upload-jobs=2 : The maximum number of concurrently running upload stages}
+        {--reserve-memory=1G : The memory to keep free for the host}
+        {--no-admission : Don't wait for free host resources}
+        {--backend=auto : How to talk to libvirt. One of [auto, virsh, libvirt]}
+        {--upload-streams=1 : Upload each image in this many concurrent ranges}
+        {--verify-upload : Download the uploaded volumes again to verify them}
+    """
+
+    def handle(self):
+        import signal
+
+        from .. import server
+        from ..backends import get_backend
+        from ..engine import write_line
+        from ..resources import HostBudget
+
+        params = self.get_parameters()
+        budget = None
+        if not params["no-admission"]:
+            budget = HostBudget(reserve_memory=params["reserve-memory"])
+        backend = get_backend(
+            params["backend"],
+            upload_streams=int(params["upload-streams"]),
+            verify_upload=params["verify-upload"],
+        )
+        runner = server.JobRunner(
+            backend,
+            jobs=int(params["jobs"]),
+            limits={
+                "image": int(params["image-jobs"]),
+                "upload": int(params["upload-jobs"]),
+            },
+            budget=budget,
+            output=write_line,
+        )
+        queue = server.JobQueue()
+        port = int(params["port"]) if params["port"] else None
+        http_server = server.make_server(
+            queue,
+            socket_path=params["socket"],
+            host=params["host"],
+            port=port,
+            output=write_line,
+        )
+        address = http_server.server_address
+        if port is not None:
+            address = f"http://{address[0]}:{address[1]}"
+        self.line(f"<c1>Listening on: {address}</>")
+        # Stop like on Ctrl-C, i.e. cancel the running stages and remove the socket
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        try:
+            server.serve(http_server, queue, runner)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            backend.close()
+
 
 class ValidateCommand(Command):
     """
-    Validate the definition file.
+    Validate the definition files.
 
     validate
-        {definition : The yaml file with the image/VM definition}
+        {definitions* : The yaml files with the image/VM definitions}
+        {--jobs= : The number of processes to use. Defaults to the number of CPUs}
     """
 
     def handle(self):
+        from .. import validator
+
         params = self.get_parameters()
-        api.validate(params["definition"])
+        jobs = int(params["jobs"]) if params["jobs"] else None
+        results = validator.check_files(
+            params["definitions"], jobs=jobs, cache=validator.DefinitionCache()
+        )
+        failed = 0
+        for path, errors in results.items():
+            if errors:
+                failed += 1
+                self.line(f"<error>{path}:</>")
+                for error in errors:
+                    self.line(f"  {error}")
+            elif len(results) > 1:
+                self.line(f"{path}: <c1>OK</>")
+        if failed:
+            return 1
         self.line("<c1>OK!</>")
+
+
+class ExportCommand(Command):
+    """
+    Export the create stages of the <c1>definitions</> as a Makefile or a Ninja file.
+
+    export
+        {definitions* : The definition files for the VMs}
+        {--format=make : The format of the build file. One of [make, ninja]}
+        {--output= : The path of the build file. Defaults to Makefile/build.ninja}
+        {--image-jobs=1 : The maximum number of concurrently running image stages}
+        {--upload-jobs=2 : The maximum number of concurrently running upload stages}
+        {--cache : Build the images on top of the cached layers}
+    """
+
+    def handle(self):
+        from .. import export
+        from ..cache import LayerCache
+        from ..placement import Placer
+        from ..validator import DefinitionCache
+
+        params = self.get_parameters()
+        build_format = params["format"]
+        if build_format not in export.FORMATS:
+            msg = f"'format' must be one of {export.FORMATS}, not: {build_format}"
+            raise ValueError(msg)
+        targets = export.get_targets(
+            params["definitions"],
+            cache=LayerCache() if params["cache"] else None,
+            definition_cache=DefinitionCache(),
+            placer=Placer(),
+        )
+        contents = export.export(
+            targets,
+            build_format=build_format,
+            limits={
+                "image": int(params["image-jobs"]),
+                "upload": int(params["upload-jobs"]),
+            },
+        )
+        output = params["output"] or export.DEFAULT_OUTPUTS[build_format]
+        with open(output, "w") as fd:
+            fd.write(contents)
+        self.line(f"<c1>{len(targets)} stages written to: {output}</>")
+
+
+class CacheCommand(Command):
+    """
+    Manage the layered image cache and the mirror of the virt-builder templates.
+
+    cache
+        {action : The action we want to perform. Needs to be one of [ls, prune, warm].}
+        {definitions?* : The definition files whose templates should be mirrored}
+        {--budget= : The maximum size of the cache, e.g. 20G}
+        {--mirror= : The directory of the template mirror}
+        {--index-url= : The index of the upstream virt-builder repository}
+        {--jobs=4 : The maximum number of concurrent downloads}
+    """
+
+    def handle(self):
+        from ..cache import DEFAULT_BUDGET, LayerCache
+
+        params = self.get_parameters()
+        action = params["action"]
+        if action not in {"ls", "prune", "warm"}:
+            msg = f"action needs to be in {{'ls', 'prune', 'warm'}}, not: {action}"
+            raise ValueError(msg)
+        if action == "warm":
+            return self.handle_warm(params)
+        cache = LayerCache(budget=params["budget"] or DEFAULT_BUDGET)
+        if action == "ls":
+            for meta in cache.entries():
+                last_used = time.strftime(
+                    "%Y-%m-%d %H:%M", time.localtime(meta["last_used"])
+                )
+                size = meta["size"] / 1024 ** 2
+                key, description = meta["key"][:12], meta["description"]
+                self.line(f"{key}  {last_used}  {size:10.1f}M  {description}")
+        else:
+            for key in cache.prune():
+                self.line(f"Evicted: {key}")
+
+    def handle_warm(self, params):
+        """ Download the templates of the definitions into the local mirror """
+        from .. import mirror
+        from ..cluster import iter_definitions
+        from ..validator import DefinitionCache
+
+        definition_cache = DefinitionCache()
+        definitions = (
+            data
+            for definition_file in params["definitions"]
+            for data in iter_definitions(definition_file, definition_cache)
+        )
+        template_mirror = mirror.TemplateMirror(
+            path=params["mirror"],
+            index_url=params["index-url"] or mirror.DEFAULT_INDEX_URL,
+        )
+        templates = mirror.get_templates(definitions)
+        for (name, arch), downloaded in template_mirror.warm(
+            templates, jobs=int(params["jobs"])
+        ):
+            status = "downloaded" if downloaded else "up to date"
+            self.line(f"{name} ({arch}): {status}")
+        self.line(f"Use it with the image option: source: {template_mirror.uri}")
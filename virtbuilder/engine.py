@@ -0,0 +1,239 @@
+import asyncio
+import collections
+import os
+import re
+import signal
+import subprocess
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import tracing
+from .backends import VirshBackend
+from .scheduler import RETRY_BACKOFF, Scheduler
+from .utils import split_cmd, write_line
+
+CHUNK_SIZE = 64 * 1024
+MAX_LINE = 4096
+TAIL_LINES = 20
+KILL_TIMEOUT = 5
+
+_NEWLINES = re.compile(rb"[\r\n]")
+
+
+def kill_process_group(process, sig=signal.SIGTERM):
+    try:
+        os.killpg(process.pid, sig)
+    except ProcessLookupError:
+        pass
+
+
+class Engine(Scheduler):
+    """
+    Run a ``Plan`` of coroutines on an asyncio event loop.
+
+    The commands of the stages are executed concurrently and their stdout/stderr are
+    streamed line by line to ``output``, prefixed with ``[node/stage]``. Each command
+    runs in a new session, so that its whole process group (e.g. the ``qemu``
+    processes of ``virt-builder``) can be killed if the task gets cancelled.
+
+    If ``fail_fast`` is True, the first failure cancels all the running tasks and
+    skips the pending ones.
+
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        jobs=4,
+        limits=None,
+        output=write_line,
+        fail_fast=False,
+        max_line=MAX_LINE,
+        budget=None,
+        retries=None,
+        backoff=RETRY_BACKOFF,
+        journal=None,
+        history=None,
+    ):
+        super().__init__(
+            jobs=jobs,
+            limits=limits,
+            budget=budget,
+            retries=retries,
+            backoff=backoff,
+            journal=journal,
+            history=history,
+        )
+        self.backend = backend or VirshBackend()
+        self.output = output
+        self.fail_fast = fail_fast
+        self.max_line = max_line
+        # The processes of the running commands, and the threads that reap them
+        self._processes = set()
+        self._reaper = None
+
+    def _emit(self, prefix, line, tail):
+        text = line.decode(errors="replace")
+        tail.append(text)
+        self.output(f"[{prefix}] {text}")
+
+    async def _pump(self, stream, prefix, tail):
+        """ Stream the lines of ``stream``, splitting the ones that are too long """
+        pending = b""
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            *lines, pending = _NEWLINES.split(pending + chunk)
+            while len(pending) > self.max_line:
+                lines.append(pending[: self.max_line])
+                pending = pending[self.max_line :]
+            for line in lines:
+                if line:
+                    self._emit(prefix, line, tail)
+        if pending:
+            self._emit(prefix, pending, tail)
+
+    async def _open_reader(self, pipe):
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), pipe
+        )
+        return reader, transport
+
+    async def run_cmd(self, cmd, prefix, span=None):
+        """
+        Execute ``cmd`` and raise a ``CalledProcessError`` if it fails.
+
+        The process is reaped with ``os.wait4()`` in a thread (instead of the child
+        watcher of asyncio), so that its resource usage can be added to ``span``.
+
+        """
+        argv = split_cmd(cmd)
+        process = subprocess.Popen(
+            argv,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            start_new_session=True,
+        )
+        self._processes.add(process)
+        loop = asyncio.get_event_loop()
+        reaped = loop.run_in_executor(self._reaper, os.wait4, process.pid, 0)
+        transports = []
+        # The last lines of the output, for the error message
+        tail = collections.deque(maxlen=TAIL_LINES)
+        try:
+            readers = []
+            for pipe in (process.stdout, process.stderr):
+                reader, transport = await self._open_reader(pipe)
+                readers.append(reader)
+                transports.append(transport)
+            await asyncio.gather(*(self._pump(r, prefix, tail) for r in readers))
+            _, status, rusage = await asyncio.shield(reaped)
+        except BaseException:
+            kill_process_group(process)
+            try:
+                await asyncio.wait_for(asyncio.shield(reaped), KILL_TIMEOUT)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                kill_process_group(process, signal.SIGKILL)
+            raise
+        finally:
+            for transport in transports:
+                transport.close()
+            self._processes.discard(process)
+        returncode = (
+            -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        )
+        # So that the Popen object doesn't try to reap the process again
+        process.returncode = returncode
+        if span is not None:
+            span.add_rusage(rusage)
+        if returncode:
+            raise subprocess.CalledProcessError(
+                returncode, argv, stderr="\n".join(tail)
+            )
+
+    async def run_stage(self, data, stage, cmds, on_success=None):
+        """ The asyncio counterpart of ``scheduler.run_stage`` """
+        name = data["general"]["name"]
+        with tracing.span(f"{name}/{stage}", node=name, stage=stage) as span:
+            if self.backend.runs_commands(stage):
+                for cmd in cmds:
+                    # The thread of the loop is shared by all the coroutines, so the
+                    # resource usage is recorded on the span of the task itself
+                    await self.run_cmd(cmd, f"{name}/{stage}", span=span)
+            elif stage == "wait":
+                # The VMs are polled by a single thread of the backend
+                address = await asyncio.wrap_future(self.backend.wait(data))
+                self.output(f"[{name}/{stage}] ready at {address}")
+            else:
+                # The libvirt calls are blocking, so they run in a thread
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(
+                    None, self.backend.run_stage, data, stage, cmds
+                )
+        if on_success is not None:
+            on_success()
+
+    async def _cancel(self, running):
+        for future in running:
+            future.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    async def run_plan(self, plan):
+        """ Execute the ``plan`` and return the list of the failed tasks """
+        running = {}
+        try:
+            while True:
+                for task in plan.ready():
+                    if self.is_full(task, running.values()):
+                        continue
+                    if self.has_capacity(task, running.values()):
+                        self.start(task)
+                        running[asyncio.ensure_future(task.action())] = task
+                delay = plan.get_delay()
+                if not running:
+                    if delay is None:
+                        break
+                    await asyncio.sleep(delay)
+                    continue
+                done, _ = await asyncio.wait(
+                    running, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    self.finish(plan, running.pop(future), future.exception())
+                if self.fail_fast and plan.failed:
+                    await self._cancel(running)
+                    for task in running.values():
+                        plan.finish(task, asyncio.CancelledError("cancelled"))
+                    running.clear()
+                    plan.skip_pending()
+        finally:
+            if running:
+                await self._cancel(running)
+        plan.skip_pending()
+        return plan.failed
+
+    def run(self, plan):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        # A task runs one command at a time, so ``jobs`` threads are enough and the
+        # blocked ones don't hold up the stages that run in the default executor
+        self._reaper = ThreadPoolExecutor(self.jobs, thread_name_prefix="reap")
+        main = asyncio.ensure_future(self.run_plan(plan))
+        try:
+            return loop.run_until_complete(main)
+        except BaseException:
+            # E.g. a KeyboardInterrupt, which stops the loop while the stages are still
+            # running. Cancelling run_plan() cancels them and kills their commands.
+            main.cancel()
+            loop.run_until_complete(asyncio.gather(main, return_exceptions=True))
+            raise
+        finally:
+            for process in self._processes:
+                kill_process_group(process, signal.SIGKILL)
+            self._reaper.shutdown(wait=False)
+            loop.close()
+            asyncio.set_event_loop(None)
@@ -0,0 +1,228 @@
+import os.path
+import shlex
+import shutil
+
+from . import api
+from . import state
+from .cache import get_referenced_paths
+from .cluster import iter_definitions
+from .tuning import CpuAllocator
+from .utils import get_state_dir, split_cmd
+
+FORMATS = ("make", "ninja")
+DEFAULT_OUTPUTS = {"make": "Makefile", "ninja": "build.ninja"}
+HEADER = (
+    "# Generated by `virtbuilder export`. Do not edit.\n"
+    "# Execute it from the directory it was generated in.\n"
+)
+
+
+class Target(object):
+    """ A create stage of a node, as a target of a build file """
+
+    def __init__(self, node, stage, cmds, deps, inputs):
+        self.node = node
+        self.stage = stage
+        # Shell commands with properly quoted arguments
+        self.cmds = cmds
+        # The stamps of the stages that this one depends on
+        self.deps = deps
+        # The files that invalidate this stage when they change
+        self.inputs = inputs
+
+    @property
+    def output(self):
+        return get_stamp_path(self.node, self.stage)
+
+
+def get_stamp_path(node, stage):
+    return get_state_dir("stamps", node, f"{stage}.stamp").as_posix()
+
+
+def get_fingerprint_path(node, stage):
+    return get_state_dir("stamps", node, f"{stage}.fingerprint").as_posix()
+
+
+def quote_cmd(cmd):
+    """ Return ``cmd`` with each of the arguments that are executed properly quoted """
+    return " ".join(shlex.quote(arg) for arg in split_cmd(cmd))
+
+
+def get_image_references(data):
+    """ Return the existing local files that are referenced by the image options """
+    config = data["image"].get("config", {})
+    options = [(key, value) for key, value in config.items() if key != "provision"]
+    for item in config.get("provision", []):
+        options.extend(item.items())
+    paths = []
+    for key, value in options:
+        paths.extend(
+            path for path in get_referenced_paths(key, value) if os.path.exists(path)
+        )
+    return paths
+
+
+def write_fingerprint(node, stage, fingerprint):
+    """
+    Write the fingerprint of a stage, unless it is unchanged.
+
+    The fingerprint files are prerequisites of the stamps, so their modification time
+    must only change when the inputs of the stage change.
+
+    """
+    path = get_fingerprint_path(node, stage)
+    if os.path.exists(path):
+        with open(path) as fd:
+            if fd.read() == fingerprint:
+                return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as fd:
+        fd.write(fingerprint)
+    return path
+
+
+def get_targets(
+    definition_files, cache=None, definition_cache=None, allocator=None, placer=None
+):
+    """
+    Return the ``Target`` objects of all the create stages of ``definition_files``.
+
+    The fingerprints of the stages are written next to the stamps, so that only the
+    stages whose inputs have changed since the last export are considered stale. If a
+    ``placement.Placer`` is provided, the definitions target the hosts that they have
+    been placed on. The layers of a ``cache`` are registered right away, since the
+    build file creates them without going through ``cache.LayerCache.prepare``.
+
+    """
+    targets = []
+    allocator = allocator or CpuAllocator()
+    definitions = (
+        data
+        for definition_file in definition_files
+        for data in iter_definitions(definition_file, definition_cache)
+    )
+    if placer is not None:
+        definitions = (placer.locate(data) for data in definitions)
+    nodes = (
+        allocator.allocate(node)
+        for data in definitions
+        for node in api.expand_replicas(data)
+    )
+    for data in nodes:
+        node = data["general"]["name"]
+        fingerprints = state.get_fingerprints(data)
+        dependencies = api.get_stage_dependencies(data)
+        node_dependencies = api.get_node_dependencies(data)
+        stages = api.get_create_stages(data, cache=cache)
+        if cache is not None and any(stage == "image" for stage, _ in stages):
+            cache.prepare(data)
+        for stage, cmds in stages:
+            cmds = [quote_cmd(cmd) for cmd in cmds]
+            if any("\n" in cmd for cmd in cmds):
+                msg = f"{node}/{stage}: arguments with newlines can't be exported"
+                raise ValueError(msg)
+            inputs = [write_fingerprint(node, stage, fingerprints[stage])]
+            if stage == "image":
+                inputs.extend(get_image_references(data))
+            deps = [get_stamp_path(node, dep) for dep in dependencies[stage]]
+            deps.extend(
+                get_stamp_path(*key) for key in node_dependencies.get(stage, [])
+            )
+            targets.append(
+                Target(
+                    node=node,
+                    stage=stage,
+                    cmds=cmds,
+                    deps=deps,
+                    inputs=inputs,
+                )
+            )
+    return targets
+
+
+def clear_stamps(data):
+    """ Remove the stamps of a node, e.g. after its VM has been removed """
+    shutil.rmtree(get_state_dir("stamps", data["general"]["name"]), ignore_errors=True)
+
+
+def _get_nodes(targets):
+    nodes = {}
+    for target in targets:
+        nodes.setdefault(target.node, []).append(target.output)
+    return nodes
+
+
+def _escape_make(path):
+    return path.replace("$", "$$").replace(" ", "\\ ")
+
+
+def to_makefile(targets):
+    """ Return a Makefile that executes the ``targets`` """
+    nodes = _get_nodes(targets)
+    lines = [HEADER, f".PHONY: all {' '.join(nodes)}", f"all: {' '.join(nodes)}", ""]
+    for node, outputs in nodes.items():
+        lines.append(f"{node}: {' '.join(_escape_make(path) for path in outputs)}")
+    lines.append("")
+    for target in targets:
+        prerequisites = " ".join(
+            _escape_make(path) for path in target.inputs + target.deps
+        )
+        lines.append(f"{_escape_make(target.output)}: {prerequisites}")
+        for cmd in target.cmds:
+            lines.append(f"\t{cmd.replace('$', '$$')}")
+        lines.append(f"\ttouch {shlex.quote(target.output).replace('$', '$$')}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _escape_ninja(path):
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+
+def to_ninja(targets, limits=None):
+    """
+    Return a Ninja file that executes the ``targets``.
+
+    ``limits`` maps stages to the maximum number of their concurrently running
+    commands and it is implemented using Ninja pools.
+
+    """
+    limits = limits or {}
+    nodes = _get_nodes(targets)
+    lines = [HEADER, "ninja_required_version = 1.1", ""]
+    for stage, depth in limits.items():
+        lines.extend([f"pool {stage}", f"  depth = {depth}", ""])
+    lines.extend(
+        [
+            "rule stage",
+            "  command = $cmd && touch $out",
+            "  description = $node/$stage",
+            "",
+        ]
+    )
+    for target in targets:
+        inputs = " ".join(_escape_ninja(path) for path in target.inputs + target.deps)
+        cmd = " && ".join(target.cmds).replace("$", "$$")
+        lines.append(f"build {_escape_ninja(target.output)}: stage {inputs}")
+        lines.append(f"  cmd = {cmd}")
+        lines.append(f"  node = {target.node}")
+        lines.append(f"  stage = {target.stage}")
+        if target.stage in limits:
+            lines.append(f"  pool = {target.stage}")
+        lines.append("")
+    for node, outputs in nodes.items():
+        outputs = " ".join(_escape_ninja(path) for path in outputs)
+        lines.append(f"build {node}: phony {outputs}")
+    lines.append(f"build all: phony {' '.join(nodes)}")
+    lines.append("default all")
+    lines.append("")
+    return "\n".join(lines)
+
+
+def export(targets, build_format="make", limits=None):
+    """ Return the contents of a build file of ``build_format`` """
+    if build_format not in FORMATS:
+        raise ValueError(f"format must be one of {FORMATS}, not: {build_format}")
+    if build_format == "make":
+        return to_makefile(targets)
+    return to_ninja(targets, limits=limits)
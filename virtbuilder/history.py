@@ -0,0 +1,185 @@
+import contextlib
+import pathlib
+import sqlite3
+import statistics
+import time
+
+from .utils import get_state_dir, parse_size
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS timings (
+    time REAL NOT NULL,
+    node TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL NOT NULL,
+    template TEXT,
+    size INTEGER,
+    packages INTEGER,
+    provision INTEGER,
+    format TEXT,
+    uri TEXT
+);
+CREATE INDEX IF NOT EXISTS timings_stage ON timings (stage, template);
+"""
+
+FEATURES = ("template", "size", "packages", "provision", "format", "uri")
+# The features that must match, from the most to the least specific estimate
+MATCH_LEVELS = [
+    ("template", "packages", "provision", "format", "uri"),
+    ("template", "format", "uri"),
+    ("template",),
+    (),
+]
+# The stages whose duration is proportional to the size of the image
+SIZED_STAGES = {"image", "upload"}
+# The number of recent timings that an estimate is based on
+SAMPLE_SIZE = 20
+
+
+def get_features(data, stage):
+    """ Return the properties of ``data`` that drive the duration of ``stage`` """
+    general = data["general"]
+    image = data["image"]
+    if stage == "customize":
+        provision = data["replica"]["provision"]
+    elif stage == "image":
+        provision = image.get("config", {}).get("provision", [])
+    else:
+        provision = []
+    return {
+        "template": f"{general['os-name']}-{general['os-version']}",
+        "size": parse_size(image["size"]),
+        "packages": sum(len(item.get("install", [])) for item in provision),
+        "provision": len(provision),
+        "format": general["format"],
+        "uri": general["uri"],
+    }
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+class History(object):
+    """
+    A SQLite database with the durations of the executed create stages.
+
+    Every stage that finishes is recorded together with the features of its node that
+    drive its duration (see ``get_features``). The estimate of a stage is the median of
+    the recent successful runs of the same stage with the most similar features,
+    scaled by the size of the image for the stages that copy it.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path) if path else get_state_dir("history.sqlite3")
+
+    @contextlib.contextmanager
+    def connect(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(str(self.path))
+        try:
+            connection.executescript(SCHEMA)
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def record(self, node, stage, features, duration, status="done"):
+        values = [time.time(), node, stage, status, duration]
+        values.extend(features[key] for key in FEATURES)
+        columns = ", ".join(("time", "node", "stage", "status", "duration") + FEATURES)
+        placeholders = ", ".join("?" * len(values))
+        with self.connect() as connection:
+            connection.execute(
+                f"INSERT INTO timings ({columns}) VALUES ({placeholders})", values
+            )
+
+    def estimate(self, stage, features):
+        """ Return the predicted duration of ``stage`` in seconds or None """
+        with self.connect() as connection:
+            for keys in MATCH_LEVELS:
+                conditions = "".join(f" AND {key} = ?" for key in keys)
+                rows = connection.execute(
+                    "SELECT duration, size FROM timings"
+                    f" WHERE stage = ? AND status = 'done'{conditions}"
+                    " AND duration > 0 ORDER BY time DESC LIMIT ?",
+                    [stage] + [features[key] for key in keys] + [SAMPLE_SIZE],
+                ).fetchall()
+                if not rows:
+                    continue
+                if stage in SIZED_STAGES and features["size"]:
+                    # The median throughput, rather than the median duration
+                    rate = statistics.median(size / duration for duration, size in rows)
+                    return features["size"] / rate
+                return statistics.median(duration for duration, _ in rows)
+        return None
+
+
+class Prediction(object):
+    """ The predicted duration of a ``Plan`` """
+
+    def __init__(self, duration, critical_path, unknown):
+        self.duration = duration
+        # The keys of the tasks whose dependency chain takes the longest
+        self.critical_path = critical_path
+        # The keys of the tasks without any history
+        self.unknown = unknown
+
+    def format(self):
+        path = " -> ".join(f"{node}/{stage}" for node, stage in self.critical_path)
+        lines = [
+            f"Predicted duration: {format_duration(self.duration)}",
+            f"Critical path: {path}",
+        ]
+        if self.unknown:
+            lines.append(f"No history for {len(self.unknown)} stages")
+        return lines
+
+
+def predict(plan, history, jobs=1, limits=None):
+    """
+    Return the ``Prediction`` of ``plan``, using the ``features`` of its tasks, or
+    None if none of its stages has any history.
+
+    The duration is the longest of the critical path of the plan and of the time it
+    takes to execute all the stages with ``jobs`` concurrent tasks (or with the stage
+    ``limits``), assuming that these are kept busy. The stages without any history
+    count as instantaneous.
+
+    """
+    limits = limits or {}
+    estimates = {}
+    unknown = []
+    for key, task in plan.tasks.items():
+        features = task.meta.get("features")
+        estimate = history.estimate(task.stage, features) if features else None
+        if estimate is None:
+            unknown.append(key)
+        estimates[key] = estimate or 0.0
+    if len(unknown) == len(plan.tasks):
+        return None
+    # The tasks are in topological order, since they only depend on earlier tasks
+    finish = {}
+    previous = {}
+    for key, task in plan.tasks.items():
+        start = 0.0
+        for dep in task.deps:
+            if finish[dep] > start:
+                start, previous[key] = finish[dep], dep
+        finish[key] = start + estimates[key]
+    critical_path = []
+    if finish:
+        key = max(finish, key=finish.get)
+        while key is not None:
+            critical_path.insert(0, key)
+            key = previous.get(key)
+    duration = max(finish.values(), default=0.0)
+    duration = max(duration, sum(estimates.values()) / jobs)
+    for stage, limit in limits.items():
+        work = sum(estimates[key] for key in plan.tasks if key[1] == stage)
+        duration = max(duration, work / limit)
+    return Prediction(duration, critical_path, unknown)
@@ -0,0 +1,69 @@
+import json
+import pathlib
+import threading
+import time
+
+from .scheduler import DONE
+from .utils import get_state_dir
+
+
+class Journal(object):
+    """
+    An append-only log of the outcomes of the tasks of a run.
+
+    Each line is a JSON object with the ``node``, the ``stage``, the ``status`` (i.e.
+    ``started``, ``retrying`` or a final ``scheduler`` status) and the ``meta`` of the
+    task, like its fingerprint and its artefact. The last line of a task is its
+    current state. Since the lines are flushed as soon as they are written, the
+    journal of a run that got killed tells where it stopped.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path) if path else get_state_dir("journal.jsonl")
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """ Start the journal of a new run """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text("")
+
+    def record(self, task, status, error=None):
+        entry = {
+            "time": time.time(),
+            "node": task.node,
+            "stage": task.stage,
+            "status": status,
+            "attempt": task.attempts + 1,
+            **task.meta,
+        }
+        if error is not None:
+            entry["error"] = f"{type(error).__name__}: {error}"
+        line = json.dumps(entry, sort_keys=True)
+        with self._lock:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a") as fd:
+                fd.write(line + "\n")
+
+    def load(self):
+        """ Return the last entry of each ``(node, stage)`` """
+        entries = {}
+        if not self.path.exists():
+            return entries
+        with self.path.open() as fd:
+            for line in fd:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line of a run that got killed while writing it
+                    continue
+                entries[(entry["node"], entry["stage"])] = entry
+        return entries
+
+    def get_completed(self):
+        """ Return a ``{(node, stage): fingerprint}`` mapping of the completed tasks """
+        return {
+            key: entry.get("fingerprint")
+            for key, entry in self.load().items()
+            if entry["status"] == DONE
+        }
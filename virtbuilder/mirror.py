@@ -0,0 +1,210 @@
+import hashlib
+import os
+import pathlib
+import platform
+import tempfile
+import urllib.parse
+import urllib.request
+
+from .utils import get_cache_dir
+
+DEFAULT_INDEX_URL = "https://builder.libguestfs.org/index.asc"
+CHUNK_SIZE = 1024 * 1024
+
+# virt-builder uses the names of ``uname -m``, but python may report e.g. AMD64
+ARCH_ALIASES = {"amd64": "x86_64", "arm64": "aarch64"}
+
+
+def get_template(data):
+    """ Return the ``(name, arch)`` of the virt-builder template of a definition """
+    general = data["general"]
+    arch = data["image"].get("arch") or platform.machine()
+    arch = ARCH_ALIASES.get(arch.lower(), arch)
+    return f"{general['os-name']}-{general['os-version']}", arch
+
+
+def get_templates(definitions):
+    """ Return the distinct templates that are used by ``definitions`` """
+    return sorted({get_template(data) for data in definitions})
+
+
+def strip_signature(text):
+    """ Return the contents of a (possibly) clearsigned index """
+    lines = text.splitlines()
+    if not lines or lines[0] != "-----BEGIN PGP SIGNED MESSAGE-----":
+        return text
+    # The armor headers end with the first empty line
+    start = lines.index("") + 1
+    end = lines.index("-----BEGIN PGP SIGNATURE-----")
+    # Undo the dash-escaping of the lines that start with "-"
+    body = [line[2:] if line.startswith("- ") else line for line in lines[start:end]]
+    return "\n".join(body) + "\n"
+
+
+def parse_index(text):
+    """
+    Parse a virt-builder index and return the list of its entries.
+
+    Each entry is a mapping of the fields of a ``[os-version]`` section, plus the
+    ``os-version`` itself (which is what virt-builder calls the template name).
+    Lines that start with a space continue the value of the previous field.
+
+    """
+    entries = []
+    entry = key = None
+    for line in strip_signature(text).splitlines():
+        if line.startswith("#"):
+            continue
+        if line.startswith("[") and line.rstrip().endswith("]"):
+            entry = {"os-version": line.strip()[1:-1]}
+            entries.append(entry)
+            key = None
+        elif line.startswith(" ") and key is not None:
+            entry[key] += "\n" + line
+        elif "=" in line and entry is not None:
+            key, value = line.split("=", 1)
+            entry[key] = value
+        elif line.strip():
+            raise ValueError(f"Invalid index line: {line!r}")
+    return entries
+
+
+def format_index(entries):
+    """ Return the text of an index with ``entries``, i.e. undo ``parse_index`` """
+    lines = []
+    for entry in entries:
+        lines.append(f"[{entry['os-version']}]")
+        lines.extend(
+            f"{key}={value}" for key, value in entry.items() if key != "os-version"
+        )
+        lines.append("")
+    return "\n".join(lines)
+
+
+def find_entry(entries, name, arch):
+    """ Return the index entry of a template. Raise a ValueError if it is missing """
+    for entry in entries:
+        if entry["os-version"] == name and entry.get("arch", "x86_64") == arch:
+            return entry
+    raise ValueError(f"The index has no template {name} for {arch}")
+
+
+class TemplateMirror(object):
+    """
+    A local virt-builder repository with the templates that the definitions use.
+
+    The templates are downloaded from the repository of ``index_url`` and verified
+    against the sha512 checksums of its index. The mirror keeps the signed upstream
+    index as is, and the templates (and their signatures, if any) under the same
+    relative paths, so that virt-builder can use it as a source (i.e. ``source:
+    file:///.../index.asc``) without touching the network, while still checking the
+    signatures. Only the requested templates are mirrored, although the index lists
+    all the upstream ones.
+
+    Downloads are written to temporary files and atomically renamed, so concurrent
+    runs never see a partial template.
+
+    """
+
+    def __init__(self, path=None, index_url=DEFAULT_INDEX_URL):
+        self.path = pathlib.Path(path) if path else get_cache_dir("templates")
+        self.index_url = index_url
+
+    @property
+    def index_path(self):
+        return self.path / "index.asc"
+
+    @property
+    def uri(self):
+        return self.index_path.resolve().as_uri()
+
+    def load_index(self):
+        """ Return the entries of the local index """
+        if not self.index_path.exists():
+            return []
+        return parse_index(self.index_path.read_text())
+
+    def fetch_index(self):
+        """ Return the (signed) text of the upstream index """
+        with urllib.request.urlopen(self.index_url) as response:
+            return response.read().decode()
+
+    def get_path(self, name):
+        """ Return the local path of a file that the index refers to """
+        path = (self.path / name).resolve()
+        if self.path.resolve() not in path.parents:
+            raise ValueError(f"The index refers to a file outside the mirror: {name}")
+        return path
+
+    def template_path(self, entry):
+        return self.get_path(entry["file"])
+
+    def has(self, entry):
+        """ Return True if the template of ``entry`` is downloaded and verified """
+        path = self.template_path(entry)
+        stamp = path.with_name(path.name + ".sha512")
+        if not path.exists() or not stamp.exists():
+            return False
+        return stamp.read_text() == entry.get("checksum[sha512]", "")
+
+    def _fetch(self, name, checksum=None):
+        """ Download ``name`` (relative to the index) atomically and return its path """
+        url = urllib.parse.urljoin(self.index_url, name)
+        path = self.get_path(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha512()
+        fd, tmp = tempfile.mkstemp(dir=path.parent, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as tmp_fd, urllib.request.urlopen(url) as response:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    digest.update(chunk)
+                    tmp_fd.write(chunk)
+            if checksum is not None and checksum != digest.hexdigest():
+                raise ValueError(f"Checksum mismatch for {url}")
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        return path
+
+    def download(self, entry):
+        """ Download the template of ``entry`` (and its signature) and verify it """
+        # An entry without a checksum never matches
+        expected = entry.get("checksum[sha512]", "")
+        path = self._fetch(entry["file"], expected)
+        if "sig" in entry:
+            # The templates of old indexes have detached signatures
+            self._fetch(entry["sig"])
+        path.with_name(path.name + ".sha512").write_text(expected)
+        return path
+
+    def write_index(self, text):
+        """ Replace the local index with the (signed) upstream ``text`` """
+        self.path.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        with os.fdopen(fd, "w") as tmp_fd:
+            tmp_fd.write(text)
+        os.replace(tmp, self.index_path)
+
+    def warm(self, templates, jobs=4):
+        """
+        Make sure that all the ``templates`` are in the mirror.
+
+        Each missing template is downloaded exactly once, using up to ``jobs``
+        concurrent downloads. Return a list of ``(template, downloaded)`` tuples.
+
+        """
+        text = self.fetch_index()
+        entries = parse_index(text)
+        wanted = [find_entry(entries, name, arch) for name, arch in templates]
+        missing = [entry for entry in wanted if not self.has(entry)]
+        if missing:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                # Consume the iterator, in order to raise the first error
+                list(executor.map(self.download, missing))
+        self.write_index(text)
+        return [
+            (template, entry in missing) for template, entry in zip(templates, wanted)
+        ]
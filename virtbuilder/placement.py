@@ -0,0 +1,147 @@
+import json
+import pathlib
+import threading
+import urllib.parse
+
+from . import api
+from .utils import get_state_dir, load_yaml, parse_size
+
+# The vCPUs that may run on each CPU of a host
+CPU_OVERCOMMIT = 4
+
+
+def load_host_pool(path):
+    """ Return the validated ``hosts`` of a host pool file """
+    from .schemas import HostPoolSchema
+
+    return HostPoolSchema.validate(load_yaml(path))["hosts"]
+
+
+def is_local_uri(uri):
+    """ Return True if ``uri`` connects to the libvirt daemon of this host """
+    return urllib.parse.urlsplit(uri).hostname is None
+
+
+def get_demand(data):
+    """ Return the CPUs, memory and pool space that a definition needs on its host """
+    vm = data["vm"]
+    count = data["replicas"]["count"] if api.has_replicas(data) else 1
+    return {
+        "cpus": int(vm["vcpus"]) * count,
+        "memory": int(vm["ram"]) * 1024 ** 2 * count,
+        # The overlays of the replicas start empty
+        "disk": parse_size(data["image"]["size"]),
+    }
+
+
+def with_uri(data, uri):
+    return dict(data, general=dict(data["general"], uri=uri))
+
+
+class Placer(object):
+    """
+    Place the definitions on the hosts of a host pool, i.e. replace their ``uri``.
+
+    A definition goes to the host with the highest score, among the ones with enough
+    free memory, free space in its pool and free CPUs (up to ``overcommit`` vCPUs per
+    CPU) for it. The score is the free memory that is left after the placement,
+    multiplied by the ``weight`` of the host and divided by its load, i.e. by one
+    plus the vCPUs of its running domains per host CPU. The resources of the
+    definitions that have been placed by this run, but that haven't been created yet,
+    count as used.
+
+    The placements are kept in ``.virtbuilder/placement.json``, so that a definition
+    stays on its host and that ``remove`` etc. can find it (see ``locate``). With the
+    images that are built directly into the pool, only the local hosts are used. The
+    rest of the images are built locally and uploaded to their host.
+
+    """
+
+    def __init__(self, hosts=None, backend=None, path=None, overcommit=CPU_OVERCOMMIT):
+        self.hosts = hosts or []
+        self.backend = backend
+        self.overcommit = overcommit
+        self.path = pathlib.Path(path) if path else get_state_dir("placement.json")
+        self._lock = threading.Lock()
+        # uri -> the demand of the definitions that have been placed by this run
+        self._planned = {}
+        # (uri, pool) -> the free resources of the host, or None if it's unreachable
+        self._info = {}
+
+    def load(self):
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text())
+
+    def save(self, placements):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(placements, indent=2, sort_keys=True))
+
+    def locate(self, data):
+        """ Return ``data`` on the host it has been placed on, if it has been placed """
+        placement = self.load().get(data["general"]["name"])
+        return with_uri(data, placement["uri"]) if placement else data
+
+    def place(self, data):
+        """ Return ``data`` on its host, placing it if it hasn't been placed yet """
+        name = data["general"]["name"]
+        with self._lock:
+            placements = self.load()
+            placement = placements.get(name)
+            if placement is None:
+                if not self.hosts:
+                    return data
+                demand = get_demand(data)
+                placement = dict(demand, uri=self._choose(data, demand))
+                placements[name] = placement
+                self.save(placements)
+                planned = self._planned.setdefault(placement["uri"], {})
+                for key, value in demand.items():
+                    planned[key] = planned.get(key, 0) + value
+        return with_uri(data, placement["uri"])
+
+    def release(self, data):
+        """ Forget the placement of a removed definition """
+        with self._lock:
+            placements = self.load()
+            if placements.pop(data["general"]["name"], None):
+                self.save(placements)
+
+    def get_host_info(self, uri, pool):
+        key = (uri, pool)
+        if key not in self._info:
+            try:
+                self._info[key] = self.backend.get_host_info(uri, pool)
+            except Exception:
+                # e.g. the host is down or the pool doesn't exist
+                self._info[key] = None
+        return self._info[key]
+
+    def _choose(self, data, demand):
+        general = data["general"]
+        best = None
+        for host in self.hosts:
+            uri = host["uri"]
+            # Direct builds and replicas write to the pool with local commands
+            local = api.is_direct(data) or api.has_replicas(data)
+            if local and not is_local_uri(uri):
+                continue
+            info = self.get_host_info(uri, general["pool"])
+            if info is None:
+                continue
+            planned = self._planned.get(uri, {})
+            memory = info["free_memory"] - planned.get("memory", 0) - demand["memory"]
+            disk = info["free_disk"] - planned.get("disk", 0) - demand["disk"]
+            vcpus = info["vcpus"] + planned.get("cpus", 0) + demand["cpus"]
+            if memory < 0 or disk < 0 or vcpus > info["cpus"] * self.overcommit:
+                continue
+            score = host["weight"] * memory / (1 + vcpus / info["cpus"])
+            if best is None or score > best[0]:
+                best = (score, uri)
+        if best is None:
+            msg = (
+                f"{general['name']}: no host of the pool has enough free memory, CPUs "
+                f"and free space in the pool '{general['pool']}'"
+            )
+            raise ValueError(msg)
+        return best[1]
@@ -0,0 +1,189 @@
+import re
+import socket
+import subprocess
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+WAIT_METHODS = ("lease", "agent", "ssh")
+DEFAULT_WAIT = {"method": "ssh", "timeout": 300, "port": 22}
+POLL_INTERVAL = 2
+# The maximum number of VMs that are probed at the same time
+MAX_PROBES = 16
+# How long to wait for the banner of the SSH server of a single VM
+SSH_TIMEOUT = 1
+AGENT_PING = '{"execute": "guest-ping"}'
+
+_IPV4 = re.compile(r"\bipv4\s+(\d+\.\d+\.\d+\.\d+)/")
+
+
+def get_wait_settings(data):
+    """ Return the ``wait`` settings of a VM, with their defaults """
+    return dict(DEFAULT_WAIT, **data["vm"].get("wait", {}))
+
+
+def parse_addresses(output):
+    """ Return the IPv4 addresses of ``virsh domifaddr`` output, except the loopback """
+    return [
+        address for address in _IPV4.findall(output) if not address.startswith("127.")
+    ]
+
+
+def _virsh(data, *args):
+    general = data["general"]
+    return subprocess.run(
+        ["virsh", f"--connect={general['uri']}", *args],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+
+
+def get_address(data, source="lease"):
+    """ Return the first IPv4 address of the domain that ``source`` knows, or None """
+    process = _virsh(data, "domifaddr", data["general"]["name"], "--source", source)
+    if process.returncode:
+        return None
+    addresses = parse_addresses(process.stdout)
+    return addresses[0] if addresses else None
+
+
+def agent_responds(data):
+    """ Return True if the qemu-guest-agent of the domain answers a ping """
+    process = _virsh(data, "qemu-agent-command", data["general"]["name"], AGENT_PING)
+    return process.returncode == 0
+
+
+def has_ssh_banner(address, port=22, timeout=SSH_TIMEOUT):
+    """ Return True if an SSH server is accepting connections on ``address`` """
+    try:
+        with socket.create_connection((address, port), timeout=timeout) as sock:
+            return sock.recv(4).startswith(b"SSH-")
+    except OSError:
+        return False
+
+
+def probe(data):
+    """ Return the address of the VM if it is ready according to its method, or None """
+    settings = get_wait_settings(data)
+    if settings["method"] == "agent":
+        if not agent_responds(data):
+            return None
+        return get_address(data, "agent") or get_address(data, "lease")
+    address = get_address(data, "lease")
+    if address and settings["method"] == "ssh":
+        if not has_ssh_banner(address, settings["port"]):
+            return None
+    return address
+
+
+def get_host_vars(data, address):
+    """ Return the Ansible variables of a VM that is reachable at ``address`` """
+    host_vars = {"ansible_host": address}
+    settings = get_wait_settings(data)
+    if settings["method"] == "ssh" and settings["port"] != DEFAULT_WAIT["port"]:
+        host_vars["ansible_port"] = settings["port"]
+    return host_vars
+
+
+class ReadinessPoller(object):
+    """
+    Wait for many VMs at once.
+
+    ``wait(data)`` returns a ``Future`` that resolves to the address of the VM as soon
+    as it is ready, or fails with a ``TimeoutError`` after the ``timeout`` of the VM.
+    A single thread probes all the VMs that are being waited for every ``interval``
+    seconds, running up to ``max_probes`` probes concurrently, and it exits when there
+    are none left. The ``hosts`` of the ready VMs are kept for the inventory.
+
+    """
+
+    def __init__(
+        self,
+        probe=probe,
+        interval=POLL_INTERVAL,
+        clock=time.monotonic,
+        max_probes=MAX_PROBES,
+    ):
+        self.probe = probe
+        self.interval = interval
+        self.max_probes = max_probes
+        self.clock = clock
+        self.hosts = {}
+        # name -> (data, future, deadline)
+        self._waiting = {}
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def wait(self, data):
+        name = data["general"]["name"]
+        future = Future()
+        future.set_running_or_notify_cancel()
+        deadline = self.clock() + get_wait_settings(data)["timeout"]
+        with self._cond:
+            self._waiting[name] = (data, future, deadline)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="readiness", daemon=True
+                )
+                self._thread.start()
+        return future
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.max_probes) as executor:
+            while True:
+                with self._cond:
+                    if not self._waiting:
+                        self._thread = None
+                        return
+                    waiting = list(self._waiting.items())
+                probes = [
+                    executor.submit(self.probe, data) for _, (data, _, _) in waiting
+                ]
+                for (name, (data, future, deadline)), result in zip(waiting, probes):
+                    self._check(name, data, future, deadline, result)
+                with self._cond:
+                    if self._waiting:
+                        self._cond.wait(self.interval)
+
+    def _check(self, name, data, future, deadline, probe):
+        """ Finish the wait of a VM, depending on the result of its ``probe`` """
+        try:
+            address = probe.result()
+        except Exception as exc:
+            # e.g. virsh is not installed
+            self._finish(name, future, exception=exc)
+            return
+        if address:
+            self.hosts[name] = get_host_vars(data, address)
+            self._finish(name, future, result=address)
+        elif self.clock() >= deadline:
+            settings = get_wait_settings(data)
+            msg = (
+                f"{name} was not ready ({settings['method']}) after "
+                f"{settings['timeout']} seconds"
+            )
+            self._finish(name, future, exception=TimeoutError(msg))
+
+    def _finish(self, name, future, result=None, exception=None):
+        with self._cond:
+            self._waiting.pop(name, None)
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+
+
+def format_inventory(hosts, group="virtbuilder"):
+    """ Return an Ansible inventory (INI) with the ``{name: host_vars}`` of the VMs """
+    lines = [f"[{group}]"]
+    for name in sorted(hosts):
+        host_vars = " ".join(f"{key}={value}" for key, value in hosts[name].items())
+        lines.append(f"{name} {host_vars}")
+    return "\n".join(lines) + "\n"
+
+
+def write_inventory(path, hosts, group="virtbuilder"):
+    with open(path, "w") as fd:
+        fd.write(format_inventory(hosts, group))
@@ -0,0 +1,115 @@
+import os
+import shutil
+
+from . import api
+from .utils import parse_size
+
+# The default memory of the libguestfs appliance (in MiB) and its default CPUs
+DEFAULT_MEMSIZE = 1280
+DEFAULT_SMP = 1
+DEFAULT_RESERVE = "1G"
+
+
+class Demand(object):
+    """ The host resources that a stage needs while it is running """
+
+    def __init__(self, memory=0, cpus=0, disk=0, path=None):
+        self.memory = memory
+        self.cpus = cpus
+        # The scratch space that the stage needs on the filesystem of ``path``
+        self.disk = disk
+        self.path = path
+
+    def __repr__(self):
+        return f"<Demand memory={self.memory} cpus={self.cpus} disk={self.disk}>"
+
+
+def get_stage_demand(data, stage):
+    """
+    Return the ``Demand`` of a create stage or None if it is negligible.
+
+    Only the ``image`` stage is expensive: ``virt-builder`` boots an appliance with
+    ``memsize`` MiB and ``smp`` CPUs and it writes an image of (up to) ``size`` into the
+    scratch dir. When building directly into the pool, the image is the volume, so it
+    doesn't need any scratch space.
+
+    """
+    if stage != "image":
+        return None
+    image = data["image"]
+    demand = Demand(
+        memory=image.get("memsize", DEFAULT_MEMSIZE) * 1024 ** 2,
+        cpus=image.get("smp", DEFAULT_SMP),
+    )
+    if not api.is_direct(data) or api.get_qcow2_options(data):
+        # The image is built locally, see ``api.get_build_path``
+        demand.disk = parse_size(image["size"])
+        demand.path = os.path.dirname(os.path.abspath(api.get_build_path(data)))
+    return demand
+
+
+def get_free_memory():
+    """ Return the memory that is available for new processes, in bytes """
+    try:
+        with open("/proc/meminfo") as fd:
+            for line in fd:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_free_disk(path):
+    """ Return the ``(device, free bytes)`` of the filesystem of ``path`` """
+    # The scratch dir gets created by the stage, so use its closest existing parent
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return os.stat(path).st_dev, shutil.disk_usage(path).free
+
+
+class HostBudget(object):
+    """
+    Admit a task only if the host has enough free memory, CPUs and scratch disk.
+
+    The resources are measured when each task is about to start and the demands of the
+    running tasks are subtracted from them, since these tasks may not have allocated
+    everything yet. At least one task is always admitted, so that a task that would
+    never fit still runs (alone) instead of blocking the plan.
+
+    """
+
+    def __init__(
+        self,
+        reserve_memory=DEFAULT_RESERVE,
+        cpus=None,
+        free_memory=get_free_memory,
+        free_disk=get_free_disk,
+    ):
+        self.reserve_memory = parse_size(reserve_memory)
+        self.cpus = cpus or os.cpu_count() or 1
+        self.free_memory = free_memory
+        self.free_disk = free_disk
+
+    def admit(self, task, running):
+        demand = task.demand
+        if demand is None:
+            return True
+        others = [other.demand for other in running if other.demand is not None]
+        if not others:
+            return True
+        if sum(other.cpus for other in others) + demand.cpus > self.cpus:
+            return False
+        memory = self.free_memory() - self.reserve_memory
+        if memory - sum(other.memory for other in others) < demand.memory:
+            return False
+        if demand.disk:
+            device, free = self.free_disk(demand.path)
+            committed = sum(
+                other.disk
+                for other in others
+                if other.disk and self.free_disk(other.path)[0] == device
+            )
+            if free - committed < demand.disk:
+                return False
+        return True
@@ -0,0 +1,438 @@
+import functools
+import time
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import api
+from . import state
+from . import tracing
+from .backends import LIFECYCLE_ACTIONS, VirshBackend
+from .cluster import iter_definitions
+from .history import get_features
+from .resources import get_stage_demand
+from .tuning import CpuAllocator
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+# The journal entries of the tasks that have started and that will be retried
+STARTED = "started"
+RETRYING = "retrying"
+
+# The stages that are retried by default, since they fail because of the network
+RETRY_STAGES = ("upload", "volume")
+# The delay before the first retry (seconds), which doubles after every attempt
+RETRY_BACKOFF = 5
+# The stages that only wait for the VMs to boot, so they don't take up a job
+IDLE_STAGES = ("wait",)
+# The stages that a resumed run executes again, since their result (i.e. the address
+# of the VM for the inventory) is not kept
+RESUMED_STAGES = ("wait",)
+
+
+class Task(object):
+    """ A single unit of work, i.e. one ``stage`` of one ``node`` """
+
+    def __init__(
+        self, node, stage, action, deps=(), demand=None, priority=0, meta=None
+    ):
+        self.node = node
+        self.stage = stage
+        self.action = action
+        self.deps = list(deps)
+        # The host resources the task needs, see ``resources.get_stage_demand``
+        self.demand = demand
+        # Ready tasks with a lower priority are handed out first
+        self.priority = priority
+        # Extra information about the task, e.g. its fingerprint, for the journal
+        self.meta = meta or {}
+        self.status = PENDING
+        self.error = None
+        # The number of failed attempts and when the task may be retried
+        self.attempts = 0
+        self.not_before = 0.0
+        # When the last attempt started (``time.monotonic()``)
+        self.started = None
+
+    @property
+    def key(self):
+        return (self.node, self.stage)
+
+    def __repr__(self):
+        return f"<Task {self.node}/{self.stage} {self.status}>"
+
+
+class Plan(object):
+    """
+    A DAG of ``Task`` objects.
+
+    Tasks are kept in insertion order, which is also the order in which ready tasks
+    of the same priority are handed out. Dependencies are expressed as task keys,
+    i.e. ``(node, stage)`` tuples.
+
+    """
+
+    def __init__(self):
+        self.tasks = {}
+
+    def add(self, task):
+        if task.key in self.tasks:
+            raise ValueError(f"Duplicate task: {task.key}")
+        missing = [dep for dep in task.deps if dep not in self.tasks]
+        if missing:
+            raise ValueError(f"Unknown dependencies for {task.key}: {missing}")
+        self.tasks[task.key] = task
+        return task
+
+    def _pending(self):
+        return [
+            task
+            for task in self.tasks.values()
+            if task.status == PENDING
+            and all(self.tasks[dep].status == DONE for dep in task.deps)
+        ]
+
+    def ready(self):
+        """ Return the pending tasks whose dependencies have all finished """
+        now = time.monotonic()
+        ready = [task for task in self._pending() if task.not_before <= now]
+        return sorted(ready, key=lambda task: task.priority)
+
+    def get_delay(self):
+        """ Return the seconds until the next retry is due, or None if there is none """
+        now = time.monotonic()
+        # The retries that are already due only wait for a free job
+        retries = [task.not_before for task in self._pending() if task.not_before > now]
+        if not retries:
+            return None
+        return min(retries) - now
+
+    def dependents(self, task):
+        """ Return all the tasks that (transitively) depend on ``task`` """
+        found = []
+        keys = {task.key}
+        for other in self.tasks.values():
+            # Tasks only depend on previously added tasks, so one pass is enough
+            if keys.intersection(other.deps):
+                keys.add(other.key)
+                found.append(other)
+        return found
+
+    def finish(self, task, error=None):
+        if error is None:
+            task.status = DONE
+        else:
+            task.status = FAILED
+            task.error = error
+            for dependent in self.dependents(task):
+                if dependent.status == PENDING:
+                    dependent.status = SKIPPED
+
+    def skip_pending(self):
+        """ Skip the tasks that are still pending, since they will never run """
+        for task in self.tasks.values():
+            if task.status == PENDING:
+                task.status = SKIPPED
+
+    @property
+    def failed(self):
+        return [task for task in self.tasks.values() if task.status == FAILED]
+
+    @property
+    def skipped(self):
+        return [task for task in self.tasks.values() if task.status == SKIPPED]
+
+
+class Scheduler(object):
+    """
+    Run a ``Plan`` using a pool of threads.
+
+    ``jobs`` is the total number of concurrently running tasks, while ``limits`` maps
+    stage names to the maximum number of concurrently running tasks of that stage. This
+    allows e.g. to limit the CPU bound ``image`` stage independently of the I/O bound
+    ``upload`` stage, so that node B is being built while node A is being uploaded.
+
+    The tasks of the ``IDLE_STAGES`` (i.e. waiting for the VMs to boot) don't count
+    towards ``jobs``, so that the next nodes keep being built in the meantime.
+
+    ``budget`` is an optional ``resources.HostBudget``. The tasks that don't fit in
+    the free resources of the host stay queued until the running ones finish.
+
+    ``retries`` maps stage names to the number of times that a failed task of that
+    stage is retried, after ``backoff`` seconds for the first retry and twice as long
+    for every next one. The other tasks keep running in the meantime. If a
+    ``journal.Journal`` is provided, the progress of the tasks is recorded in it.
+    If a ``history.History`` is provided, the durations of the tasks with
+    ``features`` in their ``meta`` are recorded in it.
+
+    """
+
+    def __init__(
+        self,
+        jobs=4,
+        limits=None,
+        budget=None,
+        retries=None,
+        backoff=RETRY_BACKOFF,
+        journal=None,
+        history=None,
+    ):
+        if jobs < 1:
+            raise ValueError(f"'jobs' must be a positive integer, not: {jobs}")
+        for stage, limit in (limits or {}).items():
+            if limit < 1:
+                msg = f"The limit of '{stage}' must be a positive integer, not: {limit}"
+                raise ValueError(msg)
+        self.jobs = jobs
+        self.limits = limits or {}
+        self.budget = budget
+        self.retries = retries or {}
+        self.backoff = backoff
+        self.journal = journal
+        self.history = history
+
+    def is_full(self, task, running):
+        """ Return True if ``task`` has to wait for a job to finish """
+        if task.stage in IDLE_STAGES:
+            return False
+        busy = sum(1 for other in running if other.stage not in IDLE_STAGES)
+        return busy >= self.jobs
+
+    def has_capacity(self, task, running):
+        limit = self.limits.get(task.stage, self.jobs)
+        if sum(1 for other in running if other.stage == task.stage) >= limit:
+            return False
+        return self.budget is None or self.budget.admit(task, list(running))
+
+    def start(self, task):
+        task.status = RUNNING
+        task.started = time.monotonic()
+        if self.journal is not None:
+            self.journal.record(task, STARTED)
+
+    def finish(self, plan, task, error=None):
+        """ Finish ``task``, unless it failed and it can be retried """
+        if error is not None and task.attempts < self.retries.get(task.stage, 0):
+            task.status = PENDING
+            task.not_before = time.monotonic() + self.backoff * 2 ** task.attempts
+            if self.journal is not None:
+                self.journal.record(task, RETRYING, error)
+            task.attempts += 1
+            return
+        plan.finish(task, error)
+        if self.journal is not None:
+            self.journal.record(task, task.status, error)
+        if self.history is not None and "features" in task.meta:
+            duration = time.monotonic() - task.started
+            self.history.record(
+                task.node, task.stage, task.meta["features"], duration, task.status
+            )
+
+    def run(self, plan):
+        """ Execute the ``plan`` and return the list of the failed tasks """
+        running = {}
+        idle = sum(1 for task in plan.tasks.values() if task.stage in IDLE_STAGES)
+        with ThreadPoolExecutor(max_workers=self.jobs + idle) as executor:
+            while True:
+                for task in plan.ready():
+                    if self.is_full(task, running.values()):
+                        continue
+                    if self.has_capacity(task, running.values()):
+                        self.start(task)
+                        running[executor.submit(task.action)] = task
+                delay = plan.get_delay()
+                if not running:
+                    if delay is None:
+                        break
+                    time.sleep(delay)
+                    continue
+                done, _ = wait(running, timeout=delay, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self.finish(plan, running.pop(future), future.exception())
+        plan.skip_pending()
+        return plan.failed
+
+
+def run_stage(backend, data, stage, cmds, on_success=None):
+    name = data["general"]["name"]
+    with tracing.span(f"{name}/{stage}", node=name, stage=stage):
+        backend.run_stage(data, stage, cmds)
+    if on_success is not None:
+        on_success()
+
+
+def place_definitions(plan, placer, definitions):
+    """ Place the ``definitions``, adding the ones that fit nowhere as failed tasks """
+    for data in definitions:
+        try:
+            yield placer.place(data)
+        except ValueError as exc:
+            task = plan.add(Task(data["general"]["name"], "place", None))
+            plan.finish(task, exc)
+
+
+def run_prepared(prepare, data, action):
+    """ Call ``prepare(data)`` right before the ``action`` of a stage runs """
+    prepare(data)
+    return action()
+
+
+def get_create_plan(
+    definition_files,
+    stage=None,
+    cache=None,
+    store=None,
+    backend=None,
+    definition_cache=None,
+    run=None,
+    allocator=None,
+    completed=None,
+    placer=None,
+):
+    """
+    Return a ``Plan`` with the create stages of all the ``definition_files``
+
+    The definition files may also be cluster files (see ``cluster.iter_definitions``).
+    The definitions are validated while they are loaded. If a ``StateStore`` is
+    provided, the stages that are up to date are left out of the plan and the
+    fingerprints of the executed stages get recorded. The stages are executed by
+    ``backend`` which defaults to the ``VirshBackend``.
+
+    ``run`` is the function that executes a stage, i.e. ``run(data, stage, cmds,
+    on_success)``. It defaults to ``run_stage`` using ``backend``. ``allocator`` is the
+    ``tuning.CpuAllocator`` of the nodes with ``pinning: auto``.
+
+    ``completed`` is a ``{(node, stage): fingerprint}`` mapping of the stages that
+    have been completed by an earlier run (see ``journal.Journal.get_completed``).
+    These stages are left out of the plan, unless their fingerprint has changed since
+    or they are one of the ``RESUMED_STAGES``.
+    ``placer`` is the ``placement.Placer`` that assigns the definitions to hosts. The
+    definitions that don't fit on any host get a failed ``place`` task.
+
+    """
+    backend = backend or VirshBackend()
+    allocator = allocator or CpuAllocator()
+    run = run or functools.partial(run_stage, backend)
+    plan = Plan()
+    definitions = (
+        data
+        for definition_file in definition_files
+        for data in iter_definitions(definition_file, definition_cache)
+    )
+    if placer is not None:
+        # The replicas are placed on the host of their base
+        definitions = place_definitions(plan, placer, definitions)
+    nodes = (
+        allocator.allocate(node)
+        for data in definitions
+        for node in api.expand_replicas(data)
+    )
+    for data in nodes:
+        node = data["general"]["name"]
+        if stage and stage not in api.get_stages(data):
+            continue
+        stages = api.get_create_stages(data, stage=stage, cache=cache)
+        fingerprints = state.get_fingerprints(data)
+        if store is not None:
+            outdated = store.get_outdated_stages(data, fingerprints)
+            stages = [(name, cmds) for name, cmds in stages if name in outdated]
+        if completed:
+            stages = [
+                (name, cmds)
+                for name, cmds in stages
+                if name in RESUMED_STAGES
+                or completed.get((node, name), False) != fingerprints[name]
+            ]
+        names = [name for name, _ in stages]
+        dependencies = api.get_stage_dependencies(data)
+        node_dependencies = api.get_node_dependencies(data)
+        for name, cmds in stages:
+            deps = [(node, dep) for dep in dependencies[name] if dep in names]
+            # The stages of other nodes only matter if they are part of the plan
+            deps.extend(
+                key for key in node_dependencies.get(name, []) if key in plan.tasks
+            )
+            on_success = None
+            if store is not None:
+                on_success = functools.partial(
+                    store.record, data, name, fingerprints[name]
+                )
+            action = functools.partial(run, data, name, cmds, on_success)
+            if name == "image" and cache is not None:
+                action = functools.partial(run_prepared, cache.prepare, data, action)
+            elif name == "vm":
+                # The pinned CPUs are only kept once the VM gets created
+                action = functools.partial(run_prepared, allocator.claim, data, action)
+            plan.add(
+                Task(
+                    node,
+                    name,
+                    action,
+                    deps,
+                    demand=get_stage_demand(data, name),
+                    # Removing the local images frees scratch disk for the next builds
+                    priority=-1 if name == "cleanup" else 0,
+                    meta={
+                        "fingerprint": fingerprints[name],
+                        "artefact": api.get_artefact(data, name),
+                        "features": get_features(data, name),
+                    },
+                )
+            )
+    return plan
+
+
+def run_action(backend, data, action, on_success=None):
+    name = data["general"]["name"]
+    with tracing.span(f"{name}/{action}", node=name, stage=action):
+        if action == "remove" and api.has_replicas(data):
+            # The replicas are separate tasks
+            backend.remove(data, replicas=False)
+        else:
+            getattr(backend, action)(data)
+    if on_success is not None:
+        on_success(data)
+
+
+def get_lifecycle_plan(
+    definition_files,
+    action,
+    backend=None,
+    definition_cache=None,
+    on_success=None,
+    placer=None,
+):
+    """
+    Return a ``Plan`` that performs a lifecycle ``action`` on all the nodes.
+
+    ``action`` is one of ``backends.LIFECYCLE_ACTIONS``. The nodes are independent of
+    each other, except for the base volumes of the replicas which are removed after
+    all of their replicas. The definitions with replicas have no VM of their own, so
+    they are only part of the ``remove`` plans. ``on_success(data)`` is called after
+    the action of each node succeeds. If a ``placement.Placer`` is provided, the
+    actions are performed on the hosts that the definitions have been placed on.
+
+    """
+    if action not in LIFECYCLE_ACTIONS:
+        raise ValueError(f"'action' must be one of {LIFECYCLE_ACTIONS}, not: {action}")
+    backend = backend or VirshBackend()
+    plan = Plan()
+    definitions = (
+        data
+        for definition_file in definition_files
+        for data in iter_definitions(definition_file, definition_cache)
+    )
+    for data in definitions:
+        if placer is not None:
+            data = placer.locate(data)
+        replicas = api.get_replicas(data) if api.has_replicas(data) else []
+        for node in replicas or [data]:
+            run = functools.partial(run_action, backend, node, action, on_success)
+            plan.add(Task(node["general"]["name"], action, run))
+        if replicas and action == "remove":
+            deps = [(node["general"]["name"], action) for node in replicas]
+            run = functools.partial(run_action, backend, data, action, on_success)
+            plan.add(Task(data["general"]["name"], action, run, deps))
+    return plan
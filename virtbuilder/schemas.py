@@ -20,6 +20,43 @@ GeneralSchema = Schema(
         "os-name": Regex(r"\w+"),
         "os-version": Regex(r"\w+"),
         Optional("verbose"): bool,
+        Optional("build-mode"): And(str, OneOf("upload", "direct")),
+        Optional("scratch-dir"): And(str, len),
+    }
+)
+
+DiskPerformanceSchema = Schema(
+    {
+        Optional("profile"): And(str, OneOf("default", "throughput", "latency")),
+        Optional("bus"): And(str, OneOf("virtio", "scsi")),
+        Optional("cache"): And(
+            str, OneOf("none", "writeback", "writethrough", "directsync", "unsafe")
+        ),
+        Optional("io"): And(str, OneOf("native", "threads", "io_uring")),
+        Optional("discard"): And(str, OneOf("unmap", "ignore")),
+        Optional("detect-zeroes"): And(str, OneOf("on", "off", "unmap")),
+        Optional("iothreads"): And(int, lambda n: n >= 0),
+        Optional("queues"): And(int, lambda n: n > 0),
+    }
+)
+
+PerformanceSchema = Schema(
+    {
+        Optional("cpu-model"): And(str, len),
+        # "auto" or a cpuset of the host, e.g. "4-7"
+        Optional("pinning"): Regex(r"^(auto|\d+(-\d+)?(,\d+(-\d+)?)*)$"),
+        Optional("numa-node"): And(int, lambda n: n >= 0),
+        Optional("hugepages"): Or(bool, And(str, OneOf("2M", "1G"))),
+        Optional("net-queues"): Or(And(int, lambda n: n > 0), "auto"),
+    }
+)
+
+# How to find out that a VM has booted, see ``readiness.probe``
+WaitSchema = Schema(
+    {
+        Optional("method"): And(str, OneOf("lease", "agent", "ssh")),
+        Optional("timeout"): And(int, lambda n: n > 0),
+        Optional("port"): And(int, lambda n: 0 < n < 65536),
     }
 )
 
@@ -32,6 +69,9 @@ VM_Schema = Schema(
         Optional("extra-args"): And(str, len),
         Optional("disk"): And(str, len),
         Optional("network"): And(str, len),
+        Optional("disk-performance"): DiskPerformanceSchema,
+        Optional("performance"): PerformanceSchema,
+        Optional("wait"): WaitSchema,
     }
 )
 
@@ -78,6 +118,17 @@ ImageConfigSchema = Schema(
     }
 )
 
+QCOW2_CLUSTER_SIZES = ["512"] + [f"{2 ** n}K" for n in range(10)] + ["1M", "2M"]
+
+# The settings of the qcow2 file, which are applied with ``qemu-img convert``
+Qcow2Schema = Schema(
+    {
+        Optional("preallocation"): And(str, OneOf("off", "metadata", "falloc", "full")),
+        Optional("cluster-size"): And(str, OneOf(*QCOW2_CLUSTER_SIZES)),
+        Optional("lazy-refcounts"): bool,
+    }
+)
+
 ImageSchema = Schema(
     {
         "size": And(str, len),
@@ -85,11 +136,59 @@ ImageSchema = Schema(
         Optional("no-sync"): And(bool),
         Optional("memsize"): And(int, lambda n: n > 1000),
         Optional("smp", default=4): And(int, lambda n: n > 1),
+        # A virt-builder repository index, e.g. the one of ``virtbuilder cache warm``
+        Optional("source"): And(str, len),
+        Optional("no-check-signature"): And(bool),
         # TODO Add support for --attach and --attach-format
         Optional("config"): ImageConfigSchema,
+        Optional("qcow2"): Qcow2Schema,
+    }
+)
+
+
+def is_replica_template(template):
+    """ Return True if ``template`` can be formatted with the fields of a replica """
+    try:
+        template.format(name="node", index=1)
+    except (AttributeError, IndexError, KeyError, ValueError):
+        return False
+    return True
+
+
+# Multiple VMs that share a single base image. Each replica gets a thin overlay of the
+# base volume. The templates are formatted with the ``name`` of the definition and the
+# (1-based) ``index`` of the replica.
+ReplicasSchema = Schema(
+    {
+        "count": And(int, lambda n: n > 0),
+        Optional("name"): And(str, lambda s: "{index" in s, is_replica_template),
+        Optional("network"): And(str, len, is_replica_template),
+        Optional("provision"): ProvisionSchema,
+    }
+)
+
+FullSchema = Schema(
+    {
+        "general": GeneralSchema,
+        "image": ImageSchema,
+        "vm": VM_Schema,
+        Optional("replicas"): ReplicasSchema,
     }
 )
 
-FullSchema = Schema({"general": GeneralSchema, "image": ImageSchema, "vm": VM_Schema})
+# The libvirt hosts that the definitions get placed on, see ``placement.Placer``
+HostPoolSchema = Schema(
+    {
+        "hosts": And(
+            [
+                {
+                    "uri": Regex(r"\w+:(\/?\/?)[^\s]+"),
+                    Optional("weight", default=1): And(Or(int, float), lambda n: n > 0),
+                }
+            ],
+            len,
+        )
+    }
+)
 
 full_schema = FullSchema
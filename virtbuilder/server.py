@@ -0,0 +1,523 @@
+import collections
+import collections.abc
+import heapq
+import ipaddress
+import itertools
+import json
+import os
+import socketserver
+import threading
+import time
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from . import __version__
+from . import export
+from . import scheduler
+from .cache import LayerCache
+from .engine import Engine
+from .placement import Placer
+from .state import StateStore
+from .tuning import CpuAllocator
+from .utils import get_state_dir
+from .validator import DefinitionCache
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+JOB_COMMANDS = ("create", "remove", "start", "stop", "reboot")
+JOB_OPTIONS = {"stage", "force", "cache"}
+# The output lines that are kept per job
+MAX_LOG_LINES = 10000
+
+
+def get_default_socket():
+    return get_state_dir("serve.sock")
+
+
+class MemoryDefinitionCache(DefinitionCache):
+    """
+    A ``DefinitionCache`` that also keeps its entries in memory.
+
+    The entries are still checked against the modification time and the size of the
+    definition files, so an edited file gets parsed again, but the unchanged ones are
+    neither parsed nor unpickled.
+
+    """
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _read_entry(self, path):
+        with self._lock:
+            entry = self._entries.get(path)
+        if entry is None:
+            entry = super()._read_entry(path)
+            if entry is not None:
+                with self._lock:
+                    self._entries[path] = entry
+        return entry
+
+    def _write_entry(self, path, entry):
+        with self._lock:
+            self._entries[path] = entry
+        super()._write_entry(path, entry)
+
+
+class Job(object):
+    """ A command to execute on some definition files, with its status and output """
+
+    def __init__(self, job_id, command, definitions, priority=0, options=None):
+        self.id = job_id
+        self.command = command
+        self.definitions = list(definitions)
+        # Queued jobs with a lower priority are executed first
+        self.priority = priority
+        self.options = options or {}
+        self.status = QUEUED
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # "node/stage" -> the status of the task
+        self.tasks = {}
+        self._log = collections.deque(maxlen=MAX_LOG_LINES)
+        # The number of lines that have been dropped from the start of the log, so
+        # that the offsets of the lines never change
+        self._dropped = 0
+        self._lock = threading.Lock()
+
+    def write(self, line):
+        with self._lock:
+            if len(self._log) == self._log.maxlen:
+                self._dropped += 1
+            self._log.append(line)
+
+    def get_log(self, offset=0):
+        """ Return the lines after ``offset`` and the offset of the next line """
+        with self._lock:
+            start = max(offset - self._dropped, 0)
+            lines = list(itertools.islice(self._log, start, None))
+            return lines, self._dropped + len(self._log)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "command": self.command,
+            "definitions": self.definitions,
+            "priority": self.priority,
+            "options": self.options,
+            "status": self.status,
+            "error": self.error,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "tasks": self.tasks,
+        }
+
+
+class JobQueue(object):
+    """
+    The jobs of the server, queued by priority.
+
+    Jobs of the same priority are executed in the order they were submitted. Finished
+    jobs are kept, so that their status and output can still be queried.
+
+    """
+
+    def __init__(self):
+        self.jobs = collections.OrderedDict()
+        self._heap = []
+        self._counter = itertools.count(1)
+        self._cond = threading.Condition()
+        self._closed = False
+
+    def submit(self, command, definitions, priority=0, options=None):
+        """ Validate and queue a job. Raise a ValueError if it is not valid. """
+        if command not in JOB_COMMANDS:
+            raise ValueError(f"'command' must be one of {JOB_COMMANDS}, not: {command}")
+        paths = isinstance(definitions, list) and definitions
+        if not paths or not all(isinstance(d, str) for d in definitions):
+            raise ValueError("'definitions' must be a non-empty list of paths")
+        if not isinstance(priority, int):
+            raise ValueError(f"'priority' must be an integer, not: {priority}")
+        if options is not None and not isinstance(options, dict):
+            raise ValueError(f"'options' must be a mapping, not: {options}")
+        unknown = set(options or {}) - JOB_OPTIONS
+        if unknown:
+            raise ValueError(f"Unknown options: {sorted(unknown)}")
+        with self._cond:
+            job = Job(next(self._counter), command, definitions, priority, options)
+            self.jobs[job.id] = job
+            heapq.heappush(self._heap, (priority, job.id))
+            self._cond.notify()
+        return job
+
+    def get(self, timeout=None):
+        """ Start the next queued job, or return None on close or after ``timeout`` """
+        with self._cond:
+            while True:
+                while self._heap:
+                    _, job_id = heapq.heappop(self._heap)
+                    job = self.jobs[job_id]
+                    # Cancelled jobs are left in the heap
+                    if job.status == QUEUED:
+                        # So that it can't be cancelled anymore
+                        job.status = RUNNING
+                        return job
+                if self._closed or not self._cond.wait(timeout):
+                    return None
+
+    def cancel(self, job_id):
+        """ Cancel a queued job and return True, or False if it has already started """
+        with self._cond:
+            job = self.jobs[job_id]
+            if job.status != QUEUED:
+                return False
+            job.status = CANCELLED
+            job.finished = time.time()
+            return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def list_jobs(self):
+        with self._cond:
+            return list(self.jobs.values())
+
+    def get_summary(self):
+        with self._cond:
+            statuses = collections.Counter(job.status for job in self.jobs.values())
+        return {"version": __version__, "jobs": dict(statuses)}
+
+
+class JobRunner(object):
+    """
+    Execute jobs, keeping the state that is expensive to set up between them.
+
+    The backend (i.e. the libvirt connections), the parsed definitions, the state
+    store, the CPU allocations and the placements are shared by all the jobs. The
+    stages of a job are executed concurrently, like ``multi --parallel`` does, and
+    their output goes to the log of the job and to ``output``.
+
+    """
+
+    def __init__(
+        self,
+        backend,
+        jobs=4,
+        limits=None,
+        budget=None,
+        definition_cache=None,
+        store=None,
+        allocator=None,
+        placer=None,
+        output=None,
+    ):
+        self.backend = backend
+        self.jobs = jobs
+        self.limits = limits
+        self.budget = budget
+        self.definition_cache = definition_cache or MemoryDefinitionCache()
+        self.store = store or StateStore()
+        self.allocator = allocator or CpuAllocator()
+        self.placer = placer or Placer(backend=backend)
+        self.output = output
+        self._layer_cache = None
+
+    @property
+    def layer_cache(self):
+        if self._layer_cache is None:
+            self._layer_cache = LayerCache()
+        return self._layer_cache
+
+    def _get_writer(self, job):
+        def write(line):
+            job.write(line)
+            if self.output is not None:
+                self.output(f"[job {job.id}] {line}")
+
+        return write
+
+    def run(self, job):
+        write = self._get_writer(job)
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            plan = self.get_plan(job, write)
+        except Exception as exc:
+            job.error = f"{type(exc).__name__}: {exc}"
+            job.status = FAILED
+            write(job.error)
+        else:
+            for task in plan.failed:
+                write(f"{task.node}/{task.stage} failed: {task.error}")
+            for task in plan.skipped:
+                write(f"{task.node}/{task.stage} skipped")
+            job.status = FAILED if plan.failed or plan.skipped else DONE
+        job.finished = time.time()
+        write(f"{job.command} {job.status} in {job.finished - job.started:.1f}s")
+        return job
+
+    def get_plan(self, job, write):
+        """ Execute the plan of ``job`` and return it """
+        if job.command == "create":
+            engine = Engine(
+                backend=self.backend,
+                jobs=self.jobs,
+                limits=self.limits,
+                output=write,
+                budget=self.budget,
+            )
+            plan = scheduler.get_create_plan(
+                job.definitions,
+                stage=job.options.get("stage"),
+                cache=self.layer_cache if job.options.get("cache") else None,
+                store=None if job.options.get("force") else self.store,
+                backend=self.backend,
+                definition_cache=self.definition_cache,
+                run=engine.run_stage,
+                allocator=self.allocator,
+                placer=self.placer,
+            )
+            self._watch(job, plan)
+            engine.run(plan)
+        else:
+            plan = scheduler.get_lifecycle_plan(
+                job.definitions,
+                job.command,
+                backend=self.backend,
+                definition_cache=self.definition_cache,
+                on_success=self.forget if job.command == "remove" else None,
+                placer=self.placer,
+            )
+            self._watch(job, plan)
+            scheduler.Scheduler(jobs=self.jobs).run(plan)
+        return plan
+
+    def _watch(self, job, plan):
+        # The tasks are shared, so the status of the job is always up to date
+        job.tasks = _TaskStatuses(plan)
+
+    def forget(self, data):
+        """ Clear the state of a removed node """
+        self.store.clear(data)
+        export.clear_stamps(data)
+        self.allocator.release(data)
+        self.placer.release(data)
+
+
+class _TaskStatuses(collections.abc.Mapping):
+    """ A live ``{"node/stage": status}`` view of the tasks of a plan """
+
+    def __init__(self, plan):
+        self.plan = plan
+
+    def __getitem__(self, key):
+        node, _, stage = key.rpartition("/")
+        return self.plan.tasks[(node, stage)].status
+
+    def __iter__(self):
+        return (f"{node}/{stage}" for node, stage in list(self.plan.tasks))
+
+    def __len__(self):
+        return len(self.plan.tasks)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    The JSON API of the server.
+
+    GET     /                   The version and the number of jobs per status
+    GET     /jobs               All the jobs
+    POST    /jobs               Submit a job, e.g. {"command": "create",
+                                "definitions": ["vm1.yml"], "priority": 0,
+                                "options": {"force": true}}
+    GET     /jobs/<id>          A single job
+    GET     /jobs/<id>/log      The output of a job, starting at ``?offset=``
+    DELETE  /jobs/<id>          Cancel a queued job
+
+    """
+
+    server_version = f"virtbuilder/{__version__}"
+
+    def send_json(self, status, body):
+        content = json.dumps(body, default=dict).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_error_json(self, status, message):
+        self.send_json(status, {"error": message})
+
+    def get_job(self, job_id):
+        try:
+            return self.server.queue.jobs[int(job_id)]
+        except (KeyError, ValueError):
+            self.send_error_json(404, f"Unknown job: {job_id}")
+            return None
+
+    def route(self):
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split("/") if part]
+        query = urllib.parse.parse_qs(url.query)
+        return parts, query
+
+    def do_GET(self):
+        parts, query = self.route()
+        queue = self.server.queue
+        if not parts:
+            self.send_json(200, queue.get_summary())
+        elif parts == ["jobs"]:
+            self.send_json(200, [job.to_dict() for job in queue.list_jobs()])
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.get_job(parts[1])
+            if job is None:
+                return
+            if len(parts) == 2:
+                self.send_json(200, job.to_dict())
+            elif parts[2] == "log":
+                offset = query.get("offset", ["0"])[0]
+                try:
+                    offset = int(offset)
+                except ValueError:
+                    msg = f"'offset' must be an integer, not: {offset}"
+                    self.send_error_json(400, msg)
+                    return
+                lines, offset = job.get_log(offset)
+                self.send_json(200, {"lines": lines, "offset": offset})
+            else:
+                self.send_error_json(404, f"Not found: {self.path}")
+        else:
+            self.send_error_json(404, f"Not found: {self.path}")
+
+    def do_POST(self):
+        parts, _ = self.route()
+        if parts != ["jobs"]:
+            self.send_error_json(404, f"Not found: {self.path}")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            job = self.server.queue.submit(
+                body.get("command"),
+                body.get("definitions"),
+                priority=body.get("priority", 0),
+                options=body.get("options"),
+            )
+        except (AttributeError, ValueError) as exc:
+            self.send_error_json(400, str(exc))
+            return
+        self.send_json(201, job.to_dict())
+
+    def do_DELETE(self):
+        parts, _ = self.route()
+        if len(parts) != 2 or parts[0] != "jobs":
+            self.send_error_json(404, f"Not found: {self.path}")
+            return
+        job = self.get_job(parts[1])
+        if job is None:
+            return
+        if not self.server.queue.cancel(job.id):
+            self.send_error_json(409, f"Job {job.id} is {job.status}")
+            return
+        self.send_json(200, job.to_dict())
+
+    def log_message(self, format, *args):
+        # Unlike the default, this doesn't use the client address, which the clients
+        # of the Unix socket don't have
+        if self.server.output is not None:
+            self.server.output(f"[serve] {format % args}")
+
+
+class HTTPJobServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, queue, output=None):
+        self.queue = queue
+        self.output = output
+        super().__init__(address, RequestHandler)
+
+
+class UnixJobServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, queue, output=None):
+        self.queue = queue
+        self.output = output
+        path = str(path)
+        # A socket left behind by a server that was killed
+        if os.path.exists(path):
+            os.unlink(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Only the owner may submit jobs. The socket is created with these permissions,
+        # since a chmod after bind() would leave a window for the other users.
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, RequestHandler)
+        finally:
+            os.umask(umask)
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def make_server(queue, socket_path=None, host="127.0.0.1", port=None, output=None):
+    """
+    Return a server listening on ``port`` of ``host`` or on a Unix socket.
+
+    The API has no authentication, so the TCP server only listens on loopback
+    addresses.
+
+    """
+    if port is not None:
+        if not is_loopback(host):
+            raise ValueError(f"'host' must be a loopback address, not: {host}")
+        return HTTPJobServer((host, port), queue, output=output)
+    return UnixJobServer(socket_path or get_default_socket(), queue, output=output)
+
+
+def serve(server, queue, runner):
+    """
+    Execute the queued jobs until ``queue`` is closed.
+
+    The requests are handled by the threads of ``server``, while the jobs are executed
+    one at a time by the calling thread (the stages of each job run concurrently).
+    This should be the main thread, which gets the ``KeyboardInterrupt`` that makes
+    the ``Engine`` cancel the running stages and kill their commands.
+
+    """
+    thread = threading.Thread(target=server.serve_forever, name="serve", daemon=True)
+    thread.start()
+    try:
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            runner.run(job)
+    finally:
+        server.shutdown()
+        server.server_close()
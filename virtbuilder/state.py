@@ -0,0 +1,248 @@
+import functools
+import json
+import os
+import pathlib
+import shutil
+import subprocess
+import threading
+
+from . import api
+from .cache import hash_references
+from .utils import get_digest, get_state_dir
+
+# The external tool each stage is using
+STAGE_TOOLS = {
+    "image": ["virt-builder", "virt-customize", "qemu-img"],
+    "volume": ["virsh"],
+    "upload": ["virsh"],
+    "cleanup": [],
+    "vm": ["virt-install"],
+    "overlay": ["virsh"],
+    "customize": ["virt-customize"],
+    "wait": ["virsh"],
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_tool_version(tool):
+    """
+    Return an identifier of the installed version of ``tool``.
+
+    Running ``tool --version`` is too slow to be done on every invocation, so we use
+    the path, the size and the modification time of the executable instead. These
+    change whenever the tool gets upgraded.
+
+    """
+    path = shutil.which(tool)
+    if path is None:
+        return None
+    stat = os.stat(path)
+    return [path, stat.st_size, stat.st_mtime_ns]
+
+
+def get_stage_inputs(data, stage):
+    """ Return the subset of the definition that affects the output of ``stage`` """
+    general = data["general"]
+    image = data["image"]
+    if stage == "image":
+        return {
+            "general": {
+                key: general.get(key)
+                for key in (
+                    "name",
+                    "domain",
+                    "format",
+                    "os-name",
+                    "os-version",
+                    "build-mode",
+                    "scratch-dir",
+                )
+            },
+            "image": image,
+            "files": hash_references(image.get("config", {})),
+            "provision": [
+                hash_references(item)
+                for item in image.get("config", {}).get("provision", [])
+            ],
+        }
+    elif stage in {"volume", "upload", "cleanup"}:
+        keys = ("uri", "pool", "name", "format", "build-mode", "scratch-dir")
+        inputs = {
+            "general": {key: general.get(key) for key in keys},
+            "size": image["size"] if stage == "volume" else None,
+        }
+        if stage == "volume" and "qcow2" in image:
+            # Only added when present, so that the older fingerprints stay valid
+            inputs["qcow2"] = image["qcow2"]
+        return inputs
+    elif stage == "overlay":
+        # The overlay must be recreated whenever the base image changes
+        base = dict(data, general=dict(general, name=data["replica"]["base"]))
+        keys = ("uri", "pool", "name", "format")
+        return {
+            "general": {key: general.get(key) for key in keys},
+            "size": image["size"],
+            "base": get_stage_inputs(base, "image"),
+        }
+    elif stage == "customize":
+        keys = ("uri", "pool", "name", "domain", "verbose")
+        return {
+            "general": {key: general.get(key) for key in keys},
+            "provision": [
+                hash_references(item) for item in data["replica"]["provision"]
+            ],
+        }
+    elif stage == "vm":
+        keys = ("uri", "pool", "name", "os-variant", "os-name", "os-version")
+        vm = data["vm"]
+        if "wait" in vm:
+            # Only affects the wait stage
+            vm = {key: value for key, value in vm.items() if key != "wait"}
+        return {"general": {key: general.get(key) for key in keys}, "vm": vm}
+    elif stage == "wait":
+        return {
+            "general": {key: general.get(key) for key in ("uri", "name")},
+            "wait": data["vm"]["wait"],
+        }
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def get_fingerprints(data):
+    """
+    Return a mapping with the fingerprint of each create stage.
+
+    The fingerprint of a stage depends on its inputs, on the versions of the tools it is
+    using and on the fingerprints of the stages it depends on. Therefore, when the
+    inputs of a stage change, the fingerprints of all the downstream stages change too.
+
+    """
+    fingerprints = {}
+    dependencies = api.get_stage_dependencies(data)
+    for stage in api.get_stages(data):
+        fingerprints[stage] = get_digest(
+            get_stage_inputs(data, stage),
+            [get_tool_version(tool) for tool in STAGE_TOOLS[stage]],
+            [fingerprints[dep] for dep in dependencies[stage]],
+        )
+    return fingerprints
+
+
+# The virsh errors of a domain that doesn't exist
+MISSING_DOMAIN_ERRORS = ("failed to get domain", "Domain not found")
+
+
+def _succeeds(*cmd):
+    process = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return process.returncode == 0
+
+
+def volume_exists(data):
+    general = data["general"]
+    return _succeeds(
+        "virsh",
+        f"--connect={general['uri']}",
+        "vol-info",
+        f"--pool={general['pool']}",
+        general["name"],
+    )
+
+
+def domain_exists(data):
+    general = data["general"]
+    return _succeeds("virsh", f"--connect={general['uri']}", "dominfo", general["name"])
+
+
+def get_domain_state(data):
+    """
+    Return the state of the domain (e.g. ``running``) or None if it is missing.
+
+    The other errors, e.g. an unreachable ``uri``, raise ``CalledProcessError``.
+
+    """
+    general = data["general"]
+    process = subprocess.run(
+        ["virsh", f"--connect={general['uri']}", "domstate", general["name"]],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if process.returncode == 0:
+        return process.stdout.strip()
+    if any(error in process.stderr for error in MISSING_DOMAIN_ERRORS):
+        return None
+    raise subprocess.CalledProcessError(
+        process.returncode, process.args, stderr=process.stderr
+    )
+
+
+class StateStore(object):
+    """
+    Store the fingerprints of the stages that have been successfully executed.
+
+    There is one JSON file per node inside ``.virtbuilder/state``.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path) if path else get_state_dir("state")
+        self._lock = threading.Lock()
+
+    def _get_path(self, data):
+        return self.path / f"{data['general']['name']}.json"
+
+    def load(self, data):
+        path = self._get_path(data)
+        if not path.exists():
+            return {}
+        return json.loads(path.read_text())
+
+    def record(self, data, stage, fingerprint):
+        """ Record that ``stage`` has been executed with ``fingerprint`` """
+        with self._lock:
+            recorded = self.load(data)
+            recorded[stage] = fingerprint
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._get_path(data).write_text(json.dumps(recorded, indent=2))
+
+    def clear(self, data):
+        path = self._get_path(data)
+        if path.exists():
+            path.unlink()
+
+    def get_outdated_stages(self, data, fingerprints=None):
+        """
+        Return the create stages that need to be executed.
+
+        A stage is outdated if its fingerprint has changed, if its output is missing or
+        if a stage it depends on is outdated. The image is only needed by the upload
+        stage, so, when the upload is up to date, a missing image is not rebuilt.
+
+        """
+        fingerprints = fingerprints or get_fingerprints(data)
+        recorded = self.load(data)
+        image = api.get_image_path(data)
+        missing_output = {
+            "image": lambda: False,
+            "volume": lambda: not volume_exists(data),
+            # If the volume is missing, the volume stage (and therefore the upload) is
+            # outdated anyway
+            "upload": lambda: False,
+            "cleanup": image.exists,
+            "vm": lambda: not domain_exists(data),
+            "overlay": lambda: not volume_exists(data),
+            "customize": lambda: False,
+            # Whether the VM is ready is not an output, so it's always checked again
+            "wait": lambda: True,
+        }
+        outdated = []
+        dependencies = api.get_stage_dependencies(data)
+        for stage in api.get_stages(data):
+            if (
+                recorded.get(stage) != fingerprints[stage]
+                or any(dep in outdated for dep in dependencies[stage])
+                or missing_output[stage]()
+            ):
+                outdated.append(stage)
+        if "upload" in outdated and "image" not in outdated and not image.exists():
+            outdated.insert(0, "image")
+        return outdated
@@ -0,0 +1,173 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+_tracer = None
+
+
+class Span(object):
+    """ The measurements of a single traced operation """
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.thread_id = threading.get_ident()
+        self.thread_name = threading.current_thread().name
+        self.start = time.perf_counter()
+        self.end = None
+        # The resource usage of the child processes that were executed during the span
+        self.cpu = 0.0
+        self.maxrss = 0
+        self.inblock = 0
+        self.oublock = 0
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def add_rusage(self, rusage):
+        self.cpu += rusage.ru_utime + rusage.ru_stime
+        # On Linux ru_maxrss is in KiB
+        self.maxrss = max(self.maxrss, rusage.ru_maxrss)
+        self.inblock += rusage.ru_inblock
+        self.oublock += rusage.ru_oublock
+
+
+class Tracer(object):
+    """
+    Collect ``Span`` objects from all the threads.
+
+    The collected spans can be exported in the Chrome trace event format, which can be
+    loaded in ``chrome://tracing`` or https://ui.perfetto.dev.
+
+    """
+
+    def __init__(self):
+        self.spans = []
+        self.origin = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _get_stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextlib.contextmanager
+    def span(self, name, category="stage", **args):
+        span = Span(name, category, args)
+        stack = self._get_stack()
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def add_rusage(self, rusage):
+        """ Attribute the resource usage of a child process to the open spans """
+        for span in self._get_stack():
+            span.add_rusage(rusage)
+
+    def to_chrome_trace(self):
+        threads = {}
+        events = []
+        for span in sorted(self.spans, key=lambda span: span.start):
+            if span.thread_id not in threads:
+                threads[span.thread_id] = len(threads) + 1
+                events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": threads[span.thread_id],
+                        "args": {"name": span.thread_name},
+                    }
+                )
+            events.append(
+                {
+                    "name": span.name,
+                    "cat": span.category,
+                    "ph": "X",
+                    "ts": (span.start - self.origin) * 1e6,
+                    "dur": span.duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threads[span.thread_id],
+                    "args": {
+                        **span.args,
+                        "cpu_seconds": span.cpu,
+                        "max_rss_kib": span.maxrss,
+                        "blocks_read": span.inblock,
+                        "blocks_written": span.oublock,
+                    },
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, path):
+        with open(path, "w") as fd:
+            json.dump(self.to_chrome_trace(), fd, indent=1)
+
+    def get_summary(self):
+        """ Return the rows of a summary table, one per span and one per category """
+        header = [
+            "span",
+            "wall (s)",
+            "cpu (s)",
+            "max rss (MiB)",
+            "blocks in",
+            "blocks out",
+        ]
+        rows = []
+        totals = {}
+        for span in sorted(self.spans, key=lambda span: span.start):
+            rows.append(
+                [
+                    span.name,
+                    f"{span.duration:.2f}",
+                    f"{span.cpu:.2f}",
+                    f"{span.maxrss / 1024:.1f}",
+                    str(span.inblock),
+                    str(span.oublock),
+                ]
+            )
+            total = totals.setdefault(span.args.get("stage", span.category), [0, 0])
+            total[0] += span.duration
+            total[1] += span.cpu
+        for name, (wall, cpu) in totals.items():
+            rows.append([f"total {name}", f"{wall:.2f}", f"{cpu:.2f}", "", "", ""])
+        return [header] + rows
+
+
+def enable():
+    """ Start collecting spans and return the ``Tracer`` """
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def disable():
+    global _tracer
+    _tracer = None
+
+
+def get_tracer():
+    return _tracer
+
+
+def span(name, category="stage", **args):
+    """ Trace an operation, if tracing has been enabled """
+    if _tracer is None:
+        # A no-op context manager (contextlib.nullcontext requires python 3.7)
+        return contextlib.suppress()
+    return _tracer.span(name, category, **args)
+
+
+def add_rusage(rusage):
+    if _tracer is not None:
+        _tracer.add_rusage(rusage)
@@ -0,0 +1,256 @@
+import functools
+import json
+import pathlib
+import threading
+
+# The disk settings of the VMs. ``default`` is what virtbuilder has always used.
+DISK_PROFILES = {
+    "default": {"bus": "virtio", "cache": "none", "io": "native"},
+    # virtio-scsi with one queue per vCPU (up to 4) and io_uring, which needs
+    # QEMU >= 5.0 and libvirt >= 6.3
+    "throughput": {
+        "bus": "scsi",
+        "cache": "none",
+        "io": "io_uring",
+        "discard": "unmap",
+        "detect-zeroes": "unmap",
+        "iothreads": 1,
+        "queues": 4,
+    },
+    # virtio-blk on a dedicated iothread, so that the requests don't wait for the
+    # main loop of QEMU
+    "latency": {"bus": "virtio", "cache": "none", "io": "native", "iothreads": 1},
+}
+
+# The virt-install names of the ``--disk`` options
+DISK_OPTIONS = {
+    "bus": "bus",
+    "cache": "cache",
+    "io": "io",
+    "discard": "discard",
+    "detect-zeroes": "detect_zeroes",
+}
+
+# The qemu-img names of the qcow2 options
+QCOW2_OPTIONS = {
+    "preallocation": "preallocation",
+    "cluster-size": "cluster_size",
+    "lazy-refcounts": "lazy_refcounts",
+}
+
+
+def get_disk_settings(vm):
+    """ Return the disk settings of the profile of ``vm``, with its overrides """
+    performance = dict(vm.get("disk-performance", {}))
+    profile = performance.pop("profile", "default")
+    return dict(DISK_PROFILES[profile], **performance)
+
+
+def get_disk_parts(vm, volume):
+    """ Return the virt-install options that attach ``volume`` to the VM """
+    settings = get_disk_settings(vm)
+    disk = [f"vol={volume}"]
+    disk.extend(
+        f"{DISK_OPTIONS[key]}={settings[key]}"
+        for key in DISK_OPTIONS
+        if key in settings
+    )
+    parts = []
+    iothreads = settings.get("iothreads")
+    if iothreads:
+        parts.append(f"--iothreads {iothreads}")
+    driver = []
+    if iothreads:
+        driver.append("driver.iothread=1")
+    if settings.get("queues"):
+        driver.append(f"driver.queues={settings['queues']}")
+    if settings["bus"] == "scsi":
+        # The multiqueue and the iothread are properties of the virtio-scsi controller
+        controller = ["type=scsi", "model=virtio-scsi"] + driver
+        parts.append(f"--controller {','.join(controller)}")
+    else:
+        disk.extend(driver)
+    parts.insert(0, f"--disk {','.join(disk)}")
+    return parts
+
+
+def get_qcow2_options(image):
+    """ Return the ``-o`` argument of ``qemu-img`` for the ``qcow2`` image settings """
+    qcow2 = image.get("qcow2", {})
+    options = []
+    for key, name in QCOW2_OPTIONS.items():
+        if key in qcow2:
+            value = qcow2[key]
+            if isinstance(value, bool):
+                value = "on" if value else "off"
+            options.append(f"{name}={value}")
+    return ",".join(options)
+
+
+def parse_cpuset(cpuset):
+    """ Return the list of the CPUs of a cpuset like ``0-3,8`` """
+    cpus = []
+    for item in str(cpuset).split(","):
+        start, _, end = item.partition("-")
+        cpus.extend(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def format_cpuset(cpus):
+    """ Return the cpuset of a list of CPUs, e.g. ``[0, 1, 2, 3, 8]`` -> ``0-3,8`` """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{a}" if a == b else f"{a}-{b}" for a, b in ranges)
+
+
+def get_performance_parts(vm):
+    """ Return the virt-install options of the ``performance`` settings of ``vm`` """
+    performance = vm.get("performance", {})
+    parts = []
+    if "cpu-model" in performance:
+        parts.append(f"--cpu {performance['cpu-model']}")
+    pinning = performance.get("pinning")
+    if pinning == "auto":
+        raise ValueError("'pinning: auto' needs a CPU allocation, see CpuAllocator")
+    if pinning:
+        cpus = parse_cpuset(pinning)
+        vcpus = int(vm["vcpus"])
+        if len(cpus) < vcpus:
+            raise ValueError(f"Can't pin {vcpus} vCPUs to the CPUs: {pinning}")
+        pins = [
+            f"vcpupin{index}.vcpu={index},vcpupin{index}.cpuset={cpu}"
+            for index, cpu in enumerate(cpus[:vcpus])
+        ]
+        parts.append(f"--cputune {','.join(pins)}")
+    if "numa-node" in performance:
+        parts.append(f"--numatune {performance['numa-node']},mode=strict")
+    hugepages = performance.get("hugepages")
+    if hugepages is True:
+        parts.append("--memorybacking hugepages=on")
+    elif hugepages:
+        size, unit = hugepages[:-1], hugepages[-1]
+        parts.append(
+            f"--memorybacking hugepages.page0.size={size},hugepages.page0.unit={unit}"
+        )
+    return parts
+
+
+def get_network_parts(vm):
+    """ Return the virt-install ``--network`` option, with virtio-net multiqueue """
+    queues = vm.get("performance", {}).get("net-queues")
+    if queues == "auto":
+        # One queue per vCPU is what the virtio-net documentation recommends
+        queues = int(vm["vcpus"])
+    network = vm.get("network")
+    if not queues:
+        return [f"--network {network}"] if network else []
+    network = network or "network=default,model=virtio"
+    return [f"--network {network},driver.queues={queues}"]
+
+
+class CpuAllocator(object):
+    """
+    Allocate host CPUs to the nodes that use ``pinning: auto``.
+
+    Each node gets its own CPUs, on the NUMA node of its ``numa-node`` setting if it
+    has one (or on a single NUMA node if possible otherwise), and no two nodes on the
+    same host (i.e. URI) share a CPU. The allocations are kept in
+    ``.virtbuilder/cpus.json``, so that they are stable across runs and they don't
+    overlap with the nodes that have been created by earlier runs. A new allocation
+    is only kept in memory until ``claim`` is called, when the VM gets created, so
+    that e.g. a preview doesn't take up any CPUs.
+
+    """
+
+    def __init__(self, path=None, topology=None):
+        from .utils import get_state_dir
+
+        self.path = pathlib.Path(path) if path else get_state_dir("cpus.json")
+        # uri -> {numa node -> [cpus]}
+        self.topology = topology or get_host_topology
+        self._lock = threading.Lock()
+        # uri -> {name -> [cpus]} of the allocations that haven't been claimed yet
+        self._pending = {}
+
+    def load(self):
+        if not self.path.exists():
+            return {}
+        return json.loads(self.path.read_text())
+
+    def save(self, allocations):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(allocations, indent=2, sort_keys=True))
+
+    def allocate(self, data):
+        """ Return ``data`` with ``pinning: auto`` replaced by the allocated CPUs """
+        vm = data["vm"]
+        performance = vm.get("performance", {})
+        if performance.get("pinning") != "auto":
+            return data
+        general = data["general"]
+        name, uri, vcpus = general["name"], general["uri"], int(vm["vcpus"])
+        with self._lock:
+            host = self.load().get(uri, {})
+            host.update(self._pending.get(uri, {}))
+            cpus = host.get(name)
+            if cpus is None or len(cpus) != vcpus:
+                cpus = self._find_cpus(uri, host, name, vcpus, performance)
+                self._pending.setdefault(uri, {})[name] = cpus
+        performance = dict(performance, pinning=format_cpuset(cpus))
+        return dict(data, vm=dict(vm, performance=performance))
+
+    def claim(self, data):
+        """ Keep the new allocation of a node, once its VM is being created """
+        general = data["general"]
+        with self._lock:
+            cpus = self._pending.get(general["uri"], {}).pop(general["name"], None)
+            if cpus is None:
+                return
+            allocations = self.load()
+            allocations.setdefault(general["uri"], {})[general["name"]] = cpus
+            self.save(allocations)
+
+    def _find_cpus(self, uri, host, name, vcpus, performance):
+        topology = self.topology(uri)
+        if "numa-node" in performance:
+            cells = [topology.get(performance["numa-node"], [])]
+        else:
+            cells = list(topology.values())
+        taken = {cpu for node, cpus in host.items() if node != name for cpu in cpus}
+        if len(cells) > 1:
+            # Prefer a single NUMA node, but span them if none has enough free CPUs
+            cells.append([cpu for cell in cells for cpu in cell])
+        for cell in cells:
+            free = [cpu for cpu in cell if cpu not in taken]
+            if len(free) >= vcpus:
+                return free[:vcpus]
+        msg = f"{name}: not enough free host CPUs on {uri} for {vcpus} pinned vCPUs"
+        raise ValueError(msg)
+
+    def release(self, data):
+        """ Free the CPUs of a removed node """
+        general = data["general"]
+        with self._lock:
+            self._pending.get(general["uri"], {}).pop(general["name"], None)
+            allocations = self.load()
+            if allocations.get(general["uri"], {}).pop(general["name"], None):
+                self.save(allocations)
+
+
+@functools.lru_cache(maxsize=None)
+def get_host_topology(uri):
+    """ Return a ``{numa node: [cpus]}`` mapping of the host of ``uri`` """
+    import subprocess
+    import xml.etree.ElementTree as ET
+
+    xml = subprocess.check_output(["virsh", "--connect", uri, "capabilities"])
+    root = ET.fromstring(xml)
+    topology = {}
+    for cell in root.iterfind("host/topology/cells/cell"):
+        cpus = [int(cpu.get("id")) for cpu in cell.iterfind("cpus/cpu")]
+        topology[int(cell.get("id"))] = sorted(cpus)
+    return topology
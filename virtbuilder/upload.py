@@ -0,0 +1,105 @@
+import hashlib
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from .utils import write_line
+
+CHUNK_SIZE = 1024 * 1024
+# Smaller ranges are not worth the overhead of an extra connection
+MIN_RANGE_SIZE = 64 * 1024 ** 2
+# More ranges than streams, so that the progress gets reported more often
+RANGES_PER_STREAM = 4
+
+
+def get_ranges(size, streams, min_size=None):
+    """ Split ``size`` bytes into the ``(offset, length)`` ranges of ``streams`` """
+    min_size = min_size or MIN_RANGE_SIZE
+    count = max(1, min(streams * RANGES_PER_STREAM, size // min_size))
+    length = -(-size // count) or 1
+    return [(offset, min(length, size - offset)) for offset in range(0, size, length)]
+
+
+def hash_range(path, offset, length):
+    """ Return the sha256 of ``length`` bytes of ``path`` starting at ``offset`` """
+    digest = hashlib.sha256()
+    with open(path, "rb") as fd:
+        fd.seek(offset)
+        while length:
+            chunk = fd.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            digest.update(chunk)
+            length -= len(chunk)
+    return digest.hexdigest()
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:d}:{minutes:02d}:{seconds:02d}"
+
+
+class Progress(object):
+    """ Report the throughput and the estimated remaining time of a transfer """
+
+    def __init__(self, total, prefix, output=write_line, clock=time.monotonic):
+        self.total = total
+        self.prefix = prefix
+        self.output = output
+        self.clock = clock
+        self.done = 0
+        self.started = clock()
+        self._lock = threading.Lock()
+
+    def update(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            self.output(f"[{self.prefix}] {self.format()}")
+
+    def format(self):
+        elapsed = max(self.clock() - self.started, 1e-6)
+        rate = self.done / elapsed
+        percent = 100 * self.done / self.total if self.total else 100
+        eta = (self.total - self.done) / rate if rate else 0
+        return (
+            f"{percent:5.1f}% of {self.total / 1024 ** 2:.1f} MiB, "
+            f"{rate / 1024 ** 2:.1f} MiB/s, ETA {format_duration(eta)}"
+        )
+
+
+def upload_file(
+    path, size, upload_range, download_digest, streams, progress=None, verify=True
+):
+    """
+    Upload ``size`` bytes of ``path`` in concurrent ranges and verify the result.
+
+    ``upload_range(offset, length)`` uploads a single range of the file, while
+    ``download_digest(offset, length)`` returns the sha256 of a range of the uploaded
+    volume. If ``verify`` is True, the ranges of the volume are compared to the ones of
+    the local file and a ValueError is raised if any of them differ. This downloads
+    the whole volume again, so it doubles the transferred bytes.
+
+    """
+    ranges = get_ranges(size, streams)
+    with ThreadPoolExecutor(max_workers=streams) as executor:
+        futures = {
+            executor.submit(upload_range, offset, length): length
+            for offset, length in ranges
+        }
+        for future in as_completed(futures):
+            future.result()
+            if progress is not None:
+                progress.update(futures[future])
+        if not verify:
+            return
+        local = executor.map(lambda r: hash_range(path, *r), ranges)
+        remote = executor.map(lambda r: download_digest(*r), ranges)
+        mismatched = [
+            offset
+            for (offset, _), expected, actual in zip(ranges, local, remote)
+            if expected != actual
+        ]
+    if mismatched:
+        raise ValueError(f"Checksum mismatch for {path} at offsets: {mismatched}")
@@ -1,26 +1,141 @@
+import hashlib
 import json
+import os
 import pathlib
+import re
 import shlex
 import subprocess
+import sys
 
-import ruamel.yaml
+from . import tracing
 
 
 def load_yaml(path):
+    """
+    Load a yaml file using the C parser, if it is available.
+
+    The C parser (libyaml) is stricter than the pure python one (e.g. it rejects
+    ``{uri: qemu:///system}``), so on errors the file is parsed again with the pure
+    python parser, which remains the reference.
+
+    """
+    # ruamel is imported lazily, since it is slow to import and it is not needed when
+    # the definitions are loaded from the ``DefinitionCache``
+    import ruamel.yaml
+
     path = pathlib.Path(path)
-    yml = ruamel.yaml.YAML(typ="safe", pure=True)  # 'safe' load and dump
-    data = yml.load(path.read_text())
+    text = path.read_text()
+    yml = ruamel.yaml.YAML(typ="safe")  # 'safe' load and dump
+    if yml.Parser is not ruamel.yaml.parser.Parser:
+        try:
+            return yml.load(text)
+        except ruamel.yaml.YAMLError:
+            pass
+    yml = ruamel.yaml.YAML(typ="safe", pure=True)
+    data = yml.load(text)
     return data
 
 
+def load_yaml_all(path):
+    """
+    Lazily load the documents of a multi-document yaml file.
+
+    Like ``load_yaml`` the C parser is tried first. If it fails half way, the pure
+    python parser takes over, skipping the documents that have already been loaded.
+
+    """
+    import ruamel.yaml
+
+    path = pathlib.Path(path)
+    loaded = 0
+    yml = ruamel.yaml.YAML(typ="safe")
+    if yml.Parser is not ruamel.yaml.parser.Parser:
+        with path.open() as fd:
+            try:
+                for document in yml.load_all(fd):
+                    loaded += 1
+                    yield document
+                return
+            except ruamel.yaml.YAMLError:
+                pass
+    yml = ruamel.yaml.YAML(typ="safe", pure=True)
+    with path.open() as fd:
+        for index, document in enumerate(yml.load_all(fd)):
+            if index >= loaded:
+                yield document
+
+
 def load_json(path):
     with open(path) as fd:
         data = json.load(fd)
     return data
 
 
-def execute_cmd(cmd):
+def split_cmd(cmd):
     cmd = shlex.split(cmd)
     # newlines seem to confuse shlex
     cmd = [elem for elem in cmd if elem != "\n"]
-    return subprocess.check_call(cmd)
+    return cmd
+
+
+def execute_cmd(cmd):
+    """
+    Execute ``cmd`` and raise a ``CalledProcessError`` if it fails.
+
+    The process is reaped with ``os.wait4()`` so that its resource usage can be
+    attributed to the active tracing spans.
+
+    """
+    cmd = split_cmd(cmd)
+    process = subprocess.Popen(cmd)
+    try:
+        _, status, rusage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.kill()
+        process.wait()
+        raise
+    process.returncode = (
+        -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    )
+    tracing.add_rusage(rusage)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    return 0
+
+
+SIZE_UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3, "t": 1024 ** 4}
+
+
+def parse_size(size):
+    """ Convert a size like ``12G`` or ``512M`` to bytes """
+    match = re.fullmatch(
+        r"\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*", str(size).lower()
+    )
+    if not match:
+        raise ValueError(f"Invalid size: {size}")
+    number, unit = match.groups()
+    return int(float(number) * SIZE_UNITS[unit])
+
+
+def write_line(line):
+    sys.stdout.write(line + "\n")
+    sys.stdout.flush()
+
+
+def get_cache_dir(*parts):
+    """ Return a directory inside the user's cache dir (i.e. ``$XDG_CACHE_HOME``) """
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return pathlib.Path(base, "virtbuilder", *parts)
+
+
+def get_state_dir(*parts):
+    """ Return a directory inside the state dir of the current working directory """
+    return pathlib.Path(".virtbuilder", *parts)
+
+
+def get_digest(*items):
+    """ Return a hex digest of JSON serializable ``items`` """
+    digest = hashlib.sha256()
+    for item in items:
+        digest.update(json.dumps(item, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
@@ -0,0 +1,336 @@
+import functools
+import hashlib
+import os
+import pathlib
+import pickle
+import tempfile
+import urllib.parse
+
+from schema import Optional, Schema, SchemaError
+
+from . import __version__
+from .schemas import FullSchema
+from .utils import get_cache_dir, load_yaml
+
+
+class NoDefault(object):
+    def __repr__(self):
+        return "<no default>"
+
+
+NO_DEFAULT = NoDefault()
+
+
+class LeafValidator(object):
+    """ Validate a single value using a (precompiled) ``schema`` validator """
+
+    def __init__(self, validator):
+        self.schema = validator if isinstance(validator, Schema) else Schema(validator)
+
+    def validate(self, data, path, errors, memo=None):
+        try:
+            return self.schema.validate(data)
+        except SchemaError as exc:
+            errors.append(f"Key '{path}' error:\n{exc.code}")
+            return data
+
+
+class MappingValidator(object):
+    """ Validate a mapping by dispatching each key to the validator of its value """
+
+    def __init__(self, fields):
+        # name -> (required, default, validator)
+        self.fields = fields
+        self.required = [name for name, (required, _, _) in fields.items() if required]
+        self.defaults = {
+            name: default
+            for name, (_, default, _) in fields.items()
+            if default is not NO_DEFAULT
+        }
+
+    def validate(self, data, path, errors, memo=None):
+        if not isinstance(data, dict):
+            errors.append(f"Key '{path}' error:\n{data!r} should be a mapping")
+            return data
+        result = dict(self.defaults)
+        for key, value in data.items():
+            field = self.fields.get(key)
+            key_path = f"{path}.{key}" if path else key
+            if field is None:
+                errors.append(f"Wrong key '{key_path}'")
+                continue
+            if memo is None:
+                result[key] = field[2].validate(value, key_path, errors)
+            else:
+                result[key] = memo.validate(field[2], value, key_path, errors)
+        for key in self.required:
+            if key not in data:
+                key_path = f"{path}.{key}" if path else key
+                errors.append(f"Missing key: '{key_path}'")
+        return result
+
+
+class ProvisionValidator(object):
+    """
+    Validate a list of single key mappings, e.g. the ``provision`` list.
+
+    Instead of trying each alternative for every item (which is what ``schema`` does),
+    each item is dispatched to the validator of its key.
+
+    """
+
+    def __init__(self, dispatch):
+        self.dispatch = dispatch
+
+    def validate(self, data, path, errors, memo=None):
+        if not isinstance(data, list):
+            errors.append(f"Key '{path}' error:\n{data!r} should be a list")
+            return data
+        result = []
+        for index, item in enumerate(data):
+            item_path = f"{path}[{index}]"
+            if not isinstance(item, dict) or len(item) > 1:
+                errors.append(
+                    f"Key '{item_path}' error:\n{item!r} should be a single key mapping"
+                )
+                continue
+            validated = {}
+            for key, value in item.items():
+                validator = self.dispatch.get(key)
+                if validator is None:
+                    errors.append(f"Wrong key '{key}' in {item_path}")
+                    continue
+                validated[key] = validator.validate(value, f"{item_path}.{key}", errors)
+            result.append(validated)
+        return result
+
+
+class ValidationMemo(object):
+    """
+    Remember the validation results of the ``shared`` objects.
+
+    When many definitions are created by merging overrides on top of the same
+    defaults, the sub-structures that are not overridden are the very same objects in
+    all of them. Those are validated only once.
+
+    """
+
+    def __init__(self, shared=()):
+        # Keep references, so that the ids can't be reused
+        self.shared = {id(obj): obj for obj in shared}
+        self.results = {}
+
+    def validate(self, validator, value, path, errors):
+        if id(value) not in self.shared:
+            return validator.validate(value, path, errors, self)
+        key = (id(value), path)
+        if key not in self.results:
+            value_errors = []
+            result = validator.validate(value, path, value_errors, self)
+            self.results[key] = (result, value_errors)
+        result, value_errors = self.results[key]
+        errors.extend(value_errors)
+        return result
+
+
+def _get_key(key):
+    """ Return the ``(name, required, default)`` of a ``schema`` dictionary key """
+    if isinstance(key, Optional):
+        return key.schema, False, getattr(key, "default", NO_DEFAULT)
+    return key, True, NO_DEFAULT
+
+
+def compile_schema(schema):
+    """
+    Turn a ``schema.Schema`` into a tree of validators.
+
+    Dictionaries become ``MappingValidator`` objects and lists of single key
+    dictionaries become ``ProvisionValidator`` objects. Everything else is a leaf and
+    it is validated by ``schema`` itself.
+
+    """
+    inner = schema.schema if type(schema) is Schema else schema
+    if isinstance(inner, dict):
+        fields = {}
+        for key, value in inner.items():
+            name, required, default = _get_key(key)
+            fields[name] = (required, default, compile_schema(value))
+        return MappingValidator(fields)
+    if (
+        isinstance(inner, list)
+        and inner
+        and all(isinstance(item, dict) and len(item) == 1 for item in inner)
+    ):
+        dispatch = {}
+        for item in inner:
+            ((key, value),) = item.items()
+            dispatch[_get_key(key)[0]] = compile_schema(value)
+        return ProvisionValidator(dispatch)
+    return LeafValidator(schema)
+
+
+@functools.lru_cache(maxsize=None)
+def get_validator():
+    """ Return the compiled validator of ``FullSchema`` """
+    return compile_schema(FullSchema)
+
+
+def validate_data(data, memo=None):
+    """
+    Validate ``data`` in a single pass and return the validated data.
+
+    Raise a ``SchemaError`` that contains all the errors, if there are any. ``memo`` is
+    an optional ``ValidationMemo``.
+
+    """
+    errors = []
+    validated = get_validator().validate(data, "", errors, memo)
+    if not errors:
+        errors.extend(check_combinations(validated))
+    if errors:
+        raise SchemaError(errors)
+    return validated
+
+
+def check_combinations(data):
+    """ Return the errors of the options that are only invalid in combination """
+    errors = []
+    uri = data["general"]["uri"]
+    if "replicas" in data and urllib.parse.urlsplit(uri).hostname:
+        errors.append(
+            f"Key 'replicas' error:\nreplicas are customized in the storage pool, "
+            f"so they need a local 'general.uri', not: {uri}"
+        )
+    return errors
+
+
+class DefinitionCache(object):
+    """
+    An on-disk cache of the definitions that have been successfully validated.
+
+    There is one pickled entry per definition file. An entry is valid as long as the
+    modification time and the size of the file haven't changed; if they have, the
+    sha256 of the contents decides whether the file must be parsed again. Entries
+    written by a different version of virtbuilder are ignored.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = pathlib.Path(path) if path else get_cache_dir("definitions")
+
+    def entry_path(self, path):
+        key = hashlib.sha256(str(path).encode()).hexdigest()
+        return self.path / f"{key}.pickle"
+
+    def _read_entry(self, path):
+        try:
+            with open(self.entry_path(path), "rb") as fd:
+                entry = pickle.load(fd)
+        except Exception:
+            # Missing, truncated or incompatible entries are just cache misses
+            return None
+        if entry.get("version") != __version__:
+            return None
+        return entry
+
+    def _write_entry(self, path, entry):
+        self.path.mkdir(parents=True, exist_ok=True)
+        # Write atomically, so that concurrent runs never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as tmp_fd:
+                pickle.dump(entry, tmp_fd, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.entry_path(path))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def get(self, path):
+        """ Return the cached data of ``path`` or None if it must be parsed again """
+        path = pathlib.Path(path).resolve()
+        stat = path.stat()
+        entry = self._read_entry(path)
+        if entry is None:
+            return None
+        if entry["mtime"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+            return entry["data"]
+        if entry["sha256"] != hashlib.sha256(path.read_bytes()).hexdigest():
+            return None
+        # Only the modification time has changed
+        self.put(path, entry["data"])
+        return entry["data"]
+
+    def put(self, path, data):
+        """ Store the validated ``data`` of ``path`` """
+        path = pathlib.Path(path).resolve()
+        stat = path.stat()
+        entry = {
+            "version": __version__,
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": hashlib.sha256(path.read_bytes()).hexdigest(),
+            "data": data,
+        }
+        try:
+            self._write_entry(path, entry)
+        except OSError:
+            # e.g. a read-only cache dir; the cache is just an optimization
+            pass
+
+    def load(self, path):
+        """ Return the validated data of ``path``, parsing it only if necessary """
+        data = self.get(path)
+        if data is None:
+            data = load_yaml(path)
+            validate_data(data)
+            self.put(path, data)
+        return data
+
+
+def load_definition(path, cache=None):
+    """
+    Load and validate a definition file. Raise a SchemaError if it is not valid.
+
+    If a ``DefinitionCache`` is provided, the file is only parsed if it has changed
+    since it was last validated.
+
+    """
+    if cache is not None:
+        return cache.load(path)
+    data = load_yaml(path)
+    validate_data(data)
+    return data
+
+
+def check_file(path, cache=None):
+    """ Return the list of the validation errors of a definition (or cluster) file """
+    from .cluster import check_definitions, iter_definitions
+
+    try:
+        for _ in iter_definitions(path, definition_cache=cache):
+            pass
+    except SchemaError:
+        # Parse the file again, in order to report the errors of all the definitions
+        return check_definitions(path)
+    except Exception as exc:
+        return [f"{type(exc).__name__}: {exc}"]
+    return []
+
+
+def check_files(paths, jobs=None, cache=None):
+    """
+    Validate multiple definition files and return a ``{path: errors}`` mapping.
+
+    The files are checked in parallel, using a pool of ``jobs`` processes.
+
+    """
+    jobs = jobs or os.cpu_count() or 1
+    paths = [str(path) for path in paths]
+    check = functools.partial(check_file, cache=cache)
+    if jobs == 1 or len(paths) == 1:
+        return {path: check(path) for path in paths}
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        chunksize = max(1, len(paths) // (jobs * 4))
+        return dict(zip(paths, executor.map(check, paths, chunksize=chunksize)))